@@ -0,0 +1,248 @@
+"""
+End-to-end broker benchmark: throughput, latency and broker CPU per message.
+
+Starts `mdbroker` in a subprocess, M synthetic echo workers (MajorDomoWorker threads) in a second process and drives
+them from N synthetic MajorDomoClient threads, each keeping `window` requests in flight. Every combination of payload
+size and dispatch mode is run for `duration` seconds:
+    single  each request goes to one worker
+    group   each request is a multiple request dispatched to `group_size` workers at once, every worker replies
+
+Reported per run: replies/sec seen by the clients, p50/p99/p999 request-to-reply latency and the broker's CPU time per
+reply (from /proc, Linux only).
+
+    python3 -m auxo_olympus.benchmarks.bench_broker --clients 4 --workers 4 --payload 64 4096 --mode single group
+    python3 -m auxo_olympus.benchmarks.bench_broker --transport tcp --broker-args="--asyncio -batch 64"
+
+With --compare-args the whole suite is run a second time against a broker started with those arguments, and the
+throughput of each run is reported relative to the first, e.g. the cost of the journal:
+    python3 -m auxo_olympus.benchmarks.bench_broker --mode single --compare-args="-journal /tmp/broker.journal"
+
+--sharded starts the sharded broker (mdshard) instead, give it -shards through --broker-args.
+"""
+import os
+import sys
+import time
+import shlex
+import signal
+import struct
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+from auxo_olympus.lib.entities.mdcliapi import MajorDomoClient
+from auxo_olympus.lib.entities.mdwrkapi import MajorDomoWorker
+
+SERVICE = "bench"
+STAMP = struct.Struct(">Qd")        # request sequence number, client send time
+
+
+def run_workers(endpoint: str, count: int):
+    """ Worker process: `count` echo workers, each on its own thread """
+    logging.disable(logging.WARNING)
+
+    def echo(name):
+        worker = MajorDomoWorker(endpoint, SERVICE, False, f"W{name:04d}.{SERVICE}", peer_port=False)
+        reply = None
+        while True:
+            request = worker.recv(reply)
+            if request is None:
+                break
+            reply = [request]
+
+    threads = [threading.Thread(target=echo, args=(i,), daemon=True) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class BenchClient(threading.Thread):
+    """ Keeps `window` requests in flight until `stop_at`, recording the latency of every reply """
+
+    def __init__(self, endpoint, name, payload, window, stop_at, routing, replies_per_request):
+        super().__init__(daemon=True)
+        self.client = MajorDomoClient(endpoint, client_name=name)
+        self.client.timeout = 1000
+        self.padding = b"x" * max(0, payload - STAMP.size)
+        self.window = window
+        self.stop_at = stop_at
+        self.routing = routing
+        self.replies_per_request = replies_per_request
+        self.latencies = []
+        self.seq = 0
+
+    def send(self):
+        self.seq += 1
+        self.client.send(SERVICE, [STAMP.pack(self.seq, time.time()) + self.padding], **self.routing)
+
+    def run(self):
+        outstanding = {}
+        for _ in range(self.window):
+            self.send()
+            outstanding[self.seq] = self.replies_per_request
+
+        while outstanding:
+            reply = self.client.recv()
+            if reply is None:
+                break
+            now = time.time()
+            seq, sent = STAMP.unpack(reply[-1][:STAMP.size])
+            self.latencies.append(now - sent)
+
+            outstanding[seq] -= 1
+            if not outstanding[seq]:
+                del outstanding[seq]
+                if now < self.stop_at:
+                    self.send()
+                    outstanding[self.seq] = self.replies_per_request
+        self.client.client.close()
+
+
+def broker_cpu(pid: int):
+    """
+    User + system CPU seconds used so far by the process and its children (the shards of a sharded broker), None
+    where /proc is not available
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            for child in children.read().split():
+                cpu += broker_cpu(int(child)) or 0.0
+        return cpu
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def wait_for_workers(endpoint: str, workers: int, timeout: float = 30.0):
+    client = MajorDomoClient(endpoint, client_name="bench-probe")
+    client.timeout = 500
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            info = client.queue_info(SERVICE)
+            if info and info['waiting'] >= workers:
+                return
+            time.sleep(0.2)
+    finally:
+        client.client.close()
+    raise RuntimeError(f"{workers} workers did not register with the broker within {timeout}s")
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples)*fraction))]
+
+
+def bench_run(endpoint, broker_pid, args, payload, mode) -> dict:
+    routing = {}
+    replies_per_request = 1
+    if mode == 'group':
+        group_size = args.group_size or args.workers
+        routing = {'multiple': True, 'group_size': group_size, 'min_workers': group_size}
+        replies_per_request = group_size
+
+    cpu_start = broker_cpu(broker_pid)
+    start = time.time()
+    stop_at = start + args.duration
+    clients = [BenchClient(endpoint, f"C{i:03d}", payload, args.window, stop_at, routing, replies_per_request)
+               for i in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+    cpu_end = broker_cpu(broker_pid)
+
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    replies = len(latencies)
+    result = {'mode': mode, 'payload': payload, 'replies': replies, 'msgs_per_sec': replies / elapsed,
+              'p50_ms': 0.0, 'p99_ms': 0.0, 'p999_ms': 0.0, 'cpu_us_per_msg': None}
+    if latencies:
+        result.update(p50_ms=1e3*percentile(latencies, 0.5), p99_ms=1e3*percentile(latencies, 0.99),
+                      p999_ms=1e3*percentile(latencies, 0.999))
+    if cpu_start is not None and cpu_end is not None and replies:
+        result['cpu_us_per_msg'] = 1e6*(cpu_end - cpu_start) / replies
+    return result
+
+
+def print_result(result: dict):
+    cpu = f"{result['cpu_us_per_msg']:.1f}" if result['cpu_us_per_msg'] is not None else "n/a"
+    print(f"{result['mode']:>7} {result['payload']:>9} {result['msgs_per_sec']:>11.0f} {result['p50_ms']:>9.2f} "
+          f"{result['p99_ms']:>9.2f} {result['p999_ms']:>9.2f} {cpu:>12}", flush=True)
+
+
+def run_suite(args, broker_args: str) -> list:
+    """ Every mode and payload size against a broker started with broker_args, returns the results """
+    if args.transport == 'ipc':
+        endpoint = f"ipc://{tempfile.gettempdir()}/auxo-bench-{os.getpid()}.ipc"
+        bind = endpoint
+    else:
+        endpoint = f"tcp://127.0.0.1:{args.port}"
+        bind = f"tcp://*:{args.port}"
+
+    module = "auxo_olympus.lib.entities.mdshard" if args.sharded else "auxo_olympus.lib.entities.mdbroker"
+    broker = subprocess.Popen(
+        [sys.executable, "-m", module, "-bind", bind] + shlex.split(broker_args),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    workers = multiprocessing.get_context('spawn').Process(target=run_workers, args=(endpoint, args.workers),
+                                                           daemon=True)
+    workers.start()
+    results = []
+    try:
+        wait_for_workers(endpoint, args.workers)
+
+        print(f"{args.clients} clients, {args.workers} workers, window {args.window}, {args.transport}, "
+              f"broker args '{broker_args}'")
+        print(f"{'mode':>7} {'payload':>9} {'msgs/s':>11} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} "
+              f"{'cpu us/msg':>12}")
+        for mode in args.mode:
+            for payload in args.payload:
+                results.append(bench_run(endpoint, broker.pid, args, payload, mode))
+                print_result(results[-1])
+                wait_for_workers(endpoint, args.workers)
+    finally:
+        workers.terminate()
+        broker.send_signal(signal.SIGINT)
+        try:
+            broker.wait(5)
+        except subprocess.TimeoutExpired:
+            broker.kill()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', default=4, type=int, help='synthetic clients')
+    parser.add_argument('--workers', default=4, type=int, help='synthetic echo workers')
+    parser.add_argument('--window', default=8, type=int, help='requests each client keeps in flight')
+    parser.add_argument('--payload', nargs='+', type=int, default=[64, 4096, 65536], help='request sizes in bytes')
+    parser.add_argument('--mode', nargs='+', choices=['single', 'group'], default=['single', 'group'])
+    parser.add_argument('--group-size', default=0, type=int, help='workers per group request, 0 = all of them')
+    parser.add_argument('--duration', default=5.0, type=float, help='seconds per run')
+    parser.add_argument('--transport', choices=['ipc', 'tcp'], default='ipc')
+    parser.add_argument('--port', default=5599, type=int, help='tcp port for the broker')
+    parser.add_argument('--broker-args', default='', type=str, help='extra arguments for mdbroker')
+    parser.add_argument('--sharded', default=False, action='store_true', help='benchmark the sharded broker')
+    parser.add_argument('--compare-args', default=None, type=str, help='rerun with these mdbroker arguments and compare')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    baseline = run_suite(args, args.broker_args)
+    if args.compare_args is None:
+        return
+
+    print()
+    compared = run_suite(args, args.compare_args)
+    print(f"\nthroughput of '{args.compare_args}' relative to '{args.broker_args}'")
+    for base, other in zip(baseline, compared):
+        ratio = other['msgs_per_sec'] / base['msgs_per_sec'] if base['msgs_per_sec'] else 0.0
+        print(f"{base['mode']:>7} {base['payload']:>9} {100*ratio:>10.1f}%")
+
+
+if __name__ == '__main__':
+    main()
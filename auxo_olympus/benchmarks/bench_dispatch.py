@@ -0,0 +1,101 @@
+"""
+Dispatch latency of the broker as the number of registered workers grows.
+
+The broker is driven in-process (no client or worker sockets): `registered` workers sit idle on a service nobody asks
+for, while a single worker serves the benchmarked service. Every sample is one client request dispatched to that worker
+plus the worker's reply, so the numbers are dominated by the per-message bookkeeping that scales with the fleet.
+Also reported is the memory the broker holds per registered worker (tracemalloc, measured while registering), and the
+cost of a worker heartbeat, the message a large idle fleet sends the most of.
+
+    python3 -m auxo_olympus.benchmarks.bench_dispatch --workers 10 1000 50000
+
+--fast makes the benchmarked service a fast service (MajorDomoBroker fast_services).
+"""
+import time
+import argparse
+import statistics
+import tracemalloc
+
+from auxo_olympus.lib.utils import MDP
+from auxo_olympus.lib.utils.envelope import RoutingHeader
+from auxo_olympus.lib.entities.mdbroker import MajorDomoBroker
+
+SERVICE = b"bench"
+IDLE_SERVICE = b"idle"
+CLIENT = b"\x00client"
+
+
+def idle_worker(i: int) -> bytes:
+    return f"I{i:06d}.idle".encode("utf8")
+
+
+def setup_broker(registered: int, fast: bool = False):
+    """ Broker with `registered` idle workers and one for the benchmarked service, and bytes held per idle worker """
+    broker = MajorDomoBroker(fast_services=[SERVICE] if fast else None)
+    broker.bind(f"inproc://bench-dispatch-{registered}")
+    # Built up front so only the broker's own allocations are counted
+    addresses = [idle_worker(i) for i in range(registered)]
+    messages = [[MDP.W_READY, IDLE_SERVICE] for _ in range(registered)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for address, msg in zip(addresses, messages):
+        broker.process_worker(address, msg)
+    per_worker = (tracemalloc.get_traced_memory()[0] - before) / max(1, registered)
+    tracemalloc.stop()
+
+    broker.process_worker(b"B000001.bench", [MDP.W_READY, SERVICE])
+    return broker, per_worker
+
+
+def bench(registered: int, requests: int, fast: bool = False) -> dict:
+    broker, per_worker = setup_broker(registered, fast)
+    worker = broker.workers[b"B000001.bench"]
+    body = b'{"payload": "x"}'
+    header = RoutingHeader().pack()
+    samples = []
+    heartbeats = []
+    try:
+        for i in range(requests):
+            start = time.perf_counter()
+            broker.process_client(CLIENT, [b"C01", SERVICE, header, body])
+            # The worker echoes the return address it was sent, the client's own on the fast path
+            return_address = next(iter(worker.inflight), CLIENT)
+            broker.process_worker(b"B000001.bench", [MDP.W_REPLY, return_address, b"", body])
+            samples.append(time.perf_counter() - start)
+
+            address = idle_worker(i % registered) if registered else b"B000001.bench"
+            start = time.perf_counter()
+            broker.process_worker(address, [MDP.W_HEARTBEAT, b"tcp://127.0.0.1:5000"])
+            heartbeats.append(time.perf_counter() - start)
+    finally:
+        broker.cleanup()
+
+    samples.sort()
+    return {
+        'workers': registered,
+        'mean_us': 1e6*statistics.mean(samples),
+        'p50_us': 1e6*samples[len(samples)//2],
+        'p99_us': 1e6*samples[int(len(samples)*0.99)],
+        'heartbeat_us': 1e6*statistics.mean(heartbeats),
+        'bytes_per_worker': per_worker,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', nargs='+', type=int, default=[10, 1000, 50000], help='registered worker counts')
+    parser.add_argument('--requests', default=2000, type=int, help='requests per worker count')
+    parser.add_argument('--fast', default=False, action='store_true', help='benchmark the fast path')
+    args = parser.parse_args()
+
+    print(f"{'workers':>10} {'mean (us)':>12} {'p50 (us)':>12} {'p99 (us)':>12} {'heartbeat (us)':>15} "
+          f"{'bytes/worker':>13}")
+    for registered in args.workers:
+        result = bench(registered, args.requests, args.fast)
+        print(f"{result['workers']:>10} {result['mean_us']:>12.1f} {result['p50_us']:>12.1f} {result['p99_us']:>12.1f} "
+              f"{result['heartbeat_us']:>15.1f} {result['bytes_per_worker']:>13.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,11 @@
 import time
 import json
-import random
+import heapq
+import struct
 import logging
 import argparse
-from collections import deque, defaultdict
-from binascii import hexlify, unhexlify
+import itertools
+from collections import OrderedDict
 
 import asyncio
 import zmq.asyncio
@@ -12,7 +13,18 @@ import zmq
 
 # Local
 from auxo_olympus.lib.utils import MDP
-from auxo_olympus.lib.utils.zhelpers import dump, ensure_is_bytes, strip_of_bytes, ZMQMonitor, EVENT_MAP
+from auxo_olympus.lib.utils import bstar
+from auxo_olympus.lib.utils import federation
+from auxo_olympus.lib.utils import snapshot
+from auxo_olympus.lib.utils.envelope import RoutingHeader
+from auxo_olympus.lib.utils.journal import Journal
+from auxo_olympus.lib.utils.membership import Membership
+from auxo_olympus.lib.utils.metrics import BatchMetrics, LatencyStats, LatencyHistogram
+from auxo_olympus.lib.utils.leader_election import LeaderStrategy, STRATEGIES, get_strategy
+from auxo_olympus.lib.utils.request_queue import RequestQueue, REJECT, OVERFLOW_POLICIES, check_weights
+from auxo_olympus.lib.utils.request_table import RequestTable
+from auxo_olympus.lib.utils.result_cache import ResultCache
+from auxo_olympus.lib.utils.zhelpers import dump, ensure_is_bytes, send_frames, ZMQMonitor, EVENT_MAP
 
 # NOTE: Make sure the broker is as stateless and lean as possible. The compute and much of the processing should be at
 #       at the edge, the broker is simply a proxy device that is just 'there'
@@ -29,41 +41,177 @@ from auxo_olympus.lib.utils.zhelpers import dump, ensure_is_bytes, strip_of_byte
 # TODO: Think of security
 # TODO: Provide signal termination and make all the main agents threads
 
+DEADLINE = struct.Struct(">d")     # absolute deadline of a replicated or journaled request
+DISPATCH = struct.Struct(">Q")     # dispatch id appended to the client address a worker is sent, and echoes back
+
+
+class WorkerQueue(object):
+    """
+    Insertion ordered queue of idle workers, keyed by worker identity -- O(1) append, popleft (oldest first) and
+    remove, unlike a list or deque which has to be scanned to remove a worker that disconnects while idle
+    """
+
+    def __init__(self):
+        self.workers = OrderedDict()
+
+    def __len__(self):
+        return len(self.workers)
+
+    def __iter__(self):
+        return iter(list(self.workers.values()))
+
+    def __contains__(self, worker):
+        return worker.identity in self.workers
+
+    def append(self, worker):
+        """ Queue the worker as the newest idle worker """
+        self.workers[worker.identity] = worker
+        self.workers.move_to_end(worker.identity)
+
+    def popleft(self):
+        """ Remove and return the longest-idle worker """
+        _, worker = self.workers.popitem(last=False)
+        return worker
+
+    def remove(self, worker):
+        """ Remove the worker if it is queued """
+        self.workers.pop(worker.identity, None)
+
+
+class Request(object):
+    """ A client request queued at the broker """
+    sender = None       # client return address
+    client_name = None
+    header = None       # RoutingHeader, parsed once on arrival
+    msg = None          # frames as forwarded to the worker: client address, empty, body
+    deadline = None     # time after which the client has given up on the request
+    priority = 0        # higher is served first when fair queuing
+    assemble_by = None  # while held for its min workers, the time after which it is failed
+    rid = None          # broker-assigned id, names the request in binary star deltas and the journal
+    done = False        # has left the queue: dispatched, dropped or expired
+    key = None          # (service, client request id) in the broker's request table, None if untracked
+    cache_key = None    # where its reply goes in the service's result cache, None if it isn't cached
+
+    def __init__(self, sender, client_name, header, msg):
+        self.sender = sender
+        self.client_name: bytes = client_name
+        self.header: RoutingHeader = header
+        self.msg: list = msg
+        self.priority: int = header.priority
+        self.deadline = time.time() + 1e-3*header.deadline if header.deadline else None
+
 
 class Service(object):
     """ A single Service """
-    name = None
-    requests = None     # Queue of client requests
-    waiting = None      # Queue of waiting workers
+    __slots__ = ('name', 'requests', 'waiting', 'membership', 'assembling', 'workers', 'dispatched', 'replies',
+                 'latency', 'cache')
 
-    def __init__(self, name):
+    def __init__(self, name, requests=None, cache=None):
         self.name = name
-        self.requests = deque()
-        self.waiting = deque()
+        self.requests: RequestQueue = requests if requests is not None else RequestQueue()    # client requests
+        self.waiting = WorkerQueue()        # idle workers
+        self.membership = Membership()      # its workers' peer port endpoints, versioned
+        self.assembling = None              # request held until its min workers are idle, it blocks the queue behind
+        self.workers: int = 0               # registered workers, idle or busy
+        self.dispatched: int = 0            # requests sent to workers
+        self.replies: int = 0               # worker replies passed back to clients
+        self.latency = LatencyHistogram()   # request-to-reply times
+        self.cache = cache                  # ResultCache of its replies, None unless caching is enabled for it
 
 
 class Worker(object):
-    """ A Worker, idle or active """
-    identity = None     # hex Identity of the worker
-    address = None      # address to route to
-    service = None      # owning service if known
-    expiry = None       # expires at this point, unless a heartbeat comes through
-
-    def __init__(self, identity, address, lifetime, endpoint, agent_name):
-        self.identity: bytes = identity
-        self.worker_name = unhexlify(self.identity)     # format A01.service
-        self.agent_name: bytes = agent_name        # the name of the agent that owns it
-        self.address = address
-        self.expiry = time.time() + 1e-3*lifetime
+    """ A Worker, idle or active. Slotted, a broker can have a great many of them """
+    __slots__ = ('identity', 'address', 'worker_name', 'agent_name', 'service_name', 'service', 'expiry', 'endpoint',
+                 'slots', 'credit', 'latency', 'load', 'last_seen', 'inflight', 'epoch')
+
+    def __init__(self, address, lifetime, endpoint):
+        # The routing id is the worker's identity, its name and the key of the broker's worker table, no copies
+        self.identity: bytes = address
+        self.address: bytes = address
+        self.worker_name: bytes = address                   # format A01.service
+        agent_name, _, service_name = address.partition(b".")
+        self.agent_name: bytes = agent_name                 # the name of the agent that owns it
+        self.service_name: bytes = service_name             # the service its name says it's for
+        self.service = None                                 # owning Service once registered
+        self.expiry = time.time() + 1e-3*lifetime           # expires at this point, unless a heartbeat comes through
         self.endpoint = endpoint
+        self.slots: int = 1         # requests the worker can have in flight, advertised in W_READY
+        self.credit: int = 0        # free slots, the worker is idle while it has any
+        self.latency = LatencyStats()       # request-to-reply times
+        self.load = None            # load reported in its last heartbeat
+        self.last_seen = time.time()        # when it last sent the broker anything
+        self.inflight = {}          # return address it was sent -> (client address, dispatch time, request table key,
+                                    # cache key), one per request, replies can come back in any order
+        self.epoch = None           # membership epoch sent to it, None unless its heartbeats subscribe it
+
+
+class ExpiryIndex(object):
+    """
+    Lazy-deletion min-heap of idle worker expiry times. Removing a worker or refreshing its expiry only updates
+    `entries`, superseded heap items are discarded when they reach the top -- purging costs O(log n) per expired worker
+    rather than a sort of every idle worker
+    """
+
+    def __init__(self):
+        self.heap = []          # (expiry, tiebreak, worker)
+        self.entries = {}       # identity -> expiry of the live heap item
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, worker):
+        return worker.identity in self.entries
+
+    def push(self, worker):
+        """ Index (or re-index) the worker at its current expiry """
+        self.entries[worker.identity] = worker.expiry
+        heapq.heappush(self.heap, (worker.expiry, next(self.counter), worker))
+
+        if len(self.heap) > 2*len(self.entries) + 64:
+            self.compact()
+
+    def remove(self, worker):
+        self.entries.pop(worker.identity, None)
+
+    def peek(self):
+        """ Earliest live expiry, None if empty """
+        heap = self.heap
+        while heap:
+            expiry, _, worker = heap[0]
+            if self.entries.get(worker.identity) == expiry:
+                return expiry
+            heapq.heappop(heap)
+        return None
+
+    def pop_expired(self, now):
+        """ Remove and return every indexed worker whose expiry is before now """
+        expired = []
+        while True:
+            expiry = self.peek()
+            if expiry is None or expiry >= now:
+                break
+            _, _, worker = heapq.heappop(self.heap)
+            del self.entries[worker.identity]
+            expired.append(worker)
+        return expired
+
+    def compact(self):
+        """ Drop the superseded items so heartbeats don't grow the heap without bound """
+        self.heap = [item for item in self.heap if self.entries.get(item[2].identity) == item[0]]
+        heapq.heapify(self.heap)
 
 
 class MajorDomoBroker():
     """ Majordomo protocol broker"""
     INTERNAL_SERVICE_PREFIX = b"mmi."
+    STATUS_QUEUE_FULL = b"503"
+    STATUS_ASSEMBLY_TIMEOUT = b"504"
+    STATUS_DEADLINE_EXCEEDED = b"504"
     HEARTBEAT_LIVENESS = 4
     HEARTBEAT_INTERVAL = 2500       # msecs
     HEARTBEAT_EXPIRY = HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+    PROVISIONAL_EXPIRY = 2 * HEARTBEAT_INTERVAL     # workers restored from a snapshot are dropped if silent this long
 
     ctx = None  # context
     socket = None   # Sockets for clients and workers
@@ -71,68 +219,299 @@ class MajorDomoBroker():
 
     heartbeat_at = None     # when to send heartbeat
     services = None     # known services
-    workers = None      # known workers
+    workers = None      # known workers, by routing id
     waiting = None      # idle workers
+    expiries = None     # expiry index over the idle workers
 
     verbose = False
 
-    def __init__(self, verbose=False):
-        """ Initialize the broker state """
+    def __init__(self, verbose=False, use_asyncio=False, batch_budget=1, queue_limit=None, overflow_policy=REJECT,
+                 queue_limits=None, spill_dir=None, edf=False, fair_queuing=False, client_weights=None,
+                 leader_strategy='random', bstar_role=None, bstar_local=None, bstar_remote=None, journal_path=None,
+                 journal_sync=25, request_table_size=10000, request_table_ttl=60.0, result_caches=None,
+                 socket_type=zmq.ROUTER, ctx=None, federation_local=None, federation_peers=None, snapshot_path=None,
+                 snapshot_interval=5000, fast_services=None):
+        """
+        Initialize the broker state
+        :param batch_budget: most messages to drain from the socket per wakeup before heartbeating and purging
+        :param queue_limit: most requests queued per service, None for unbounded
+        :param overflow_policy: what to do with requests past the limit, one of request_queue.OVERFLOW_POLICIES
+        :param queue_limits: per-service overrides, {service name: (limit, policy)}
+        :param spill_dir: where the spill policy writes its files, defaults to the temp directory
+        :param edf: serve requests that have a deadline earliest-deadline-first within each service
+        :param fair_queuing: serve each service's requests by priority, then round robin across clients
+        :param client_weights: fair queuing weights, {client name: requests per round}, 1 if not given
+        :param leader_strategy: how group leaders are elected, a LeaderStrategy or one of leader_election.STRATEGIES
+        :param bstar_role: 'primary' or 'backup' to run as one of a binary star pair (see utils/bstar.py), None alone
+        :param bstar_local: endpoint to publish our state on, in a binary star pair
+        :param bstar_remote: the peer's state endpoint, in a binary star pair
+        :param journal_path: write-ahead journal of the queued requests (see utils/journal.py), None for none
+        :param journal_sync: most msecs between syncs of the journal to disk
+        :param request_table_size: most client request ids tracked to coalesce retries (see utils/request_table.py),
+                                   0 to not track them
+        :param request_table_ttl: secs a request id is tracked after its last activity
+        :param result_caches: services whose replies are cached (see utils/result_cache.py), {service name: (size, ttl)}
+        :param socket_type: zmq.DEALER for a shard behind a ShardedBroker, which passes on the clients' and workers'
+                            frames, addresses included, as its ROUTER received them (see mdshard.py)
+        :param ctx: zmq context to share with other brokers in the process, so they can talk over inproc
+        :param federation_local: endpoint to bind for peer brokers (see utils/federation.py), None to not federate
+        :param federation_peers: endpoints of the peer brokers to forward requests for services we don't host to
+        :param snapshot_path: file the registry is snapshotted to and restored from on startup (see
+                              utils/snapshot.py), None for no snapshots
+        :param snapshot_interval: msecs between snapshots
+        :param fast_services: names of stateless services whose single-worker requests take the fast path when one
+                              of their workers is idle, see fast_request
+        """
         self.verbose = verbose
+        self.use_asyncio = use_asyncio
+        self.batch_budget: int = max(1, batch_budget)
+        self.batch_metrics = BatchMetrics()
+        self.queue_limit = queue_limit
+        self.overflow_policy: str = overflow_policy
+        self.queue_limits: dict = queue_limits or {}
+        self.spill_dir = spill_dir
+        self.edf: bool = edf
+        self.fair_queuing: bool = fair_queuing
+        check_weights(client_weights)
+        self.client_weights: dict = client_weights or {}
+        self.result_caches: dict = result_caches or {}
+        self.fast_services = set(fast_services or ())
+        if self.fast_services & set(self.result_caches):
+            raise ValueError("A fast service's requests bypass the result cache, it can't have one")
+        if self.fast_services and bstar_role is not None:
+            raise ValueError("Fast services skip binary star replication, they can't run in a binary star pair")
+        self.fast_requests: int = 0     # requests that took the fast path
+        self.leader_strategy: LeaderStrategy = get_strategy(leader_strategy)
         self.services = {}
         self.workers = {}
-        self.waiting = []
+        self.waiting = WorkerQueue()
+        self.expiries = ExpiryIndex()
         self.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
-        self.ctx = zmq.Context()
-        self.socket = self.ctx.socket(zmq.ROUTER)
+        self.started = time.time()
+        self.request_table = RequestTable(request_table_size, request_table_ttl) if request_table_size else None
+        self.owns_ctx: bool = ctx is None
+        if ctx is None:
+            ctx = zmq.asyncio.Context() if use_asyncio else zmq.Context()
+        self.ctx = ctx
+        self.running: bool = True
+        self.socket = self.ctx.socket(socket_type)
         self.socket.linger = 0
         self.poller = zmq.Poller()
-        self.poller.register(self.socket, zmq.POLLIN)
+        if not use_asyncio:
+            self.poller.register(self.socket, zmq.POLLIN)
+
+        # Binary star: the state exchange with our peer, and the workers adopted from it on failover
+        self.bstar = None
+        self.adopted = {}       # worker address -> (service, slots)
+        self.request_ids = itertools.count(1)
+        self.dispatch_ids = itertools.count(1)
+        # By rid, not flags on the request: a spilled request comes back from disk as a copy
+        self.recorded = set()           # replicated/journaled as queued, so their removal has to be as well
+        self.journaled = set()          # have an ACCEPTED record in the journal
+        if bstar_role is not None:
+            if use_asyncio:
+                raise ValueError("A binary star broker runs the poll loop, not asyncio")
+            self.bstar = bstar.BinaryStar(self.ctx, bstar_role == 'primary', bstar_local, bstar_remote)
+            self.poller.register(self.bstar.subscriber, zmq.POLLIN)
+
+        # Federation: the peer brokers we forward to and that forward to us
+        self.federation = None
+        if federation_local is not None:
+            if use_asyncio:
+                raise ValueError("A federated broker runs the poll loop, not asyncio")
+            self.federation = federation.Federation(self.ctx, federation_local, federation_peers or [])
+            self.poller.register(self.federation.router, zmq.POLLIN)
+            for peer in self.federation.peers:
+                self.poller.register(peer.socket, zmq.POLLIN)
 
         self._debug = False
         if self._debug:
             self.monitor: ZMQMonitor = ZMQMonitor(self.socket)
 
-        # Arranged by service, then ip
-        self.worker_endpoints = defaultdict(dict)      # stores all the physical ip of the workers as seen from broker
-
+        # asyncio mode: the event loop, and the services whose queues the dispatch coroutine still has to service
         self.loop = None
+        self.pending_dispatch = None
+        self.dispatch_event = None
 
         logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
 
+        # Requests queued before a crash or restart are replayed from the journal
+        self.journal = None
+        self.journal_pending = []       # (service, request) queued since the last journal sync
+        self.journal_due = None
+        if journal_path is not None:
+            self.journal = Journal(journal_path, journal_sync)
+            self.requeue_journal()
+
+        # Warm restart: the workers of the last snapshot are taken as alive until they miss their first heartbeat
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval: float = snapshot_interval
+        self.snapshot_at = None
+        self.provisional = set()        # addresses of restored workers not heard from yet, they get no requests
+        if snapshot_path is not None:
+            if bstar_role is not None:
+                raise ValueError("A binary star broker recovers from its peer, not from a snapshot")
+            self.restore_snapshot()
+            self.snapshot_at = time.time() + 1e-3*snapshot_interval
+
     def run(self):
         """ Main broker work happens here -- mediates between the client and the worker socket """
+        if self.use_asyncio:
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.run_async())
+            return
 
         # Start the socket monitor
         if self._debug:
             event_filter: str = 'ALL' if self.verbose else EVENT_MAP[zmq.EVENT_ACCEPTED]
             self.monitor.run(event=event_filter)
 
-        while True:
-            items = self.poller.poll(self.HEARTBEAT_INTERVAL)
+        while self.running:
+            # Wake up in time for the next worker heartbeat, workers with a backup broker fail over if it's late
+            timeout = min(self.HEARTBEAT_INTERVAL, max(0, 1e3*(self.heartbeat_at - time.time())))
+            if self.bstar is not None:
+                timeout = min(timeout, max(0, 1e3*(self.bstar.next_send() - time.time())))
+            if self.journal is not None and self.next_journal_sync() is not None:
+                timeout = min(timeout, max(0, 1e3*(self.next_journal_sync() - time.time())))
+            if self.federation is not None:
+                timeout = min(timeout, max(0, 1e3*(self.federation.next_send() - time.time())))
+            if self.snapshot_at is not None:
+                timeout = min(timeout, max(0, 1e3*(self.snapshot_at - time.time())))
+            items = dict(self.poller.poll(timeout))
+
+            if self.socket in items:
+                self.recv_batch()
+            if self.bstar is not None:
+                if self.bstar.subscriber in items:
+                    self.recv_state()
+                self.bstar.send_state(time.time())
+            if self.journal is not None:
+                self.sync_journal(time.time())
+            if self.federation is not None:
+                self.recv_federation(items)
+            if self.snapshot_at is not None and time.time() >= self.snapshot_at:
+                self.save_snapshot()
 
-            if items:
-                msg = self.socket.recv_multipart()
-                if self.verbose:
-                    logging.info("I: received message:")
-                    dump(msg)
+            self.purge_workers()
+            self.purge_requests()
+            self.send_heartbeats()
 
-                sender = msg.pop(0)
-                empty = msg.pop(0)
-                assert empty == b""
-                header = msg.pop(0)
+    def stop(self):
+        """ Have the poll loop return, by the next heartbeat at the latest """
+        self.running = False
 
-                if MDP.C_CLIENT == header:
-                    self.process_client(sender, msg)
-                elif MDP.W_WORKER == header:
-                    self.process_worker(sender, msg)
-                else:
-                    logging.error("E: invalid message:")
-                    dump(msg)
+    async def run_async(self):
+        """
+        asyncio version of run -- receiving, dispatching, heartbeating and purging each run as their own coroutine
+        on a zmq.asyncio socket, so timers fire when they are due instead of whenever the poll happens to wake up
+        """
+        assert self.use_asyncio, "Broker must be created with use_asyncio=True"
+        self.pending_dispatch = set()
+        self.dispatch_event = asyncio.Event()
+
+        loops = [self.recv_loop(), self.dispatch_loop(), self.heartbeat_loop(), self.purge_loop()]
+        if self.journal is not None:
+            loops.append(self.journal_loop())
+        if self.snapshot_path is not None:
+            loops.append(self.snapshot_loop())
+        await asyncio.gather(*loops)
+
+    async def recv_loop(self):
+        """ Receive and process messages from clients and workers """
+        while True:
+            msg = await self.socket.recv_multipart()
+            self.handle_message(msg)
+
+            # Drain whatever else is already queued before yielding to the other coroutines
+            count = 1
+            while count < self.batch_budget:
+                try:
+                    msg = await self.socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.handle_message(msg)
+                count += 1
+            self.batch_metrics.record(count)
+
+    def recv_batch(self):
+        """ Process the messages already queued on the socket, up to batch_budget, returns how many were processed """
+        count = 0
+        while count < self.batch_budget:
+            try:
+                msg = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            self.handle_message(msg)
+            count += 1
+
+        self.batch_metrics.record(count)
+        return count
+
+    async def dispatch_loop(self):
+        """ Hand queued requests to idle workers for every service flagged by dispatch() """
+        while True:
+            await self.dispatch_event.wait()
+            self.dispatch_event.clear()
 
             self.purge_workers()
+            while self.pending_dispatch:
+                service = self.services.get(self.pending_dispatch.pop())
+                if service is not None:
+                    self.dispatch_requests(service)
+
+    async def heartbeat_loop(self):
+        """ Send heartbeats to idle workers every HEARTBEAT_INTERVAL """
+        while True:
+            await asyncio.sleep(max(0.0, self.heartbeat_at - time.time()))
             self.send_heartbeats()
 
+    async def purge_loop(self):
+        """ Sleep until the next idle worker is due to expire, then purge """
+        while True:
+            next_expiry = self.next_expiry()
+            if next_expiry is None:
+                delay = 1e-3*self.HEARTBEAT_INTERVAL
+            else:
+                delay = min(max(0.0, next_expiry - time.time()), 1e-3*self.HEARTBEAT_INTERVAL)
+            await asyncio.sleep(delay)
+            self.purge_workers()
+            self.purge_requests()
+
+    async def journal_loop(self):
+        """ Sync the journal every sync interval, one sync commits every request queued since the last """
+        while True:
+            await asyncio.sleep(1e-3*self.journal.sync_interval)
+            self.sync_journal()
+
+    async def snapshot_loop(self):
+        """ Snapshot the registry every snapshot interval """
+        while True:
+            await asyncio.sleep(1e-3*self.snapshot_interval)
+            self.save_snapshot()
+
+    def handle_message(self, msg):
+        """ Process a single multipart message received on the broker socket """
+        if self.verbose:
+            logging.info("I: received message:")
+            dump(msg)
+
+        if self.bstar is not None and not self.bstar_accepts():
+            return
+
+        sender = msg.pop(0)
+        empty = msg.pop(0)
+        assert empty == b""
+        header = msg.pop(0)
+
+        if MDP.C_CLIENT == header:
+            self.process_client(sender, msg)
+        elif MDP.W_WORKER == header:
+            self.process_worker(sender, msg)
+        else:
+            logging.error("E: invalid message:")
+            dump(msg)
+
     def destroy(self):
         """ Disconnect all workers, destroy context """
         while self.workers:
@@ -142,24 +521,83 @@ class MajorDomoBroker():
     def process_client(self, sender, msg):
         """ Process a request coming from a client """
         assert len(msg) >= 2        # Service_name + body
+        received = time.time()
+        if self.fast_services and msg[1] in self.fast_services and self.fast_request(sender, msg):
+            return
         sender_name = msg.pop(0)
         service = msg.pop(0)
 
+        # Routing flags come from the header frame, older clients only have them in the body
+        header = RoutingHeader.unpack(msg[0]) if len(msg) > 1 else None
+        if header is not None:
+            msg.pop(0)
+        elif RoutingHeader.is_header(msg[0]) and len(msg) > 1:
+            logging.warning("W: unsupported routing header, reading flags from the body")
+            msg.pop(0)
+
         # Set reply return address to client sender
-        msg = [sender, ""] + msg
+        msg = [sender, b""] + msg
         if service.startswith(self.INTERNAL_SERVICE_PREFIX):
             self.service_internal(service, msg)
         else:
-            self.dispatch(self.require_service(service), msg)
+            if header is None:
+                header = RoutingHeader.from_body(msg[2])
+            queued = self.require_service(service)
+            if self.federation is not None and not queued.workers and not self.federation.is_forwarded(sender):
+                peer = self.federation.pick_peer(service)
+                if peer is not None:
+                    # Not hosted here, but a peer has workers for it
+                    if not self.federation.forward(peer, sender, service, sender_name, header, msg[2:], received):
+                        self.send_to_client(sender, [service, self.STATUS_DEADLINE_EXCEEDED])
+                    return
+            cache_key = None
+            if queued.cache is not None and not header.multiple:
+                digest = ResultCache.digest(service, msg[2:])
+                reply = queued.cache.get(digest)
+                if reply is not None:
+                    # Answered without waking a worker
+                    self.send_to_client(sender, [service] + reply)
+                    return
+                cache_key = queued.cache.key(digest)
+            if self.request_table is not None and header.request_id:
+                # A retry of a request we already have is answered from, or waits on, the original
+                if self.resend_request((service, header.request_id), sender):
+                    return
+            request = Request(sender, sender_name, header, msg)
+            request.rid = next(self.request_ids)
+            request.cache_key = cache_key
+            self.track_request(service, request)
+            self.dispatch(queued, request)
 
     def process_worker(self, sender, msg):
         """ Process message sent to us by a worker """
         assert len(msg) >= 1        # at least, command
+        if self.fast_services and msg[0] == MDP.W_REPLY and self.fast_reply(sender, msg):
+            return
         # worker_name = msg.pop(0)      # FIXME: Remove
         command = msg.pop(0)
 
-        worker_ready = hexlify(sender) in self.workers
+        worker_ready = sender in self.workers
         worker = self.require_worker(sender)
+        worker.last_seen = time.time()
+
+        adopted = self.adopted.pop(sender, None)
+        if adopted is not None and not worker_ready and command != MDP.W_READY:
+            # Registered with our binary star peer before we took over, carry on as if it had registered with us
+            self.register_worker(worker, *adopted)
+            worker_ready = True
+
+        if sender in self.provisional:
+            if command == MDP.W_READY:
+                # It has restarted too, let it register afresh rather than disconnect it
+                self.delete_worker(worker, False)
+                worker = self.require_worker(sender)
+                worker_ready = False
+            elif command in (MDP.W_HEARTBEAT, MDP.W_REPLY):
+                # Restored from a snapshot and alive after all, it can have requests now
+                self.provisional.discard(sender)
+                self.worker_waiting(worker)
+            # A W_DISCONNECT just deletes it below, it mustn't be handed a queued request on its way out
 
         if command == MDP.W_READY:
             assert len(msg) >= 1
@@ -167,20 +605,25 @@ class MajorDomoBroker():
             if worker_ready or service.startswith(self.INTERNAL_SERVICE_PREFIX):
                 self.delete_worker(worker, True)
             else:
-                # Attach worker to service and mark as idle
-                worker.service = self.require_service(service)
-                self.worker_waiting(worker)
+                self.register_worker(worker, service, max(1, int(msg.pop(0))) if msg else 1)
 
         elif command == MDP.W_REPLY:
             if worker_ready:
                 # Remove and save client return envelope and insert the protocol header and service name, then rewrap
-                client = msg.pop(0)
+                client, key, cache_key = self.record_latency(worker, msg.pop(0))
                 _ = msg.pop(0)
 
-                msg = [client, b"", MDP.C_CLIENT, worker.service.name] + msg
-                msg = ensure_is_bytes(msg)
-
-                self.socket.send_multipart(msg)
+                body = ensure_is_bytes(msg)
+                self.send_to_client(client, [worker.service.name] + body)
+                if cache_key is not None and worker.service.cache is not None:
+                    worker.service.cache.put(cache_key, body)
+                if key is not None and self.request_table is not None:
+                    # Resends of the request that coalesced onto it are owed the reply too
+                    for waiter in self.request_table.reply(key, body):
+                        self.send_to_client(waiter, [worker.service.name] + body)
+
+                # The reply returns the request's credit
+                worker.credit = min(worker.credit + 1, worker.slots)
                 self.worker_waiting(worker)
             else:
                 self.delete_worker(worker, True)
@@ -188,9 +631,22 @@ class MajorDomoBroker():
         elif command == MDP.W_HEARTBEAT:
             if worker_ready:
                 worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
-                endpoint = msg.pop(0)
-                worker.endpoint = endpoint
-                self.worker_endpoints[worker.service.name][worker.worker_name] = endpoint
+                if worker in self.expiries:
+                    self.expiries.push(worker)
+                self.set_worker_endpoint(worker, msg.pop(0))
+                if msg:
+                    try:
+                        worker.load = float(msg.pop(0))
+                    except ValueError:
+                        pass
+                if msg:
+                    # The membership epoch it holds, which subscribes it to its service's membership updates
+                    try:
+                        epoch = int(msg.pop(0))
+                    except ValueError:
+                        pass
+                    else:
+                        worker.epoch = epoch if worker.epoch is None else min(worker.epoch, epoch)
             else:
                 self.delete_worker(worker, True)
 
@@ -201,6 +657,83 @@ class MajorDomoBroker():
             logging.error("E: invalid message:")
             dump(msg)
 
+    def fast_request(self, sender, msg) -> bool:
+        """
+        Fast path for a stateless service: a single-worker request goes straight out to an idle worker, envelope
+        rewritten around the client's frames, without a Request, its request id, queueing or journaling. Returns False
+        when the request needs the full path: no idle worker, requests queued ahead of it, a group request, or an older
+        client's request without a routing header. Retries of a stateless request are simply run again
+        """
+        service = self.services.get(msg[1])
+        if service is None or not service.waiting or service.requests or service.assembling is not None:
+            return False
+        if len(msg) < 4 or not RoutingHeader.is_single(msg[2]):
+            return False
+
+        worker = service.waiting.popleft()
+        worker.credit -= 1
+        if worker.credit > 0:
+            service.waiting.append(worker)
+        else:
+            self.waiting.remove(worker)
+            self.expiries.remove(worker)
+        service.dispatched += 1
+        self.fast_requests += 1
+
+        membership_frame = self.membership_update(worker) or str(service.membership.epoch).encode("utf8")
+        self.send([worker.address, b"", MDP.W_WORKER, MDP.W_REQUEST, MDP.W_LEADER, membership_frame, sender, b""]
+                       + msg[3:])
+        return True
+
+    def fast_reply(self, sender, msg) -> bool:
+        """
+        Fast path for a fast service's reply: passed straight back to the client. Returns False when it needs the
+        full path, for a request that took it (tracked in the worker's inflight) or a worker not confirmed alive yet
+        """
+        worker = self.workers.get(sender)
+        if worker is None or worker.service is None or worker.service.name not in self.fast_services:
+            return False
+        if worker.inflight or (self.provisional and sender in self.provisional) or len(msg) < 3:
+            return False
+        client = msg[1]
+        if self.federation is not None and self.federation.is_forwarded(client):
+            return False
+
+        service = worker.service
+        service.replies += 1
+        worker.last_seen = time.time()
+        self.send([client, b"", MDP.C_CLIENT, service.name] + msg[3:])
+        worker.credit = min(worker.credit + 1, worker.slots)
+        if service.requests or service.assembling is not None:
+            self.worker_waiting(worker)
+        else:
+            # Nothing queued for it, it's just idle again
+            self.waiting.append(worker)
+            service.waiting.append(worker)
+            worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
+            self.expiries.push(worker)
+        return True
+
+    def send(self, frames):
+        """ Send a message whose frames are all bytes already, see zhelpers.send_frames """
+        if self.use_asyncio:
+            # An asyncio socket's sends are futures each, the parts must go out as one
+            self.socket.send_multipart(frames)
+        else:
+            send_frames(self.socket, frames)
+
+    def register_worker(self, worker, service, slots):
+        """ Attach worker to service and mark as idle, with as many credits as it has advertised slots """
+        worker.service = self.require_service(service)
+        worker.service.workers += 1
+        if worker.service.cache is not None:
+            worker.service.cache.invalidate()
+        worker.slots = slots
+        worker.credit = slots
+        if self.bstar is not None:
+            self.bstar.publish(bstar.WORKER_READY, worker.address, service, str(slots))
+        self.worker_waiting(worker)
+
     def delete_worker(self, worker, disconnect):
         """ Deletes the worker from all data structures and deletes worker """
         logging.info("Deleting worker")
@@ -208,33 +741,70 @@ class MajorDomoBroker():
         if disconnect:
             self.send_to_worker(worker, MDP.W_DISCONNECT, None, None)
 
+        self.expiries.remove(worker)
+        self.waiting.remove(worker)
+        self.provisional.discard(worker.identity)
         if worker.service is not None:
-            try:
-                worker.service.waiting.remove(worker)
-            except (ValueError, KeyError):
-                # pass error silently FIXME: Potential error because we kill the worker before it can be remove?
-                pass
+            worker.service.waiting.remove(worker)
 
         self.workers.pop(worker.identity)
-        try:
-            self.worker_endpoints[worker.service.name].pop(worker.worker_name)
-        except (KeyError, AttributeError):
-            # worker probably has already been killed # FIXME: Confirm this
-            pass
+        if self.request_table is not None:
+            # Its requests in flight will never be answered, let their retries through
+            for _, _, key, _ in worker.inflight.values():
+                if key is not None:
+                    self.request_table.forget(key)
+        if worker.service is not None:
+            worker.service.workers -= 1
+            if worker.service.cache is not None:
+                worker.service.cache.invalidate()
+            if self.bstar is not None:
+                self.bstar.publish(bstar.WORKER_DELETED, worker.address)
+        if worker.service is not None:
+            worker.service.membership.leave(worker.worker_name)
+
+    @staticmethod
+    def record_latency(worker, return_address):
+        """
+        Time from dispatching the request the worker replied to, by the return address it was sent, to the reply, per
+        worker and per service. Returns the client address and the request's request table and result cache keys,
+        None where it has none. A return address we don't know (a fast path request's) is the client's own
+        """
+        worker.service.replies += 1
+        started = worker.inflight.pop(return_address, None)
+        if started is None:
+            return return_address, None, None
+        client, dispatched_at, key, cache_key = started
+        latency = time.time() - dispatched_at
+        worker.latency.record(latency)
+        worker.service.latency.record(latency)
+        return client, key, cache_key
+
+    @staticmethod
+    def set_worker_endpoint(worker, endpoint):
+        """ Record where the worker's peer port is reachable, a new endpoint is a change to the service's membership """
+        worker.endpoint = endpoint
+        worker.service.membership.join(worker.worker_name, endpoint)
+
+    @staticmethod
+    def membership_update(worker):
+        """ The membership update a subscribed worker is behind by, None if it's up to date or not subscribed """
+        membership = worker.service.membership
+        if worker.epoch is None or worker.epoch == membership.epoch:
+            return None
+        frame = membership.update_frame(worker.epoch)
+        worker.epoch = membership.epoch
+        return frame
 
     def require_worker(self, address):
-        """ Finds the worker (creates if necessary) """
+        """ Finds the worker (creates if necessary), by its routing id """
         assert address is not None
-        identity = hexlify(address)
-        worker_agent_name, worker_service = unhexlify(identity).split(b".")  # format of A01
-
-        worker = self.workers.get(identity)
+        worker = self.workers.get(address)
         if worker is None:
-            worker = Worker(identity, address, self.HEARTBEAT_EXPIRY, 'unknown', worker_agent_name)
+            worker = Worker(address, self.HEARTBEAT_EXPIRY, 'unknown')
 
-            self.workers[identity] = worker
+            self.workers[address] = worker
             if self.verbose:
-                logging.info(f"I: registering new worker:{unhexlify(identity)}")
+                logging.info(f"I: registering new worker:{address}")
 
         return worker
 
@@ -243,7 +813,10 @@ class MajorDomoBroker():
         assert name is not None
         service = self.services.get(name)
         if service is None:
-            service = Service(name)
+            limit, policy = self.queue_limits.get(name, (self.queue_limit, self.overflow_policy))
+            cache = ResultCache(*self.result_caches[name]) if name in self.result_caches else None
+            service = Service(name, RequestQueue(limit, policy, self.spill_dir, self.edf, self.fair_queuing,
+                                                 self.client_weights), cache)
             self.services[name] = service
 
         return service
@@ -254,88 +827,313 @@ class MajorDomoBroker():
         logging.info(f"I: MDP  broker/0.1.1 is active at {endpoint}")
 
     def service_internal(self, service, msg):
-        """ Handle internal service according to spec -- service discovery for client side"""
+        """
+        Handle internal service according to spec -- service discovery for client side
+            mmi.service: "200" if the service named in the body exists, "404" otherwise
+            mmi.queue: json with the named service's queue depth, limit and idle workers, "404" if unknown
+            mmi.stats: json with the named service's counters and latency histogram, every service's if the body is
+                       empty, "404" if unknown
+            mmi.workers: json with the named service's workers (every worker if the body is empty), "404" if unknown
+        """
         returncode = "501"
-        if "mmi.service" == service:
+        if b"mmi.service" == service:
             name = msg[-1]
             returncode = "200" if name in self.services else "404"
+        elif b"mmi.queue" == service:
+            queried = self.services.get(msg[-1])
+            returncode = "404"
+            if queried is not None:
+                returncode = json.dumps({
+                    'depth': len(queried.requests),
+                    'limit': queried.requests.limit,
+                    'policy': queried.requests.policy,
+                    'dropped': queried.requests.dropped,
+                    'assembling': queried.assembling is not None,
+                    'waiting': len(queried.waiting),
+                })
+        elif b"mmi.stats" == service:
+            returncode = self.stats_report(msg[-1])
+        elif b"mmi.workers" == service:
+            returncode = self.workers_report(msg[-1])
         msg[-1] = returncode
 
-        # Insert the protocol header and service name after the routing envelope
-        msg = msg[:2] + [MDP.C_CLIENT, service] + msg[2:]
-        msg = msg[:2] + [MDP.C_CLIENT, service] + msg[2:]
-        msg = ensure_is_bytes(msg)
-        self.socket.send_multipart(msg)
+        # Reply with the service name ahead of the body, after the routing envelope
+        self.send_to_client(msg[0], ensure_is_bytes([service] + msg[2:]))
+
+    def send_to_client(self, address, frames):
+        """ Send a reply (service name, body...) to a client, or back to the peer broker that forwarded its request """
+        if self.federation is not None and self.federation.is_forwarded(address):
+            self.federation.reply(address, frames)
+        else:
+            self.send([address, b"", MDP.C_CLIENT] + frames)
+
+    def stats_report(self, name):
+        """ mmi.stats reply for one service, or all of them and the broker's own counters if name is empty """
+        def service_stats(queried):
+            idle = len(queried.waiting)
+            return {
+                'depth': len(queried.requests),
+                'workers': queried.workers,
+                'idle': idle,
+                'busy': queried.workers - idle,
+                'dispatched': queried.dispatched,
+                'replies': queried.replies,
+                'dropped': queried.requests.dropped,
+                'expired': queried.requests.expired,
+                'latency': queried.latency.as_dict(),
+                'cache': queried.cache.as_dict() if queried.cache is not None else None,
+                'membership': queried.membership.as_dict(),
+            }
+
+        if name:
+            queried = self.services.get(name)
+            return "404" if queried is None else json.dumps(service_stats(queried))
+
+        return json.dumps({
+            'broker': {
+                'uptime': time.time() - self.started,
+                'workers': len(self.workers),
+                'idle': len(self.waiting),
+                'batches': self.batch_metrics.as_dict(),
+                'request_ids': self.request_table.as_dict() if self.request_table is not None else None,
+                'federation': self.federation.as_dict() if self.federation is not None else None,
+                'provisional': len(self.provisional),
+                'fast_requests': self.fast_requests,
+            },
+            'services': {queried.name.decode("utf8"): service_stats(queried) for queried in self.services.values()},
+        })
+
+    def workers_report(self, name):
+        """ mmi.workers reply for the workers of one service, or of every service if name is empty """
+        if name and name not in self.services:
+            return "404"
+
+        now = time.time()
+        report = {}
+        for worker in self.workers.values():
+            if worker.service is None or (name and worker.service.name != name):
+                continue
+            report[worker.worker_name.decode("utf8")] = {
+                'service': worker.service.name.decode("utf8"),
+                'idle': worker in self.waiting,
+                'slots': worker.slots,
+                'credit': worker.credit,
+                'heartbeat_age': now - worker.last_seen,
+                'provisional': worker.identity in self.provisional,
+                'load': worker.load,
+                'latency': worker.latency.as_dict(),
+            }
+        return json.dumps(report)
+
+    def send_status(self, request, service_name, status):
+        """ Answer a client request, and any retries waiting on it, with a status code instead of a worker reply """
+        for address in [request.sender] + self.forget_request(request):
+            self.send_to_client(address, [service_name, status])
+
+    def track_request(self, service_name, request):
+        """ Enter a request the client gave an id in the request table, so its retries are recognised """
+        if self.request_table is not None and request.header.request_id:
+            request.key = (service_name, request.header.request_id)
+            self.request_table.begin(request.key, request.sender)
+
+    def resend_request(self, key, sender) -> bool:
+        """ A request with a client id: if it's a retry answer it with the replies so far and return True """
+        replies = self.request_table.resend(key, sender)
+        if replies is None:
+            return False
+        for body in replies:
+            self.send_to_client(sender, [key[0]] + body)
+        return True
+
+    def forget_request(self, request) -> list:
+        """ The request failed, stop tracking its id. Returns the addresses of the retries that were waiting on it """
+        if request.key is None or self.request_table is None:
+            return []
+        return self.request_table.forget(request.key)
 
     def send_heartbeats(self):
-        """ Send heartbeats to idle worker if it's time """
+        """ Send heartbeats to every registered worker if it's time, busy or idle """
         if time.time() > self.heartbeat_at:
             for worker in self.waiting:
+                # Idle workers catch up on their peer group between requests, so a request finds them ready
+                update = self.membership_update(worker)
+                if update is not None:
+                    self.send_to_worker(worker, MDP.W_MEMBERSHIP, None, msg=update)
                 # worker.endpoint is where the worker is connecting from as seen by the broker
                 self.send_to_worker(worker, MDP.W_HEARTBEAT, None, msg=worker.endpoint)
+            for worker in self.workers.values():
+                # A worker with all its slots taken is off the idle list, but a pipelined one is still waiting on us
+                # in recv_request and its liveness would run out
+                if worker.service is not None and not worker.credit:
+                    self.send_to_worker(worker, MDP.W_HEARTBEAT, None, msg=worker.endpoint)
 
             self.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
 
+    def next_expiry(self):
+        """ Time at which the next idle worker expires, None if there are no idle workers """
+        return self.expiries.peek()
+
     def purge_workers(self):
-        if self.waiting:
-            self.waiting = sorted(self.waiting, key=lambda worker: worker.expiry)
-
-        while self.waiting:
-            w = self.waiting[0]
-            if w.expiry < time.time():
-                logging.info(f"I: deleting expired worker: {w.identity}")
-                self.delete_worker(w, False)
-                self.waiting.pop(0)
-            else:
-                break
+        """ Delete the idle workers that have stopped heartbeating """
+        for w in self.expiries.pop_expired(time.time()):
+            logging.info(f"I: deleting expired worker: {w.identity}")
+            self.waiting.remove(w)
+            self.delete_worker(w, False)
+
+    def purge_requests(self, service=None):
+        """
+        Drop queued requests whose deadline has passed, from one service or all of them, and fail held group requests
+        whose workers didn't assemble in time
+        """
+        now = time.time()
+        if service is None and self.request_table is not None:
+            self.request_table.expire(now)
+        for queued in [service] if service is not None else list(self.services.values()):
+            expired = queued.requests.expire(now)
+            if expired:
+                logging.info(f"I: dropping {len(expired)} expired request(s) for {queued.name}")
+                for request in expired:
+                    self.record_removed(request)
+                    self.forget_request(request)
+
+            held = queued.assembling
+            if held is None:
+                continue
+            if held.deadline is not None and held.deadline < now:
+                logging.info(f"I: dropping expired group request for {queued.name}")
+                queued.assembling = None
+                self.record_removed(held)
+                self.forget_request(held)
+            elif held.assemble_by is not None and held.assemble_by < now:
+                logging.info(f"I: {queued.name} group request timed out waiting for {held.header.min_workers} workers")
+                queued.assembling = None
+                self.record_removed(held)
+                self.send_status(held, queued.name, self.STATUS_ASSEMBLY_TIMEOUT)
+
+            if queued.assembling is None and service is None:
+                # the held request was blocking the rest of the queue
+                self.dispatch(queued, None)
 
     def worker_waiting(self, worker):
-        """ This worker is now waiting for work """
+        """ This worker is now waiting for work (has at least one free slot) """
         # Queue to broker and service waiting lists
         self.waiting.append(worker)
         worker.service.waiting.append(worker)
         worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
+        self.expiries.push(worker)
         self.dispatch(worker.service, None)
 
-    def dispatch(self, service, msg):
+    def dispatch(self, service, request):
         """ Dispatch requests to waiting workers as possible """
         assert service is not None
-        if msg is not None:
-            service.requests.append(msg)
-        self.purge_workers()
-
-        while service.waiting and service.requests:
-            request = service.requests.popleft()
-            multiple: bool = json.loads(request[2]).get("multiple_bool", False)    # client may indicate the problem requires coord
+        if request is not None:
+            overflow = service.requests.append(request)
+            if overflow is not None:
+                # Queue is full, let the client know so it can back off
+                logging.warning(f"W: {service.name} queue is full, dropping request")
+                self.record_removed(overflow)
+                self.send_status(overflow, service.name, self.STATUS_QUEUE_FULL)
+            if request is not overflow and service.requests.spilled:
+                # Spilled: what comes back from disk and gets dispatched is a copy, it has to be recorded first
+                self.record_queued(service, request)
+                request = None
+
+        if self.pending_dispatch is not None:
+            # asyncio mode, let the dispatch coroutine pick it up
+            if request is not None and not request.done:
+                self.record_queued(service, request)
+            self.pending_dispatch.add(service.name)
+            self.dispatch_event.set()
+            return
 
-            leader_index: int = self.determine_leader(len(service.waiting))
-            worker_index: int = 0
-            while service.waiting:
-                worker = service.waiting.popleft()
-                self.waiting.remove(worker)
-
-                leader_bool: bool = leader_index == worker_index
-                option = {'leader': leader_bool, 'peer_endpoints': strip_of_bytes(self.worker_endpoints[service.name])}
+        self.purge_workers()
+        self.dispatch_requests(service)
+
+        # Only requests left waiting for a worker need replicating and journaling, most go straight out
+        if request is not None and not request.done:
+            self.record_queued(service, request)
+
+    def dispatch_requests(self, service):
+        """ Pair the service's queued requests with its idle workers """
+        if service.waiting:
+            self.purge_requests(service)
+
+        while service.waiting:
+            request = service.assembling
+            if request is None:
+                if not service.requests:
+                    break
+                request = service.requests.popleft()
+
+            group_size = self.group_size(service, request)
+            if group_size is None:
+                # Hold the request (and the queue behind it) until enough workers are idle to dispatch it at once
+                if service.assembling is None:
+                    service.assembling = request
+                    if request.header.assembly_timeout:
+                        request.assemble_by = time.time() + 1e-3*request.header.assembly_timeout
+                break
+            service.assembling = None
+            service.dispatched += 1
+            self.record_removed(request)
+            if request.key is not None and self.request_table is not None:
+                self.request_table.dispatched(request.key, group_size)
+
+            group = [service.waiting.popleft() for _ in range(group_size)]
+            leader_index: int = self.determine_leader(service, group)
+            epoch_frame: bytes = str(service.membership.epoch).encode("utf8")
+            now = time.time()
+            for worker_index, worker in enumerate(group):
+                leader_frame: bytes = MDP.W_LEADER if leader_index == worker_index else MDP.W_FOLLOWER
 
                 # msg:
-                #   Frame 0: client address
-                #   Frame 1: empty
-                #   Frame 2: client request
+                #   Frame 0: leader flag
+                #   Frame 1: membership epoch, or the update (json) the worker is behind by
+                #   Frame 2: return address, the client address and a dispatch id, echoed back in the reply
+                #   Frame 3: empty
+                #   Frame 4: client request
+
+                membership_frame: bytes = self.membership_update(worker) or epoch_frame
+                return_address: bytes = request.sender + DISPATCH.pack(next(self.dispatch_ids))
+                self.send_to_worker(worker, MDP.W_REQUEST, option=[leader_frame, membership_frame],
+                                    msg=[return_address] + request.msg[1:])
+                worker.inflight[return_address] = (request.sender, now, request.key, request.cache_key)
+
+                # Each request in flight uses up one of the worker's credits, it stays idle while it has any left
+                worker.credit -= 1
+                if worker.credit > 0:
+                    service.waiting.append(worker)
+                else:
+                    self.waiting.remove(worker)
+                    self.expiries.remove(worker)
 
-                self.send_to_worker(worker, MDP.W_REQUEST, option=option, msg=request)
-                worker_index += 1
+    @staticmethod
+    def group_size(service, request):
+        """
+        How many of the service's idle workers the request goes to, None if it needs more than are idle.
+        The client may indicate the problem requires coord, in which case it goes to a group of between min_workers
+        and group_size idle workers, otherwise to one
+        """
+        if not request.header.multiple:
+            return 1
 
-            if not multiple:
-                break
+        idle = len(service.waiting)
+        if idle < max(1, request.header.min_workers):
+            return None
+        if request.header.group_size:
+            return min(idle, request.header.group_size)
+        return idle
 
     def send_to_worker(self, worker, command, option, msg=None):
-        """ Send message to worker. If message is provided, sends that message """
+        """ Send message to worker. If message is provided, sends that message. Option may be a list of frames """
         if msg is None:
             msg = []
         elif not isinstance(msg, list):
             msg = [msg]
 
-        if option is not None:
+        if isinstance(option, list):
+            msg = option + msg
+        elif option is not None:
             msg = [option] + msg
         msg = [worker.address, "", MDP.W_WORKER, command] + msg
         msg = ensure_is_bytes(msg)     # Try to make everything a byte
@@ -344,42 +1142,389 @@ class MajorDomoBroker():
             logging.info(f"I: sending {command} to worker")
             dump(msg)
 
-        self.socket.send_multipart(msg)
+        self.send(msg)
 
-    @staticmethod
-    def determine_leader(num_workers: int) -> int:
+    def determine_leader(self, service, group: list) -> int:
         """
         Leader election happens because of asymmetries -- as in initiating actions such
-        as broadcasts or singular replies. This particular method picks a worker
-        to be a leader at random
+        as broadcasts or singular replies. The broker's leader strategy picks the worker
+        in the group to be the leader, see leader_election.py
         """
-        return random.randint(0, num_workers-1)
+        if len(group) == 1:
+            return 0
+        return self.leader_strategy.elect(service, group)
+
+    def bstar_accepts(self) -> bool:
+        """ Binary star: whether to serve a client or worker message, taking over from the peer if it has gone """
+        was_passive = self.bstar.state == bstar.PASSIVE
+        accepted = self.bstar.client_event(time.time())
+        if accepted and was_passive:
+            self.adopt_shadow()
+        return accepted
+
+    def recv_state(self):
+        """ Binary star: process the state messages and deltas waiting from the peer """
+        while True:
+            try:
+                msg = self.bstar.subscriber.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+            if msg[0] == bstar.HEARTBEAT:
+                was_passive = self.bstar.state == bstar.PASSIVE
+                if self.bstar.peer_event(msg[1], time.time()):
+                    self.send_snapshot()
+                if was_passive and self.bstar.active:
+                    self.adopt_shadow()
+            elif not self.bstar.active:
+                self.bstar.apply(msg)
+
+    def recv_federation(self, items):
+        """ Federation: process what our peers have sent, and ask them for their registries when it's time """
+        now = time.time()
+        fed = self.federation
+        if fed.router in items:
+            while True:
+                try:
+                    msg = fed.router.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                identity, kind = msg[0], msg[1]
+                if kind == federation.REGISTRY:
+                    fed.send(fed.router, [identity, federation.REGISTRY, self.registry()])
+                elif kind == federation.REQUEST and len(msg) >= 7:
+                    # token, service, client name, header, body: queued as if from a client of ours
+                    address = fed.accept(identity, msg[2], msg[5], now)
+                    self.process_client(address, [msg[4], msg[3]] + msg[5:])
+                else:
+                    logging.error("E: invalid federation message:")
+                    dump(msg)
+
+        for peer in fed.peers:
+            if peer.socket not in items:
+                continue
+            while True:
+                try:
+                    msg = peer.socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if msg[0] == federation.REGISTRY and len(msg) > 1:
+                    fed.update_registry(peer, msg[1], now)
+                elif msg[0] == federation.REPLY and len(msg) >= 3:
+                    # token, service, body: back to the client the request came from
+                    address = fed.route_reply(msg, now)
+                    if address is not None:
+                        self.send_to_client(address, msg[2:])
+                else:
+                    logging.error("E: invalid federation message:")
+                    dump(msg)
+
+        fed.send_registry_requests(now)
+        fed.expire(now)
+
+    def registry(self) -> bytes:
+        """ Federation: the services we have workers for and their queue depths, for our peers """
+        return json.dumps({service.name.decode("utf8"): len(service.requests)
+                           for service in self.services.values() if service.workers}).encode("utf8")
+
+    @staticmethod
+    def encode_request(service, request) -> list:
+        """ Frames a queued request is replicated and journaled as """
+        deadline = DEADLINE.pack(request.deadline) if request.deadline is not None else b""
+        return [service.name, request.sender, request.client_name, request.header.pack(), deadline] + request.msg
+
+    @staticmethod
+    def decode_request(frames: list):
+        """ Service name and request back from encode_request's frames """
+        service, sender, client_name, header, deadline = frames[:5]
+        request = Request(sender, client_name, RoutingHeader.unpack(header), frames[5:])
+        request.deadline = DEADLINE.unpack(deadline)[0] if deadline else None
+        return service, request
+
+    def record_queued(self, service, request):
+        """
+        Replicate to the binary star peer and journal a request that has just been queued. Journaling waits for the
+        next sync: nothing is durable before then anyway, and requests that leave the queue first are never written
+        """
+        if request.rid is None or (self.bstar is None and self.journal is None):
+            return
+        self.recorded.add(request.rid)
+        if self.bstar is not None:
+            self.bstar.publish(bstar.QUEUED, str(request.rid), *self.encode_request(service, request))
+        if self.journal is not None:
+            if not self.journal_pending:
+                self.journal_due = time.time() + 1e-3*self.journal.sync_interval
+            self.journal_pending.append((service, request))
+            if not self.journal.sync_interval:
+                self.sync_journal()
+
+    def sync_journal(self, now=None):
+        """ Group commit: journal the requests queued since the last commit that are still waiting, then sync """
+        if self.journal_pending and (now is None or now >= self.journal_due):
+            for service, request in self.journal_pending:
+                if request.rid in self.recorded:
+                    self.journaled.add(request.rid)
+                    self.journal.accepted(request.rid, self.encode_request(service, request))
+            self.journal_pending = []
+            now = None
+        self.journal.sync(now)
+
+    def next_journal_sync(self):
+        """ When the journal is next due to be synced, None if there's nothing to sync """
+        if self.journal_pending:
+            return self.journal_due
+        return self.journal.next_sync()
+
+    def record_removed(self, request):
+        """ The request has left the queue: dispatched, dropped or expired """
+        request.done = True
+        if request.rid not in self.recorded:
+            return
+        self.recorded.discard(request.rid)
+        if self.bstar is not None:
+            self.bstar.publish(bstar.REMOVED, str(request.rid))
+        if request.rid in self.journaled:
+            self.journaled.discard(request.rid)
+            self.journal.done(request.rid)
+
+    def send_snapshot(self):
+        """ Binary star: bring a (re)started peer's shadow up to date with our workers and queues """
+        self.bstar.publish(bstar.SNAPSHOT)
+        for worker in self.workers.values():
+            if worker.service is not None:
+                self.bstar.publish(bstar.WORKER_READY, worker.address, worker.service.name, str(worker.slots))
+        for service in self.services.values():
+            queued = ([service.assembling] if service.assembling is not None else []) + service.requests.all_requests()
+            for request in queued:
+                self.bstar.publish(bstar.QUEUED, str(request.rid), *self.encode_request(service, request))
+
+    def adopt_shadow(self):
+        """ Binary star: we've taken over, requeue the peer's queued requests and expect its workers """
+        logging.warning(f"W: taking over from binary star peer, {len(self.bstar.requests)} queued request(s) and "
+                        f"{len(self.bstar.workers)} worker(s)")
+        self.adopted.update(self.bstar.workers)
+
+        last_rid = 0
+        for rid, frames in self.bstar.requests.items():
+            service, request = self.decode_request(frames)
+            request.rid = int(rid)
+            last_rid = max(last_rid, request.rid)
+            self.track_request(service, request)
+            self.dispatch(self.require_service(service), request)
+
+        # Keep our request ids clear of the ones just adopted
+        self.request_ids = itertools.count(max(last_rid, next(self.request_ids)) + 1)
+        self.bstar.requests.clear()
+        self.bstar.workers.clear()
+
+    def requeue_journal(self):
+        """ Requeue the requests the journal still holds from before a restart, they never reached a worker """
+        last_rid = 0
+        for rid, frames in self.journal.recovered:
+            service, request = self.decode_request(frames)
+            request.rid = rid
+            self.recorded.add(rid)
+            self.journaled.add(rid)
+            last_rid = max(last_rid, rid)
+            self.track_request(service, request)
+            overflow = self.require_service(service).requests.append(request)
+            if overflow is not None:
+                self.record_removed(overflow)
+                self.forget_request(overflow)
+        if self.journal.recovered:
+            logging.info(f"I: requeued {len(self.journal.recovered)} request(s) from the journal")
+        self.journal.recovered = []
+        self.request_ids = itertools.count(last_rid + 1)
+
+    def save_snapshot(self):
+        """
+        Write the registry to the snapshot file: workers, leader election state and, without a journal, queues,
+        including the requests spilled to disk
+        """
+        records = []
+        for worker in self.workers.values():
+            if worker.service is None:
+                continue
+            latency = worker.latency
+            records.append([snapshot.WORKER, worker.address, worker.service.name, str(worker.slots).encode("utf8"),
+                            worker.service.membership.members.get(worker.worker_name, b""),
+                            encode_number(worker.load), b"1" if worker.epoch is not None else b"",
+                            str(latency.count).encode("utf8")] +
+                           [encode_number(value) for value in (latency.ewma, latency.last, latency.min, latency.max)])
+
+        records.append([snapshot.LEADER, self.leader_strategy.name.encode("utf8")] + self.leader_strategy.snapshot())
+
+        # The journal already keeps the queues, and more recently
+        if self.journal is None:
+            for service in self.services.values():
+                queued = ([service.assembling] if service.assembling is not None else []) + \
+                    service.requests.all_requests()
+                for request in queued:
+                    records.append([snapshot.QUEUED, str(request.rid).encode("utf8")] +
+                                   self.encode_request(service, request))
+
+        snapshot.save(self.snapshot_path, records)
+        self.snapshot_at = time.time() + 1e-3*self.snapshot_interval
+
+    def restore_snapshot(self):
+        """ Rebuild the registry from the snapshot file, workers are provisional until heard from """
+        records = snapshot.load(self.snapshot_path)
+        now = time.time()
+        last_rid = 0
+        requeued = 0
+        for record in records:
+            kind = record[0]
+            if kind == snapshot.WORKER:
+                address, service, slots, endpoint, load, subscribed, count, ewma, last, fastest, slowest = record[1:12]
+                worker = self.require_worker(address)
+                worker.service = self.require_service(service)
+                worker.service.workers += 1
+                worker.slots = worker.credit = int(slots)
+                if endpoint:
+                    self.set_worker_endpoint(worker, endpoint)
+                worker.load = decode_number(load)
+                # Whatever membership epoch it holds is from before the restart, it gets the whole membership again
+                worker.epoch = 0 if subscribed else None
+                worker.latency.count = int(count)
+                worker.latency.ewma, worker.latency.last, worker.latency.min, worker.latency.max = (
+                    decode_number(value) for value in (ewma, last, fastest, slowest))
+
+                # Idle so it is heartbeated and purged, but off its service's queue until it shows signs of life
+                worker.expiry = now + 1e-3*self.PROVISIONAL_EXPIRY
+                self.waiting.append(worker)
+                self.expiries.push(worker)
+                self.provisional.add(address)
+
+            elif kind == snapshot.LEADER:
+                if record[1].decode("utf8") == self.leader_strategy.name:
+                    self.leader_strategy.restore(record[2:])
+
+            elif kind == snapshot.QUEUED and self.journal is None:
+                service, request = self.decode_request(record[2:])
+                request.rid = int(record[1])
+                last_rid = max(last_rid, request.rid)
+                self.track_request(service, request)
+                overflow = self.require_service(service).requests.append(request)
+                if overflow is not None:
+                    self.record_removed(overflow)
+                    self.forget_request(overflow)
+                requeued += 1
+
+        if records:
+            logging.info(f"I: restored {len(self.provisional)} worker(s) and {requeued} queued request(s) from "
+                         f"snapshot {self.snapshot_path}")
+        self.request_ids = itertools.count(max(last_rid, next(self.request_ids)) + 1)
 
     def cleanup(self):
         if self._debug:
             self.monitor.stop()
 
+        # A planned restart carries on from here
+        if self.snapshot_path is not None:
+            self.save_snapshot()
+
+        for service in self.services.values():
+            service.requests.close()
+        if self.bstar is not None:
+            self.bstar.close()
+        if self.federation is not None:
+            self.federation.close()
+        if self.journal is not None:
+            self.sync_journal()
+            self.journal.close()
+
         self.socket.close()
-        self.ctx.destroy()
-        if self.loop: self.loop.close()
+        if self.owns_ctx:
+            self.ctx.destroy()
+        if self.loop:
+            self.loop.close()
 
 
-def main():
+def encode_number(value) -> bytes:
+    """ A float that may be None as a snapshot frame """
+    return b"" if value is None else repr(value).encode("utf8")
+
+
+def decode_number(frame: bytes):
+    return float(frame) if frame else None
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """ Command line arguments of the broker, shared with the sharded broker (mdshard.py) """
     parser = argparse.ArgumentParser()
     parser.add_argument('-port', default=5555, type=int, help='port to listen through')
+    parser.add_argument('-bind', default=None, type=str, help='endpoint to bind instead of tcp://*:port, e.g. ipc://')
     parser.add_argument("--v", default=False, action='store_true', help='verbose output')
+    parser.add_argument("--asyncio", default=False, action='store_true', help='run the broker on an asyncio event loop')
+    parser.add_argument('-batch', default=1, type=int, help='most messages to drain per poll wakeup')
+    parser.add_argument('-queue_limit', default=None, type=int, help='most requests queued per service')
+    parser.add_argument('-overflow', default=REJECT, choices=OVERFLOW_POLICIES, help='policy once a queue is full')
+    parser.add_argument("--edf", default=False, action='store_true', help='earliest-deadline-first within services')
+    parser.add_argument("--fair", default=False, action='store_true', help='round robin across clients of a service')
+    parser.add_argument('-leader', default='random', choices=list(STRATEGIES), help='group leader election strategy')
+    parser.add_argument('-bstar', default=None, choices=['primary', 'backup'], help='run as one of a binary star pair')
+    parser.add_argument('-bstar_local', default=None, type=str, help='endpoint to publish binary star state on')
+    parser.add_argument('-bstar_remote', default=None, type=str, help="the binary star peer's state endpoint")
+    parser.add_argument('-journal', default=None, type=str, help='write-ahead journal of queued requests')
+    parser.add_argument('-journal_sync', default=25, type=float, help='most msecs between journal syncs')
+    parser.add_argument('-request_table', default=10000, type=int,
+                        help='most client request ids tracked to coalesce retries, 0 to disable')
+    parser.add_argument('-request_ttl', default=60.0, type=float, help='secs a client request id is tracked for')
+    parser.add_argument('-federate', default=None, type=str, help='endpoint to bind for federated peer brokers')
+    parser.add_argument('-peer', default=[], action='append', type=str,
+                        help="a federated peer broker's -federate endpoint, may be repeated")
+    parser.add_argument('-cache', default=[], action='append', type=str, metavar='SERVICE[:SIZE[:TTL]]',
+                        help="cache the service's replies, SIZE replies for TTL secs (1000, 60), may be repeated")
+    parser.add_argument('-snapshot', default=None, type=str, help='file to snapshot the registry to and restore from')
+    parser.add_argument('-snapshot_interval', default=5000, type=float, help='msecs between registry snapshots')
+    parser.add_argument('-fast', default=[], action='append', type=str, metavar='SERVICE',
+                        help='stateless service whose requests go straight to an idle worker, may be repeated')
+
+    return parser
+
+
+def broker_options(args, parser) -> dict:
+    """ MajorDomoBroker keyword arguments from the parsed command line """
+    if args.bstar and not (args.bstar_local and args.bstar_remote):
+        parser.error("-bstar needs -bstar_local and -bstar_remote")
+    if args.peer and not args.federate:
+        parser.error("-peer needs -federate")
+    if args.snapshot and args.bstar:
+        parser.error("-snapshot can't be used with -bstar")
+    if args.fast and args.bstar:
+        parser.error("-fast can't be used with -bstar")
+    if set(args.fast) & {cache.split(":")[0] for cache in args.cache}:
+        parser.error("-fast services can't be cached")
+    result_caches = {}
+    for cache in args.cache:
+        parts = cache.split(":")
+        try:
+            name, size, ttl = parts + ["1000", "60"][len(parts) - 1:]
+            result_caches[name.encode("utf8")] = (int(size), float(ttl))
+        except ValueError:
+            parser.error(f"-cache {cache}: expected SERVICE[:SIZE[:TTL]]")
+
+    return dict(verbose=args.v, use_asyncio=args.asyncio, batch_budget=args.batch, queue_limit=args.queue_limit,
+                overflow_policy=args.overflow, edf=args.edf, fair_queuing=args.fair, leader_strategy=args.leader,
+                bstar_role=args.bstar, bstar_local=args.bstar_local, bstar_remote=args.bstar_remote,
+                journal_path=args.journal, journal_sync=args.journal_sync, request_table_size=args.request_table,
+                request_table_ttl=args.request_ttl, result_caches=result_caches, federation_local=args.federate,
+                federation_peers=args.peer, snapshot_path=args.snapshot, snapshot_interval=args.snapshot_interval,
+                fast_services=[name.encode("utf8") for name in args.fast])
 
-    args = parser.parse_args()
 
-    port = args.port
-    verbose = args.v
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    endpoint = args.bind or f"tcp://*:{args.port}"
+    options = broker_options(args, parser)
 
     print(args)
     print("#"*40)
 
     # Create and start new broker
-    broker = MajorDomoBroker(verbose)
-    broker.bind(f"tcp://*:{port}")
+    broker = MajorDomoBroker(**options)
+    broker.bind(endpoint)
 
     try:
         print("Broker started")
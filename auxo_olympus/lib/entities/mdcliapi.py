@@ -1,8 +1,16 @@
+import os
+import json
+import math
+import time
 import logging
+from binascii import hexlify
 
 import zmq
 
 import auxo_olympus.lib.utils.MDP as MDP
+from auxo_olympus.lib.utils.envelope import RoutingHeader
+from auxo_olympus.lib.utils.hash_ring import HashRing
+from auxo_olympus.lib.utils.metrics import LatencyHistogram
 from auxo_olympus.lib.utils.zhelpers import dump, ensure_is_bytes
 
 
@@ -16,13 +24,27 @@ class MajorDomoClient(object):
     poller = None
     timeout = 2500
     verbose = False
+    backup = None           # endpoint of the other broker of a binary star pair
+    identity = None         # kept across reconnects when there is a backup, so queued replies still find us
+    last_request = None     # frames of the last request, resent on failover
+    retries = 0             # times a request is resent to the same broker before giving up on it
+    answered = False        # a reply to the last request has arrived
 
-    def __init__(self, broker, verbose=False, client_name=MDP.C_CLIENT):
+    def __init__(self, broker, verbose=False, client_name=MDP.C_CLIENT, backup=None, retries=0):
+        """
+        :param backup: the other broker of a binary star pair, failed over to when the broker stops answering
+        :param retries: times to resend a request that gets no reply within the timeout. Requests that may be resent
+                        carry a request id, so the broker coalesces the resends onto the original
+        """
         self.broker = broker
+        self.backup = backup
+        self.retries: int = retries
         self.verbose = verbose
         if not isinstance(client_name, bytes):
             client_name = client_name.encode("utf8")
         self.client_name = client_name
+        if backup:
+            self.identity = client_name + b"-" + hexlify(os.urandom(4))
         self.agent_type = MDP.C_CLIENT
         self.ctx = zmq.Context()
         self.poller = zmq.Poller()
@@ -36,33 +58,54 @@ class MajorDomoClient(object):
             self.client.close()
         self.client = self.ctx.socket(zmq.DEALER)
         self.client.linger = 0
+        if self.identity:
+            self.client.identity = self.identity
         self.client.connect(self.broker)
         self.poller.register(self.client, zmq.POLLIN)
         if self.verbose:
             logging.info("I: connecting to broker at %s...", self.broker)
 
-    def send(self, service: str, request: str):
+    def send(self, service: str, request: str, **routing):
         """Send request to broker
+        :param routing: routing flags for the broker (see RoutingHeader), e.g. multiple=True. A request that may be
+                        resent is given a random request_id if it doesn't have one
         """
         if not isinstance(request, list):
             request = [request.encode("utf8")]
+        if (self.retries or self.backup) and not routing.get('request_id'):
+            routing['request_id'] = os.urandom(16)
 
         # Prefix request with protocol frames
         # Frame 0: empty (REQ emulation)
         # Frame 1: "MDPCxy" (six bytes, MDP/Client x.y)
-        # Frame 2: Service name (printable string -- encode to bytes)
+        # Frame 2: Client name
+        # Frame 3: Service name (printable string -- encode to bytes)
+        # Frame 4: Routing header, so the broker never has to parse the body
 
-        request = [b"", MDP.C_CLIENT, self.client_name, service] + request
+        header = RoutingHeader(**routing).pack()
+        request = [b"", MDP.C_CLIENT, self.client_name, service, header] + request
         request = ensure_is_bytes(request)
         if self.verbose:
             logging.warning("I: send request to '%s' service: ", service)
             dump(request)
         self.client.send_multipart(request)
+        self.last_request = request
+        self.answered = False
 
     def recv(self):
         """Returns the reply message or None if there was no reply."""
         try:
             items = self.poller.poll(self.timeout)
+            retries = self.retries if self.last_request and not self.answered else 0
+            while not items and retries:
+                # Lazy Pirate: the broker answers or coalesces the resend, it won't be computed twice
+                retries -= 1
+                logging.warning("W: no reply, resending request")
+                self.client.send_multipart(self.last_request)
+                items = self.poller.poll(self.timeout)
+            if not items and self.backup and self.last_request:
+                self.fail_over()
+                items = self.poller.poll(self.timeout)
         except KeyboardInterrupt:
             return    # interrupted
 
@@ -80,6 +123,264 @@ class MajorDomoClient(object):
             header = msg.pop(0)
             assert self.agent_type == header
             service = msg.pop(0)
+            self.answered = True
             return msg
         else:
             logging.warning("W: permanent error, abandoning request")
+
+    def fail_over(self):
+        """ Switch to the other broker of a binary star pair and resend the last request there """
+        self.broker, self.backup = self.backup, self.broker
+        logging.warning("W: no reply, failing over to %s", self.broker)
+        self.reconnect_to_broker()
+        self.client.send_multipart(self.last_request)
+
+    def queue_info(self, service: str):
+        """ Ask the broker (mmi.queue) how deep the service's queue is, None if unknown or no reply """
+        self.send("mmi.queue", service)
+        reply = self.recv()
+        if not reply or reply[-1] == b"404":
+            return None
+        return json.loads(reply[-1])
+
+    def stats(self, service: str = ""):
+        """ Broker counters and latency histograms (mmi.stats), of one service or all of them, None if unknown """
+        self.send("mmi.stats", service)
+        reply = self.recv()
+        if not reply or reply[-1] == b"404":
+            return None
+        return json.loads(reply[-1])
+
+    def workers(self, service: str = ""):
+        """ Broker's view of the service's workers (mmi.workers), or of every worker, None if unknown """
+        self.send("mmi.workers", service)
+        reply = self.recv()
+        if not reply or reply[-1] == b"404":
+            return None
+        return json.loads(reply[-1])
+
+
+class BrokerHealth(object):
+    """ What a MultiBrokerClient knows of one broker of its pool """
+    COOLDOWN = 2.0          # secs a broker is avoided after it first fails to answer
+    MAX_COOLDOWN = 60.0     # the cooldown doubles with every failure in a row, up to this
+
+    def __init__(self):
+        self.failures: int = 0      # failures in a row
+        self.down_until: float = 0.0
+        self.replies: int = 0
+        self.hedges_won: int = 0    # replies that beat the broker the request was sent to first
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.down_until
+
+    def succeeded(self):
+        self.failures = 0
+        self.down_until = 0.0
+        self.replies += 1
+
+    def failed(self, now: float):
+        self.failures += 1
+        self.down_until = now + min(self.MAX_COOLDOWN, self.COOLDOWN * 2 ** (self.failures - 1))
+
+
+class MultiBrokerClient(object):
+    """
+    Majordomo client over a pool of brokers. Each service goes to the broker the consistent hash ring picks for it, so
+    clients spread their load over the pool without a central balancer, and each service's requests keep to one broker.
+    Lazy Pirate failover: a broker that doesn't answer within `timeout` is marked down for a while, its socket is
+    reopened and the request goes to the service's next broker on the ring, up to `retries` times. With
+    `hedge_percentile` a request still unanswered after that percentile of the replies seen so far is also sent to the
+    next broker, and the first reply wins.
+
+    Requests carry a request id, so a broker that gets the same request again coalesces it onto the first (see
+    utils/request_table.py). Like MajorDomoClient, one request is in flight at a time: send, then recv its replies.
+    """
+    timeout = 2500              # msecs to wait for a broker's reply before failing over
+    HEDGE_MIN_SAMPLES = 20      # replies to see before hedging, the percentile means little before that
+
+    def __init__(self, brokers: list, verbose=False, client_name=MDP.C_CLIENT, retries=3, hedge_percentile=None,
+                 replicas=100):
+        """
+        :param brokers: broker endpoints
+        :param retries: times a request is sent on to another broker after a timeout before giving up
+        :param hedge_percentile: e.g. 0.95 to hedge requests slower than 95% of the replies so far, None not to hedge
+        :param replicas: points per broker on the hash ring
+        """
+        if not brokers:
+            raise ValueError("MultiBrokerClient needs at least one broker")
+        self.verbose = verbose
+        if not isinstance(client_name, bytes):
+            client_name = client_name.encode("utf8")
+        self.client_name = client_name
+        self.retries: int = retries
+        self.hedge_percentile = hedge_percentile
+        self.agent_type = MDP.C_CLIENT
+
+        self.ring = HashRing(brokers, replicas)
+        self.preferences = {}   # service -> brokers in ring order for it
+        self.health = {broker: BrokerHealth() for broker in brokers}
+        self.latency = LatencyHistogram()
+        self.ctx = zmq.Context()
+        self.sockets = {}       # broker -> DEALER socket
+        for broker in brokers:
+            self.reconnect(broker)
+
+        self.last_request = None
+        self.pending = {}       # broker -> time the current request was sent there
+        self.tried = []         # brokers the current request has been sent to
+        self.answered_by = None
+        logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+
+    def reconnect(self, broker: str):
+        """ (Re)open the socket to a broker, dropping anything still on its way from it """
+        if broker in self.sockets:
+            self.sockets[broker].close()
+        socket = self.ctx.socket(zmq.DEALER)
+        socket.linger = 0
+        socket.connect(broker)
+        self.sockets[broker] = socket
+        if self.verbose:
+            logging.info("I: connecting to broker at %s...", broker)
+
+    def brokers_for(self, service: bytes) -> list:
+        """ The service's brokers in the order to try them, the healthy ones first """
+        order = self.preferences.get(service)
+        if order is None:
+            order = self.preferences[service] = self.ring.preference(service)
+        now = time.time()
+        return [b for b in order if self.health[b].healthy(now)] + [b for b in order if not self.health[b].healthy(now)]
+
+    def send(self, service: str, request: str, **routing):
+        """Send a request to the service's broker
+        :param routing: routing flags for the broker (see RoutingHeader), e.g. multiple=True
+        """
+        if not isinstance(request, list):
+            request = [request.encode("utf8")]
+        if not routing.get('request_id'):
+            routing['request_id'] = os.urandom(16)
+        header = RoutingHeader(**routing).pack()
+        request = ensure_is_bytes([b"", MDP.C_CLIENT, self.client_name, service, header] + request)
+
+        self.abandon(list(self.pending))
+        self.last_request = request
+        self.tried = []
+        self.answered_by = None
+        self.send_to(self.brokers_for(request[3])[0])
+
+    def send_to(self, broker: str):
+        if self.verbose:
+            logging.info("I: send request to '%s' via %s", self.last_request[3], broker)
+            dump(self.last_request)
+        self.sockets[broker].send_multipart(self.last_request)
+        self.pending[broker] = time.time()
+        self.tried.append(broker)
+
+    def abandon(self, brokers: list):
+        """ Stop waiting on these brokers, any reply still to come from them is dropped with their socket """
+        for broker in brokers:
+            del self.pending[broker]
+            self.reconnect(broker)
+
+    def next_broker(self):
+        """ The next broker of the current request's service not tried yet, None if all have been """
+        for broker in self.brokers_for(self.last_request[3]):
+            if broker not in self.tried:
+                return broker
+        return None
+
+    def hedge_delay(self):
+        """ Secs after which an unanswered request is hedged, None if hedging is off or there's too little to go on """
+        if self.hedge_percentile is None or self.latency.count < self.HEDGE_MIN_SAMPLES:
+            return None
+        return 1e-6*self.latency.percentile(self.hedge_percentile)
+
+    def recv(self):
+        """Returns the reply message or None if there was no reply."""
+        if self.answered_by is not None:
+            # Further replies to a group request all come from the broker that answered first
+            socket = self.sockets[self.answered_by]
+            if socket.poll(self.timeout):
+                return self.unwrap(socket.recv_multipart())
+            logging.warning("W: permanent error, abandoning request")
+            return None
+        if self.last_request is None:
+            return None
+
+        retries = self.retries
+        while True:
+            # Brokers are dropped from pending as their timeouts pass, so every one left still has a wake up to come
+            now = time.time()
+            hedge_delay = self.hedge_delay()
+            first_sent = min(self.pending.values())
+            wake_at = first_sent + 1e-3*self.timeout
+            if hedge_delay is not None and len(self.pending) == 1 and self.next_broker() is not None:
+                wake_at = min(wake_at, first_sent + hedge_delay)
+
+            poller = zmq.Poller()
+            for broker in self.pending:
+                poller.register(self.sockets[broker], zmq.POLLIN)
+            try:
+                # Rounded up, zmq would cut a fraction of a msec down to a poll that returns straight away
+                items = dict(poller.poll(max(0, math.ceil(1e3*(wake_at - now)))))
+            except KeyboardInterrupt:
+                return None     # interrupted
+
+            for broker, sent in list(self.pending.items()):
+                if self.sockets[broker] in items:
+                    return self.answered(broker, sent)
+
+            # Lazy Pirate: a broker that didn't answer in time is given up on, whether or not a hedge is still out
+            now = time.time()
+            expired = [broker for broker, sent in self.pending.items() if now >= sent + 1e-3*self.timeout]
+            for broker in expired:
+                self.health[broker].failed(now)
+                logging.warning("W: no reply from %s", broker)
+            self.abandon(expired)
+
+            if not self.pending:
+                # Nobody left to answer, try the next broker
+                broker = self.next_broker()
+                if not retries or broker is None:
+                    logging.warning("W: permanent error, abandoning request")
+                    self.last_request = None
+                    return None
+                retries -= 1
+                self.send_to(broker)
+            elif hedge_delay is not None and len(self.pending) == 1 and now >= min(self.pending.values()) + hedge_delay:
+                broker = self.next_broker()
+                if broker is not None:
+                    if self.verbose:
+                        logging.info("I: hedging request to %s", broker)
+                    self.send_to(broker)
+
+    def answered(self, broker: str, sent: float):
+        """ The first reply to the current request, from `broker`: forget the other brokers it went to """
+        msg = self.sockets[broker].recv_multipart()
+        self.latency.record(time.time() - sent)
+        self.health[broker].succeeded()
+        if broker != self.tried[0]:
+            self.health[broker].hedges_won += 1
+        del self.pending[broker]
+        self.abandon(list(self.pending))
+        self.answered_by = broker
+        return self.unwrap(msg)
+
+    def unwrap(self, msg: list):
+        if self.verbose:
+            logging.info("I: received reply:")
+            dump(msg)
+
+        # Don't try to handle errors, just assert noisily
+        assert len(msg) >= 4
+
+        _ = msg.pop(0)
+        header = msg.pop(0)
+        assert self.agent_type == header
+        service = msg.pop(0)
+        return msg
+
+    def close(self):
+        for socket in self.sockets.values():
+            socket.close()
+        self.ctx.term()
@@ -29,7 +29,10 @@ class Client(object):
         for i in range(num_requests):
             request = json.dumps(kwargs)    # FIXME: May have to remove some extra client information here!
             try:
-                self.client.send(service, request)
+                self.client.send(service, request, multiple=kwargs.get('multiple_bool', False),
+                                 priority=kwargs.get('priority', 0), deadline=1000*self.TIMEOUT,
+                                 min_workers=kwargs.get('min_workers', 0), group_size=kwargs.get('max_workers', 0),
+                                 assembly_timeout=kwargs.get('assembly_timeout', 0))
             except KeyboardInterrupt:
                 print("Send interrupted, aborting")
                 return
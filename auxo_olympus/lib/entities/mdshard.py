@@ -0,0 +1,256 @@
+"""
+Sharded Majordomo broker: services are partitioned across K independent brokers behind one front ROUTER.
+
+A single MajorDomoBroker serves every service from one socket and one thread, so a hot service's dispatching holds up
+all the others. Here the front only reads the frames it needs to pick a shard and passes the message on unchanged,
+addresses included, to that shard's DEALER socket:
+    client request      the service name, hashed to a shard; mmi.* requests go to the shard owning the service named
+                        in the body (shard 0 when the body is empty, so broker-wide mmi.stats only covers that shard)
+    worker message      the service from its W_READY, remembered per worker until it disconnects or has been silent for
+                        WORKER_TTL; before that, or once forgotten, the service part of its identity (A01.service)
+Each shard is a whole MajorDomoBroker with its own services, workers, queues and heartbeats, whose replies the front
+sends back out of the ROUTER as they are. Shards run as processes over ipc:// by default, so they dispatch on separate
+cores; with threads=True they run as threads over inproc://, which only overlaps their socket I/O.
+
+    python3 -m auxo_olympus.lib.entities.mdshard -shards 4 -port 5555
+"""
+import os
+import time
+import zlib
+import signal
+import logging
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+import zmq
+
+from auxo_olympus.lib.utils import MDP
+from auxo_olympus.lib.utils.zhelpers import dump
+from auxo_olympus.lib.entities.mdbroker import MajorDomoBroker, build_parser, broker_options
+
+
+def run_shard(endpoint: str, options: dict):
+    """ Shard process: a broker serving the front over `endpoint` until interrupted """
+    broker = MajorDomoBroker(socket_type=zmq.DEALER, **options)
+    broker.bind(endpoint)
+    try:
+        broker.run()
+    except KeyboardInterrupt:
+        pass
+    broker.cleanup()
+
+
+class ShardedBroker(object):
+    """ Front router and the shard brokers behind it, see the module docstring """
+    POLL_INTERVAL = 250     # msecs, how long stop() can take to be noticed
+    BATCH = 64              # most messages forwarded from one socket before looking at the others
+    WORKER_TTL = 60.0       # secs a worker's shard is remembered after its last message, its shard has long purged it
+
+    def __init__(self, shards: int = 2, threads: bool = False, **options):
+        """
+        :param shards: number of shard brokers
+        :param threads: run the shards as threads of this process rather than as processes
+        :param options: MajorDomoBroker keyword arguments every shard is created with, a journal_path or
+                        snapshot_path gets a .<shard> suffix per shard
+        """
+        if shards < 1:
+            raise ValueError("A sharded broker needs at least one shard")
+        if options.get('bstar_role') is not None:
+            raise ValueError("Shards can't run as a binary star pair")
+        if options.get('federation_local') is not None:
+            raise ValueError("Shards can't be federated, they would all bind the same federation endpoint")
+        if threads and options.get('use_asyncio'):
+            raise ValueError("Thread shards share the front's context, they run the poll loop, not asyncio")
+
+        self.threads: bool = threads
+        self.options: dict = options
+        self.ctx = zmq.Context()
+        self.frontend = self.ctx.socket(zmq.ROUTER)
+        self.frontend.linger = 0
+        self.running: bool = True
+
+        if threads:
+            self.endpoints = [f"inproc://mdshard-{id(self)}-{i}" for i in range(shards)]
+        else:
+            self.endpoints = [f"ipc://{tempfile.gettempdir()}/auxo-shard-{os.getpid()}-{i}.ipc" for i in range(shards)]
+        self.shards = []            # Thread or Process running each shard
+        self.brokers = []           # the shard brokers, thread mode only
+        self.backends = []          # DEALER socket to each shard
+        self.worker_shards = OrderedDict()  # worker address -> [shard it registered with, last message], oldest first
+        self.forwarded = [0] * shards
+
+        logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+
+    def shard_of(self, service: bytes) -> int:
+        return zlib.crc32(service) % len(self.endpoints)
+
+    def bind(self, endpoint):
+        """ Bind the front to endpoint, can call this multiple times """
+        self.frontend.bind(endpoint)
+        logging.info(f"I: sharded MDP broker ({len(self.endpoints)} shards) is active at {endpoint}")
+
+    def start(self):
+        """ Start the shards and connect to them """
+        for i, endpoint in enumerate(self.endpoints):
+            options = dict(self.options)
+            for path in ('journal_path', 'snapshot_path'):
+                if options.get(path):
+                    options[path] = f"{options[path]}.{i}"
+
+            if self.threads:
+                broker = MajorDomoBroker(socket_type=zmq.DEALER, ctx=self.ctx, **options)
+                broker.bind(endpoint)
+                self.brokers.append(broker)
+                shard = threading.Thread(target=broker.run, daemon=True)
+            else:
+                shard = multiprocessing.get_context('spawn').Process(target=run_shard, args=(endpoint, options),
+                                                                     daemon=True)
+            shard.start()
+            self.shards.append(shard)
+
+            backend = self.ctx.socket(zmq.DEALER)
+            backend.linger = 0
+            backend.connect(endpoint)
+            self.backends.append(backend)
+
+    def route(self, msg: list):
+        """ Index of the shard a message from a client or worker goes to, None if it is malformed """
+        if len(msg) < 4:
+            return None
+        sender, header = msg[0], msg[2]
+
+        if header == MDP.C_CLIENT:
+            if len(msg) < 5:
+                return None
+            service = msg[4]
+            if service.startswith(MajorDomoBroker.INTERNAL_SERVICE_PREFIX):
+                # Answered by the shard that owns the service the body asks about
+                return self.shard_of(msg[-1]) if len(msg) > 5 and msg[-1] else 0
+            return self.shard_of(service)
+
+        if header == MDP.W_WORKER:
+            command = msg[3]
+            if command == MDP.W_DISCONNECT:
+                entry = self.worker_shards.pop(sender, None)
+                return entry[0] if entry is not None else self.shard_of(sender.rpartition(b".")[2])
+
+            if command == MDP.W_READY and len(msg) > 4:
+                entry = self.worker_shards[sender] = [self.shard_of(msg[4]), time.time()]
+            else:
+                entry = self.worker_shards.get(sender)
+                if entry is None:
+                    return self.shard_of(sender.rpartition(b".")[2])
+                entry[1] = time.time()
+            self.worker_shards.move_to_end(sender)
+            return entry[0]
+
+        return None
+
+    def expire_workers(self, now: float):
+        """ Forget the workers not heard from for WORKER_TTL, the ones that expired or crashed without a goodbye """
+        cutoff = now - self.WORKER_TTL
+        while self.worker_shards:
+            sender, entry = next(iter(self.worker_shards.items()))
+            if entry[1] >= cutoff:
+                break
+            del self.worker_shards[sender]
+
+    def forward_requests(self):
+        """ Pass messages from clients and workers on to their shards """
+        for _ in range(self.BATCH):
+            try:
+                msg = self.frontend.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            shard = self.route(msg)
+            if shard is None:
+                logging.error("E: invalid message:")
+                dump(msg)
+                continue
+            self.forwarded[shard] += 1
+            self.backends[shard].send_multipart(msg)
+
+    def forward_replies(self, backend):
+        """ Pass a shard's messages, already addressed, back out to clients and workers """
+        for _ in range(self.BATCH):
+            try:
+                msg = backend.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.frontend.send_multipart(msg)
+
+    def run(self):
+        """ Start the shards and route between them and the front until stopped """
+        if not self.shards:
+            self.start()
+
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        for backend in self.backends:
+            poller.register(backend, zmq.POLLIN)
+
+        while self.running:
+            items = dict(poller.poll(self.POLL_INTERVAL))
+            if self.frontend in items:
+                self.forward_requests()
+            for backend in self.backends:
+                if backend in items:
+                    self.forward_replies(backend)
+            self.expire_workers(time.time())
+
+    def stop(self):
+        self.running = False
+
+    def cleanup(self):
+        """ Stop the shards and close the front """
+        for broker in self.brokers:
+            broker.stop()
+        for i, shard in enumerate(self.shards):
+            if self.threads:
+                shard.join(1e-3*MajorDomoBroker.HEARTBEAT_INTERVAL + 1)
+                if not shard.is_alive():
+                    self.brokers[i].cleanup()
+            elif shard.is_alive():
+                # Interrupted rather than terminated so it cleans up (syncs its journal) on the way out
+                os.kill(shard.pid, signal.SIGINT)
+                shard.join(5)
+                if shard.is_alive():
+                    shard.terminate()
+
+        for backend in self.backends:
+            backend.close()
+        self.frontend.close()
+        self.ctx.destroy(0)
+
+
+def main():
+    parser = build_parser()
+    parser.add_argument('-shards', default=2, type=int, help='number of shard brokers the services are spread over')
+    parser.add_argument("--threads", default=False, action='store_true', help='run the shards as threads, not processes')
+    args = parser.parse_args()
+    endpoint = args.bind or f"tcp://*:{args.port}"
+    options = broker_options(args, parser)
+    if options['bstar_role'] is not None or options['federation_local'] is not None:
+        parser.error("-bstar and -federate can't be used with shards")
+
+    print(args)
+    print("#"*40)
+
+    broker = ShardedBroker(args.shards, args.threads, **options)
+    broker.bind(endpoint)
+
+    try:
+        print("Broker started")
+        broker.run()
+
+    except KeyboardInterrupt:
+        print("Broker has been stopped")
+        broker.cleanup()
+
+    print("Exiting main program")
+
+
+if __name__ == '__main__':
+    main()
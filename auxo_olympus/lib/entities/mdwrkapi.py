@@ -1,3 +1,4 @@
+import os
 import time
 import json
 import random
@@ -7,8 +8,10 @@ from typing import Dict
 
 import zmq
 
-from auxo_olympus.lib.utils.zhelpers import dump, ensure_is_bytes, ZMQMonitor, get_host_name_ip, strip_of_bytes
+from auxo_olympus.lib.utils.zhelpers import dump, ensure_is_bytes, ZMQMonitor, get_host_name_ip
 from auxo_olympus.lib.utils.mdpeer import PeerPort
+from auxo_olympus.lib.utils.membership import MembershipReplica
+from auxo_olympus.lib.utils.metrics import BatchMetrics
 import auxo_olympus.lib.utils.MDP as MDP
 
 
@@ -20,6 +23,7 @@ LOCAL: bool = True      # if running on this machine, use 'ipc://routing.ipc'
 
 class MajorDomoWorker(object):
     HEARTBEAT_LIVENESS = 3
+    FAILOVER_AFTER = 1.5        # heartbeats of silence before failing over to the backup broker, if there is one
     broker = None
     ctx = None
     service = None
@@ -32,12 +36,19 @@ class MajorDomoWorker(object):
 
     expect_reply = False
     timeout = 2500
+    batch_budget = 1        # most messages drained per poll wakeup
     verbose = False
 
     reply_to = None       # Return address if any
+    backup = None         # endpoint of the other broker of a binary star pair
+    heard_at = 0          # when the broker was last heard from
 
-    def __init__(self, broker, service, verbose=False, worker_name=MDP.W_WORKER, own_port=None):
+    def __init__(self, broker, service, verbose=False, worker_name=MDP.W_WORKER, own_port=None, slots=1,
+                 peer_port=True, backup=None):
         self.broker: str = broker
+        self.backup: str = backup
+        self.use_peer_port: bool = peer_port      # False for services whose workers never talk to their peers
+        self.slots: int = slots     # requests the broker may have in flight with us, see recv_request
         self.own_port: int = own_port if own_port else 5555 + random.randint(1, 20)
         self.service: str = service
         self.verbose = verbose
@@ -51,6 +62,7 @@ class MajorDomoWorker(object):
         self.agent_name: bytes = agent_name        # of format A01
 
         self.worker_socket = None
+        self.batch_metrics = BatchMetrics()
         self.ctx = zmq.Context()
         self.poller = zmq.Poller()
 
@@ -62,6 +74,7 @@ class MajorDomoWorker(object):
         self.endpoint: str = f"tcp://{ip_addr}:{self.own_port}"
         
         self.peers_endpoints: Dict[bytes, str] = {}    # tcp endpoints of peers for the given service
+        self.membership = MembershipReplica()           # the service's peer group, kept up to date by the broker
         # Note that self.peer has not been connected to its peers
         self.peer_port: PeerPort = None
         self.peer_request_queue: Queue = Queue()
@@ -97,12 +110,27 @@ class MajorDomoWorker(object):
             if self.verbose:
                 logging.info(f"I: connecting to broker at {self.broker}...")
 
-            # Register service with broker
-            self.send_to_broker(MDP.W_READY, self.service, [])
+            # Register service with broker, advertising our slots if we can take more than one request at a time
+            self.send_to_broker(MDP.W_READY, self.service, [str(self.slots)] if self.slots > 1 else [])
+
+            # A new registration starts with an empty membership, our first heartbeat subscribes us to it right away
+            self.membership.reset()
+            if self.use_peer_port:
+                self.send_heartbeat()
 
             # If liveness hits zero, queue is considered disconnected
             self.liveness = self.HEARTBEAT_LIVENESS
             self.heartbeat_at = time.time() + 1e-3 * self.heartbeat
+            self.heard_at = time.time()
+
+    def fail_over(self):
+        """ Switch to the other broker of a binary star pair """
+        self.broker, self.backup = self.backup, self.broker
+        logging.warning(f"W: broker is silent, failing over to {self.broker}")
+        self.reconnect_to_broker()
+
+    def failover_at(self) -> float:
+        return self.heard_at + 1e-3*self.FAILOVER_AFTER*self.heartbeat
 
     def send_to_broker(self, command, option=None, msg=None):
         """Send message to broker.
@@ -135,6 +163,7 @@ class MajorDomoWorker(object):
             except TypeError:       # probably trying to concatenate a list with dict
                 reply = [self.reply_to, ''] + [reply]
             self.send_to_broker(MDP.W_REPLY, msg=reply)
+            self.heard_at = time.time()     # the broker doesn't heartbeat us while we're busy
 
         while True:
             # Determine whether the peer-port is dead, break if so
@@ -142,40 +171,24 @@ class MajorDomoWorker(object):
                 break
 
             # Poll socket for a reply, with timeout
+            timeout = self.timeout
+            if self.backup:
+                timeout = max(0, min(timeout, 1e3*(self.failover_at() - time.time())))
             try:
-                items = self.poller.poll(self.timeout)
+                items = self.poller.poll(timeout)
             except (zmq.ZMQError, KeyboardInterrupt):
                 break   # Interrupted
 
             if items:
-                msg = self.worker_socket.recv_multipart()
-                if self.verbose:
-                    logging.info("I: received message from broker: ")
-                    dump(msg)
-
-                self.liveness = self.HEARTBEAT_LIVENESS
-                # Don't try to handle errors, just assert noisily
-                assert len(msg) >= 3
-
-                # msg from broker:
-                #   Frame 0: empty
-                #   Frame 1: MDPW
-                #   Frame 2: x/02 (type request)
-                #   Frame 3: options (type dict -- use json loads to unpack)
-                #   Frame 4: client addr
-                #   Frame 5: empty
-                #   Frame 6: client request
-
-                empty = msg.pop(0)
-                assert empty == b''
-                header = msg.pop(0)
-                assert header == MDP.W_WORKER
-                command = msg.pop(0)
-
-                out = self.command_handler(command, msg)
+                out = self.recv_batch()
                 if out:         # request to process?
                     return out
 
+            elif self.backup:
+                # With a backup broker, don't wait out the liveness: switch as soon as a heartbeat is overdue
+                if time.time() >= self.failover_at():
+                    self.fail_over()
+
             else:
                 self.liveness -= 1
                 if self.liveness == 0:
@@ -189,57 +202,125 @@ class MajorDomoWorker(object):
 
             # Send HEARTBEAT if it's time
             if time.time() > self.heartbeat_at:
-                self.send_to_broker(MDP.W_HEARTBEAT, msg=self.endpoint)
+                self.send_heartbeat()
                 self.heartbeat_at = time.time() + 1e-3*self.heartbeat
 
         self.destroy()
 
+    def send_heartbeat(self):
+        """ Heartbeat with our peer port endpoint and load, and the membership epoch we hold if we use a peer port """
+        msg = [self.endpoint, str(self.report_load())]
+        if self.use_peer_port:
+            msg.append(str(self.membership.epoch))
+        self.send_to_broker(MDP.W_HEARTBEAT, msg=msg)
+
+    def report_load(self) -> float:
+        """ Load reported to the broker in heartbeats, used for leader election -- the host's load per core """
+        try:
+            return round(os.getloadavg()[0] / (os.cpu_count() or 1), 3)
+        except (AttributeError, OSError):
+            return 0.0
+
+    def recv_request(self):
+        """
+        For pipelined workers (slots > 1): wait for the next request without replying to the previous one.
+        Returns (reply_to, request), the reply is sent later with send_reply(reply_to, reply)
+        """
+        request = self.recv(reply=None)
+        if request is None:
+            return None, None
+        return self.reply_to, request
+
+    def send_reply(self, reply_to, reply):
+        """ Reply to a request received with recv_request, which gives its slot back to the broker """
+        if not isinstance(reply, list):
+            reply = [reply]
+        self.send_to_broker(MDP.W_REPLY, msg=[reply_to, ''] + reply)
+        self.heard_at = time.time()
+
+    def recv_batch(self):
+        """
+        Process the messages already queued from the broker, up to batch_budget, before going back to the heartbeat
+        check. Stops early and returns the request if one arrives
+        """
+        count = 0
+        out = None
+        while count < self.batch_budget and not out:
+            try:
+                msg = self.worker_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            count += 1
+
+            if self.verbose:
+                logging.info("I: received message from broker: ")
+                dump(msg)
+
+            self.liveness = self.HEARTBEAT_LIVENESS
+            self.heard_at = time.time()
+            # Don't try to handle errors, just assert noisily
+            assert len(msg) >= 3
+
+            # msg from broker:
+            #   Frame 0: empty
+            #   Frame 1: MDPW
+            #   Frame 2: x/02 (type request)
+            #   Frame 3: leader flag
+            #   Frame 4: membership epoch, or the membership update we're behind by (json)
+            #   Frame 5: return address (client addr), echoed back as is in the reply
+            #   Frame 6: empty
+            #   Frame 7: client request
+
+            empty = msg.pop(0)
+            assert empty == b''
+            header = msg.pop(0)
+            assert header == MDP.W_WORKER
+            command = msg.pop(0)
+
+            out = self.command_handler(command, msg)
+
+        self.batch_metrics.record(count)
+        return out
+
     def command_handler(self, command: bytes, msg: list):
         if command == MDP.W_REQUEST:
 
             # msg:
-            # Frame 0: options
-            # Frame 1: client_addr
-            # Frame 2: empty
-            # Frame 3: client request
+            # Frame 0: leader flag
+            # Frame 1: membership epoch or update
+            # Frame 2: client_addr
+            # Frame 3: empty
+            # Frame 4: client request
 
             self.received_request: bool = True
 
             # We should pop and save as many addresses as there are
             # up to a null part, but for now, just save one...
-            options = msg.pop(0)
+            leader_frame = msg.pop(0)
+            membership_frame = msg.pop(0)
             self.reply_to = msg.pop(0)
             empty = msg.pop(0)
             assert empty == b''
             actual_msg = msg.pop(0)
 
-            options: dict = json.loads(options)
-
-            self.leader_bool = options['leader']
+            self.leader_bool = leader_frame == MDP.W_LEADER
 
-            peers_endpoints: Dict[bytes, bytes] = options['peer_endpoints']
-            peers_endpoints: Dict[str, str] = strip_of_bytes(peers_endpoints)
-            peers_endpoints.pop(self.worker_name.decode('utf8'))      # pop own endpoint
-            self.peers_endpoints = peers_endpoints
-            # convert dict[str, str] to dict[bytes, str]
+            if membership_frame.startswith(b'{'):
+                self.update_membership(membership_frame)
+            elif self.use_peer_port and int(membership_frame) != self.membership.epoch:
+                logging.warning(f"W: request for membership epoch {int(membership_frame)}, "
+                                f"we have {self.membership.epoch}")
 
-            kv_pairs = list(self.peers_endpoints.items())
-            self.peers_endpoints.clear()
-            for k, v in kv_pairs:
-                new_key: bytes = (k+'.peer').encode('utf8')
-                self.peers_endpoints[new_key] = v
-
-            # Construct the peer port given that the broker provides endpoints of peers
-            if self.peers_endpoints:
-                self.peer_port: PeerPort = PeerPort(
-                    endpoint=self.endpoint,
-                    peer_name=self.worker_name.decode('utf8') + '.peer',
-                    peers=self.peers_endpoints,
-                    verbose=False
-                )
+            # The peer port is set up ahead of the request when the peers were known, or once per request otherwise
+            if self.use_peer_port and not (self.peer_port and self.peer_port_running()):
+                self.peer_port = None
+                self.update_peers()
 
             return actual_msg  # We have a request to process
 
+        elif command == MDP.W_MEMBERSHIP:
+            self.update_membership(msg.pop(0))
+
         elif command == MDP.W_HEARTBEAT:
             # do nothing on the heartbeat
             pass
@@ -251,6 +332,33 @@ class MajorDomoWorker(object):
             logging.error("E: invalid input message: ")
             dump(msg)
 
+    def update_membership(self, frame: bytes):
+        """ Apply a membership update from the broker, and pass the changes on to our peer port """
+        if not self.membership.apply(json.loads(frame)):
+            logging.warning("W: missed a membership update, the broker will resend the membership")
+        if self.use_peer_port:
+            self.update_peers()
+
+    def update_peers(self):
+        """ Peers' endpoints from the membership, given to the peer port -- started here if there isn't one yet """
+        own_name = self.worker_name.decode('utf8')
+        peers_endpoints: Dict[bytes, str] = {(name + '.peer').encode('utf8'): endpoint
+                                             for name, endpoint in self.membership.members.items() if name != own_name}
+        if self.peer_port is not None:
+            # Updated in place, the peer port and the services holding it share the dict
+            self.peers_endpoints.clear()
+            self.peers_endpoints.update(peers_endpoints)
+            return
+
+        self.peers_endpoints = peers_endpoints
+        if self.peers_endpoints:
+            self.peer_port: PeerPort = PeerPort(
+                endpoint=self.endpoint,
+                peer_name=self.worker_name.decode('utf8') + '.peer',
+                peers=self.peers_endpoints,
+                verbose=False
+            )
+
     def peer_port_running(self) -> bool:
         """ True if the peer-port is still running """
         if self.peer_port:
@@ -3,6 +3,7 @@
 C_CLIENT = b"MDPC"
 W_WORKER = b"MDPW"
 A_AGENT = b'MDPA'
+R_ROUTING = b"MDPR"     # prefix of the client routing-header frame, see utils/envelope.py
 
 # MDP/Server commands, as bytes -- these are the base behaviors
 W_READY = b"\001"
@@ -10,13 +11,18 @@ W_REQUEST = b"\002"
 W_REPLY = b"\003"
 W_HEARTBEAT = b"\004"
 W_DISCONNECT = b"\005"
+W_MEMBERSHIP = b"\006"      # broker to worker: changes to its service's peer group, see utils/membership.py
+
+# W_REQUEST leader flag frame
+W_LEADER = b"\001"
+W_FOLLOWER = b"\000"
 
 # Status
 SUCCESS = 'SUCCESS'
 FAIL = 'FAIL'
 TIMEOUT = 'TIMEOUT'
 
-commands = [None, "READY", "REQUEST", "REPLY", "HEARTBEAT", "DISCONNECT"]
+commands = [None, "READY", "REQUEST", "REPLY", "HEARTBEAT", "DISCONNECT", "MEMBERSHIP"]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,146 @@
+"""
+Binary Star primary/backup pair for the broker, after the pattern of the same name in the zguide.
+
+Two brokers run side by side, a primary and a backup. Each publishes its state on a PUB socket every HEARTBEAT ms and
+subscribes to its peer's. The active broker also publishes a delta for every change to its registry and queues:
+    Q   request queued      rid, service, client address, client name, routing header, deadline, request frames
+    R   request removed     rid (dispatched, dropped or expired)
+    W   worker registered   address, service, slots
+    X   worker deleted      address
+    S   snapshot follows    the passive broker clears its shadow, sent whenever the peer (re)appears
+The passive broker applies them to its shadow and ignores clients and workers. Once the active broker has been silent
+for PEER_EXPIRY ms, the first client or worker message to reach the passive broker makes it take over: it adopts the
+shadow queues and workers and carries on from there. Clients and workers given the backup endpoint fail over by
+themselves, see MajorDomoClient and MajorDomoWorker.
+"""
+import logging
+from collections import OrderedDict
+
+import zmq
+
+from auxo_olympus.lib.utils.zhelpers import ensure_is_bytes
+
+PRIMARY = b"1"      # starting up as primary, waiting for the peer
+BACKUP = b"2"       # starting up as backup, waiting for the peer
+ACTIVE = b"3"       # serving clients and workers
+PASSIVE = b"4"      # shadowing the active peer
+STATE_NAMES = {PRIMARY: 'primary', BACKUP: 'backup', ACTIVE: 'active', PASSIVE: 'passive'}
+
+HEARTBEAT = b"H"
+QUEUED = b"Q"
+REMOVED = b"R"
+WORKER_READY = b"W"
+WORKER_DELETED = b"X"
+SNAPSHOT = b"S"
+
+
+class BinaryStar(object):
+    """ State machine and state sockets of one broker of the pair, plus its shadow of the peer's state """
+    HEARTBEAT = 250                 # msecs between state messages
+    PEER_EXPIRY = 2 * HEARTBEAT     # peer is considered dead after this long without a state message
+
+    def __init__(self, ctx, primary: bool, local: str, remote: str):
+        """
+        :param primary: True for the primary broker, False for the backup
+        :param local: endpoint to publish our state and deltas on
+        :param remote: the peer's state endpoint
+        """
+        self.state: bytes = PRIMARY if primary else BACKUP
+        self.peer_state = None
+        self.peer_expiry: float = 0.0
+        self.send_at: float = 0.0
+
+        self.publisher = ctx.socket(zmq.PUB)
+        self.publisher.linger = 0
+        self.publisher.bind(local)
+        self.subscriber = ctx.socket(zmq.SUB)
+        self.subscriber.linger = 0
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+        self.subscriber.connect(remote)
+
+        # Shadow of the active peer
+        self.requests = OrderedDict()   # rid -> frames of its QUEUED delta
+        self.workers = {}               # worker address -> (service, slots)
+
+    @property
+    def active(self) -> bool:
+        return self.state == ACTIVE
+
+    def set_state(self, state: bytes):
+        logging.info(f"I: binary star {STATE_NAMES[self.state]} -> {STATE_NAMES[state]}")
+        self.state = state
+
+    def peer_event(self, peer_state: bytes, now: float) -> bool:
+        """ State message from the peer, True if it has just (re)started and needs a snapshot of our state """
+        fresh = now >= self.peer_expiry or (peer_state != self.peer_state and peer_state in (PRIMARY, BACKUP))
+        self.peer_state = peer_state
+        self.peer_expiry = now + 1e-3*self.PEER_EXPIRY
+
+        if self.state == PRIMARY:
+            if peer_state == BACKUP:
+                self.set_state(ACTIVE)
+            elif peer_state == ACTIVE:
+                self.set_state(PASSIVE)
+        elif self.state == BACKUP:
+            if peer_state == ACTIVE:
+                self.set_state(PASSIVE)
+        elif self.state == ACTIVE:
+            if peer_state == ACTIVE:
+                logging.error("E: binary star: both brokers are active (split brain)")
+        elif self.state == PASSIVE:
+            if peer_state in (PRIMARY, BACKUP):
+                # The peer restarted, we keep serving
+                self.set_state(ACTIVE)
+            elif peer_state == PASSIVE:
+                logging.error("E: binary star: both brokers are passive")
+
+        return fresh and self.state == ACTIVE
+
+    def client_event(self, now: float) -> bool:
+        """ A client or worker message arrived, True if we should serve it """
+        if self.state == ACTIVE:
+            return True
+        if self.state == PRIMARY:
+            # No backup heard from yet, serve on our own
+            self.set_state(ACTIVE)
+            return True
+        if self.state == PASSIVE and now >= self.peer_expiry:
+            # The active peer is gone and clients are turning to us: fail over
+            self.set_state(ACTIVE)
+            return True
+        return False
+
+    def send_state(self, now: float):
+        """ Publish our state if it's time """
+        if now >= self.send_at:
+            self.publisher.send_multipart([HEARTBEAT, self.state])
+            self.send_at = now + 1e-3*self.HEARTBEAT
+
+    def next_send(self) -> float:
+        return self.send_at
+
+    def publish(self, kind: bytes, *frames):
+        """ Publish a delta to the passive peer, only the active broker does """
+        if self.state == ACTIVE:
+            self.publisher.send_multipart(ensure_is_bytes([kind] + list(frames)))
+
+    def apply(self, msg: list):
+        """ Apply a delta from the active peer to the shadow """
+        kind = msg[0]
+        if kind == QUEUED:
+            self.requests[msg[1]] = msg[2:]
+        elif kind == REMOVED:
+            self.requests.pop(msg[1], None)
+        elif kind == WORKER_READY:
+            self.workers[msg[1]] = (msg[2], int(msg[3]))
+        elif kind == WORKER_DELETED:
+            self.workers.pop(msg[1], None)
+        elif kind == SNAPSHOT:
+            self.requests.clear()
+            self.workers.clear()
+        else:
+            logging.error(f"E: binary star: invalid delta {kind}")
+
+    def close(self):
+        self.publisher.close()
+        self.subscriber.close()
@@ -0,0 +1,98 @@
+"""
+Routing header sent by clients ahead of the request body.
+
+The broker only needs a handful of flags to route a request (does it need a group of workers, how many, how urgent),
+so instead of the broker deserializing the whole JSON body to find them the client sends them in a small fixed binary
+frame:
+
+    Frame 0: empty
+    Frame 1: "MDPC"
+    Frame 2: client name
+    Frame 3: service name
+    Frame 4: routing header (RoutingHeader.pack)
+    Frame 5+: request body
+
+Layout (network byte order):
+    4s  magic, MDP.R_ROUTING
+    B   layout version
+    B   flags (bit 0: multiple workers requested)
+    B   priority
+    x   reserved
+    H   group size, the most workers a multiple request is dispatched to, 0 = every idle worker
+    I   deadline, milliseconds from the broker receiving the request, 0 = none. Relative so that broker and client
+        clocks don't have to agree
+    H   min workers, a multiple request is held until this many workers are idle, 0 = any
+    I   assembly timeout, milliseconds a held request waits for min workers before it is failed, 0 = until its deadline
+    16s request id, chosen by the client so the broker can recognise a retried request, zero-padded, all zero = none
+"""
+import json
+import struct
+
+from auxo_olympus.lib.utils import MDP
+
+
+class RoutingHeader(object):
+    VERSION = 4
+    LAYOUT = struct.Struct(">4sBBBxHIHI16s")
+    PREFIX = MDP.R_ROUTING + bytes([VERSION])
+    NO_REQUEST_ID = bytes(16)
+
+    FLAG_MULTIPLE = 0x01
+
+    def __init__(self, multiple=False, priority=0, group_size=0, deadline=0, min_workers=0, assembly_timeout=0,
+                 request_id=b""):
+        self.multiple: bool = bool(multiple)
+        self.priority: int = priority
+        self.group_size: int = group_size
+        self.deadline: int = int(deadline)     # ms
+        self.min_workers: int = min_workers
+        self.assembly_timeout: int = int(assembly_timeout)     # ms
+        if len(request_id) > len(self.NO_REQUEST_ID):
+            raise ValueError(f"request id is {len(request_id)} bytes, at most {len(self.NO_REQUEST_ID)} fit the header")
+        # Padded here so a header and the header it unpacks to carry the same id
+        self.request_id: bytes = request_id.ljust(len(self.NO_REQUEST_ID), b"\0") if request_id else b""
+
+    def __repr__(self):
+        return f"RoutingHeader(multiple={self.multiple}, priority={self.priority}, group_size={self.group_size}, " \
+            f"deadline={self.deadline}, min_workers={self.min_workers}, assembly_timeout={self.assembly_timeout}, " \
+            f"request_id={self.request_id.hex() or None})"
+
+    def pack(self) -> bytes:
+        flags = self.FLAG_MULTIPLE if self.multiple else 0
+        return self.LAYOUT.pack(MDP.R_ROUTING, self.VERSION, flags, self.priority, self.group_size, self.deadline,
+                                self.min_workers, self.assembly_timeout, self.request_id)
+
+    @classmethod
+    def is_header(cls, frame) -> bool:
+        return isinstance(frame, bytes) and frame[:len(MDP.R_ROUTING)] == MDP.R_ROUTING
+
+    @classmethod
+    def is_single(cls, frame: bytes) -> bool:
+        """ True for a header of this version asking for a single worker, read without decoding the rest """
+        return len(frame) == cls.LAYOUT.size and frame[:len(cls.PREFIX)] == cls.PREFIX and \
+            not frame[len(cls.PREFIX)] & cls.FLAG_MULTIPLE
+
+    @classmethod
+    def unpack(cls, frame: bytes):
+        """ Decode a header frame, None if the frame is not a header this version understands """
+        if not cls.is_header(frame) or len(frame) != cls.LAYOUT.size:
+            return None
+        _, version, flags, priority, group_size, deadline, min_workers, assembly_timeout, request_id = \
+            cls.LAYOUT.unpack(frame)
+        if version != cls.VERSION:
+            return None
+        if request_id == cls.NO_REQUEST_ID:
+            request_id = b""
+        return cls(multiple=flags & cls.FLAG_MULTIPLE, priority=priority, group_size=group_size, deadline=deadline,
+                   min_workers=min_workers, assembly_timeout=assembly_timeout, request_id=request_id)
+
+    @classmethod
+    def from_body(cls, body: bytes):
+        """ Compatibility fallback for clients that don't send a header: sniff the flags out of the JSON body """
+        try:
+            request = json.loads(body)
+        except (TypeError, ValueError):
+            return cls()
+        if not isinstance(request, dict):
+            return cls()
+        return cls(multiple=request.get("multiple_bool", False))
@@ -0,0 +1,217 @@
+"""
+Federation of brokers: requests for services a broker has no workers for are forwarded to a peer broker that has.
+
+Every broker binds a ROUTER socket for its peers and connects a DEALER to each peer it is given. Over the DEALER it
+asks the peer for its registry every INTERVAL ms and forwards requests; the peer answers both over its ROUTER:
+    G                                           registry request
+    G  registry                                 answer: json {service name: requests queued}, hosted services only
+    Q  token, service, client name, header, body...     a forwarded request
+    P  token, service, body...                  a reply to it, or a status code, as many as the request gets
+A broker forwards a request for a service without workers of its own to the peer hosting it with the fewest queued
+requests, counting the requests it has forwarded there since the peer last reported, and keeps the token to route
+the replies back to the client. A request's deadline is forwarded as what is left of it, so it can't outlive the
+deadline its client set by hopping brokers. The receiving broker queues the request under a synthetic client address
+that maps back to the forwarding peer and the token, and never forwards it again. Peers that haven't answered for
+EXPIRY ms are left out until they do.
+
+A route, the token on one side and the synthetic address on the other, is kept for as long as its request can be
+answered, however long it waits or runs: a single-worker request's route goes with its reply, a group request's
+ROUTE_TTL secs after its latest reply, as the number of replies isn't known. Unanswered routes go once the request's
+deadline has passed; the forwarding side also drops those without a deadline if their peer stops answering.
+"""
+import json
+import time
+import struct
+import heapq
+import logging
+import itertools
+
+import zmq
+
+from auxo_olympus.lib.utils.envelope import RoutingHeader
+
+REGISTRY = b"G"
+REQUEST = b"Q"
+REPLY = b"P"
+
+TOKEN = struct.Struct(">Q")
+
+
+class Peer(object):
+    """ A peer broker, as seen through our DEALER to it """
+    endpoint = None
+    socket = None
+    services = None     # its registry, service name -> requests queued, empty until it answers
+    expiry = 0.0        # its registry is stale after this
+    forwarded = 0       # requests forwarded to it since its last registry
+
+    def __init__(self, endpoint, socket):
+        self.endpoint: str = endpoint
+        self.socket = socket
+        self.services = {}
+        self.expiry: float = 0.0
+        self.forwarded: int = 0
+
+
+class Federation(object):
+    """ Sockets and routing state of one broker's federation, see the module docstring """
+    INTERVAL = 1000             # msecs between registry requests
+    EXPIRY = 3 * INTERVAL       # a peer's registry is dropped after this long without an answer
+    ROUTE_TTL = 60.0            # secs a group request's route is kept after its latest reply
+
+    def __init__(self, ctx, local: str, peers: list):
+        """
+        :param local: endpoint to bind for our peers
+        :param peers: endpoints of the peers to forward to
+        """
+        self.router = ctx.socket(zmq.ROUTER)
+        self.router.linger = 0
+        self.router.bind(local)
+        self.peers = []
+        for endpoint in peers:
+            socket = ctx.socket(zmq.DEALER)
+            socket.linger = 0
+            socket.connect(endpoint)
+            self.peers.append(Peer(endpoint, socket))
+
+        self.send_at: float = 0.0
+        self.tokens = itertools.count(1)
+        # Routes end with [expires at, None for never, multiple], see set_expiry
+        self.outbound = {}      # token -> [client address, service, peer, expires at, multiple]
+        self.inbound = {}       # synthetic client address -> [peer identity, token, expires at, multiple]
+        self.expiries = []      # heap of (expires at, 0 for outbound or 1 for inbound, key), lazily deleted
+        self.forwarded: int = 0
+        self.received: int = 0
+
+    def next_send(self) -> float:
+        return self.send_at
+
+    def send_registry_requests(self, now: float):
+        """ Ask every peer for its registry if it's time """
+        if now < self.send_at:
+            return
+        for peer in self.peers:
+            self.send(peer.socket, [REGISTRY])
+            if now >= peer.expiry and peer.services:
+                logging.warning(f"W: federation peer {peer.endpoint} stopped answering")
+                peer.services = {}
+                # Nothing else would ever drop the routes of requests without a deadline that went to it
+                for token in [token for token, route in self.outbound.items() if route[2] is peer and route[3] is None]:
+                    del self.outbound[token]
+        self.send_at = now + 1e-3*self.INTERVAL
+
+    @staticmethod
+    def send(socket, frames: list):
+        try:
+            socket.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.Again:
+            logging.warning("W: federation peer not keeping up, dropping message")
+
+    def update_registry(self, peer, registry: bytes, now: float):
+        peer.services = json.loads(registry)
+        peer.expiry = now + 1e-3*self.EXPIRY
+        peer.forwarded = 0
+
+    def pick_peer(self, service: bytes):
+        """ The live peer hosting the service with the fewest queued requests, None if no peer hosts it """
+        name = service.decode("utf8")
+        best, best_load = None, None
+        for peer in self.peers:
+            queued = peer.services.get(name)
+            if queued is None:
+                continue
+            load = queued + peer.forwarded
+            if best is None or load < best_load:
+                best, best_load = peer, load
+        return best
+
+    def forward(self, peer, sender: bytes, service: bytes, client_name: bytes, header, body: list,
+                received: float) -> bool:
+        """
+        Send a client's request on to the peer, remembering where its replies go. The peer restarts the clock on a
+        relative deadline, so it's sent what is left of it after the time the request has spent with us since it was
+        `received`. Returns False, and sends nothing, if there's none left
+        """
+        now = time.time()
+        if header.deadline:
+            header.deadline -= int(1e3*(now - received))
+            if header.deadline <= 0:
+                return False
+        token = TOKEN.pack(next(self.tokens))
+        self.outbound[token] = [sender, service, peer, None, header.multiple]
+        if header.deadline:
+            self.set_expiry(0, token, now + 1e-3*header.deadline)
+        peer.forwarded += 1
+        self.forwarded += 1
+        self.send(peer.socket, [REQUEST, token, service, client_name, header.pack()] + body)
+        return True
+
+    def route_reply(self, msg: list, now: float):
+        """ A peer's reply to a request we forwarded: the client address to pass it to, None if the route is gone """
+        route = self.outbound.get(msg[1])
+        if route is None:
+            return None
+        self.replied(0, msg[1], now)
+        return route[0]
+
+    def accept(self, identity: bytes, token: bytes, header: bytes, now: float) -> bytes:
+        """ A peer forwarded us a request, returns the synthetic client address to queue it under """
+        # Starts with a zero byte like the addresses zmq generates, but longer, so it can't clash with a real client
+        address = b"\0" + identity + b"/" + token
+        header = RoutingHeader.unpack(header)
+        # A header we can't read could be a group request's, its route has to outlive the first reply
+        self.inbound[address] = [identity, token, None, header is None or header.multiple]
+        if header is not None and header.deadline:
+            self.set_expiry(1, address, now + 1e-3*header.deadline)
+        self.received += 1
+        return address
+
+    def is_forwarded(self, address: bytes) -> bool:
+        return address in self.inbound
+
+    def reply(self, address: bytes, frames: list, now: float = None):
+        """ Send a reply (service, body...) to a request a peer forwarded us """
+        route = self.inbound[address]
+        self.replied(1, address, now if now is not None else time.time())
+        self.send(self.router, [route[0], REPLY, route[1]] + frames)
+
+    def set_expiry(self, side: int, key: bytes, at: float):
+        """ Drop the route (0 outbound, 1 inbound) at `at`, replacing any expiry it had """
+        (self.outbound, self.inbound)[side][key][-2] = at
+        heapq.heappush(self.expiries, (at, side, key))
+
+    def replied(self, side: int, key: bytes, now: float):
+        """ A reply went through the route: a single request is done with it, a group may have more replies to come """
+        routes = (self.outbound, self.inbound)[side]
+        if routes[key][-1]:
+            self.set_expiry(side, key, now + self.ROUTE_TTL)
+        else:
+            del routes[key]
+
+    def expire(self, now: float):
+        """ Forget the routes whose deadline, or whose group's last reply's ROUTE_TTL, has passed """
+        while self.expiries and self.expiries[0][0] < now:
+            at, side, key = heapq.heappop(self.expiries)
+            routes = (self.outbound, self.inbound)[side]
+            route = routes.get(key)
+            if route is not None and route[-2] == at:
+                del routes[key]
+
+        # Entries of routes answered or re-armed since are only skipped when they come up, don't let them pile up
+        if len(self.expiries) > 4*(len(self.outbound) + len(self.inbound)) + 64:
+            self.expiries = [(at, side, key) for at, side, key in self.expiries
+                             if (self.outbound, self.inbound)[side].get(key, [None, None])[-2] == at]
+            heapq.heapify(self.expiries)
+
+    def as_dict(self) -> dict:
+        return {
+            'peers': {peer.endpoint: peer.services for peer in self.peers},
+            'forwarded': self.forwarded,
+            'received': self.received,
+            'routes': len(self.outbound) + len(self.inbound),
+        }
+
+    def close(self):
+        self.router.close()
+        for peer in self.peers:
+            peer.socket.close()
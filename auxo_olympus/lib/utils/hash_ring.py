@@ -0,0 +1,64 @@
+"""
+Consistent hash ring, for clients spreading services over a pool of brokers without a central balancer.
+
+Each node is placed on the ring at `replicas` points; a key belongs to the first node clockwise from its hash. Adding
+or removing a node only moves the keys of the arcs it gains or loses, so every client with the same list of brokers
+sends a given service to the same broker, and losing a broker only moves that broker's services.
+"""
+import bisect
+import hashlib
+
+
+def ring_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+
+class HashRing(object):
+
+    def __init__(self, nodes=(), replicas: int = 100):
+        """
+        :param nodes: initial nodes, any str
+        :param replicas: points per node, more spreads the keys more evenly
+        """
+        self.replicas: int = replicas
+        self.points = []        # sorted hashes
+        self.owners = {}        # hash -> node
+        self.nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node: str):
+        self.nodes.append(node)
+        for i in range(self.replicas):
+            point = ring_hash(f"{node}#{i}".encode("utf8"))
+            self.owners[point] = node
+            bisect.insort(self.points, point)
+
+    def remove(self, node: str):
+        self.nodes.remove(node)
+        for i in range(self.replicas):
+            point = ring_hash(f"{node}#{i}".encode("utf8"))
+            del self.owners[point]
+            self.points.remove(point)
+
+    def preference(self, key: bytes) -> list:
+        """ Every node, in the order the key tries them: its owner first, then on around the ring """
+        if not self.points:
+            return []
+        start = bisect.bisect(self.points, ring_hash(key))
+        order = []
+        for i in range(len(self.points)):
+            node = self.owners[self.points[(start + i) % len(self.points)]]
+            if node not in order:
+                order.append(node)
+                if len(order) == len(self.nodes):
+                    break
+        return order
+
+    def get(self, key: bytes):
+        """ The node owning the key, None if the ring is empty """
+        order = self.preference(key)
+        return order[0] if order else None
@@ -0,0 +1,197 @@
+"""
+Write-ahead journal of the requests accepted by the broker, so queued requests survive a crash.
+
+The journal is an append-only, memory-mapped file of records:
+    length (4 bytes), crc32 (4), kind (1), request id (8), payload (length bytes)
+An ACCEPTED record carries the request's frames, a DONE record marks the request as dispatched or dropped. Appending
+is a copy into the map; the map is synced to disk at most every `sync_interval` ms, so one msync covers every record
+appended since the last one (group commit). A crash loses at most the last interval.
+
+When most of the file is taken up by requests that are done, the live records are copied to a fresh file which
+atomically replaces the old one. On open the journal is scanned, stopping at the first torn or empty record, and the
+requests still live are kept in `recovered` for the broker to requeue.
+"""
+import os
+import mmap
+import zlib
+import time
+import struct
+import logging
+
+ACCEPTED = 1
+DONE = 2
+
+
+def pack_frames(frames: list) -> bytes:
+    """ Frames as one payload: their count, their lengths, then the frames themselves """
+    return struct.pack(f">{len(frames) + 1}I", len(frames), *map(len, frames)) + b"".join(frames)
+
+
+def unpack_frames(payload: bytes) -> list:
+    count, = struct.unpack_from(">I", payload)
+    lengths = struct.unpack_from(f">{count}I", payload, 4)
+    offset = 4*(count + 1)
+    frames = []
+    for length in lengths:
+        frames.append(payload[offset:offset + length])
+        offset += length
+    return frames
+
+
+class Journal(object):
+    """ Memory-mapped journal of accepted and completed requests, see the module docstring """
+    RECORD = struct.Struct(">IIBQ")
+    KEY = struct.Struct(">BQ")      # the part of the record header covered by the crc
+
+    def __init__(self, path: str, sync_interval: float = 25, initial_size: int = 1 << 20,
+                 compact_min: int = 64 << 20):
+        """
+        :param path: journal file, created if missing and replayed if not
+        :param sync_interval: most msecs between syncs to disk, 0 to sync after every record
+        :param initial_size: bytes the file starts at, it doubles whenever it fills up
+        :param compact_min: don't compact files smaller than this
+        """
+        self.path = path
+        self.sync_interval: float = sync_interval
+        self.compact_min: int = compact_min
+
+        self.file = open(path, 'a+b')
+        self.size: int = max(os.path.getsize(path), initial_size)
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+        self.offset: int = 0            # where the next record goes
+        self.synced: int = 0            # everything before this is on disk
+        self.live = {}                  # request id -> (offset, length) of its ACCEPTED record, in journal order
+        self.live_bytes: int = 0
+        self.dirty_since = None         # time of the first record not yet synced
+        self.syncs: int = 0
+        self.compactions: int = 0
+
+        self.recovered = self.replay()  # [(request id, frames)] of the requests not done
+
+    def __len__(self):
+        return len(self.live)
+
+    def replay(self) -> list:
+        """ Scan the file, rebuilding the live set, returns the live requests in the order they were accepted """
+        payloads = {}
+        offset = 0
+        while offset + self.RECORD.size <= self.size:
+            length, crc, kind, rid = self.RECORD.unpack_from(self.map, offset)
+            end = offset + self.RECORD.size + length
+            if not kind:
+                break
+            if end > self.size or zlib.crc32(self.map[offset + self.RECORD.size:end], zlib.crc32(
+                    self.KEY.pack(kind, rid))) != crc:
+                logging.warning(f"W: journal {self.path} has a torn record at {offset}, ignoring the rest")
+                break
+
+            if kind == ACCEPTED:
+                self.live[rid] = (offset, end - offset)
+                self.live_bytes += end - offset
+                payloads[rid] = self.map[offset + self.RECORD.size:end]
+            elif kind == DONE and rid in self.live:
+                self.live_bytes -= self.live.pop(rid)[1]
+                del payloads[rid]
+            offset = end
+
+        # Anything past the last good record must not be mistaken for records later
+        self.offset = self.synced = offset
+        self.map[offset:] = bytes(self.size - offset)
+        self.map.flush()
+        return [(rid, unpack_frames(payload)) for rid, payload in payloads.items()]
+
+    def append(self, kind: int, rid: int, payload: bytes = b"") -> int:
+        need = self.RECORD.size + len(payload)
+        if self.offset + need + self.RECORD.size > self.size:
+            self.grow(self.offset + need + self.RECORD.size)
+
+        offset = self.offset
+        crc = zlib.crc32(payload, zlib.crc32(self.KEY.pack(kind, rid)))
+        if payload:
+            self.map[offset + self.RECORD.size:offset + need] = payload
+        self.RECORD.pack_into(self.map, offset, len(payload), crc, kind, rid)
+        self.offset += need
+
+        if self.dirty_since is None:
+            self.dirty_since = time.time()
+        if not self.sync_interval:
+            self.sync()
+        return offset
+
+    def accepted(self, rid: int, frames: list):
+        """ Journal a request the broker has queued """
+        payload = pack_frames(frames)
+        offset = self.append(ACCEPTED, rid, payload)
+        self.live[rid] = (offset, self.RECORD.size + len(payload))
+        self.live_bytes += self.RECORD.size + len(payload)
+
+    def done(self, rid: int):
+        """ Mark a journaled request as dispatched or dropped """
+        entry = self.live.pop(rid, None)
+        if entry is not None:
+            self.live_bytes -= entry[1]
+            self.append(DONE, rid)
+
+    def next_sync(self):
+        """ When the records appended so far are due to be synced, None if there are none """
+        if self.dirty_since is None:
+            return None
+        return self.dirty_since + 1e-3*self.sync_interval
+
+    def sync(self, now: float = None):
+        """ Sync the records appended since the last sync if they are due (all of them if now is None) """
+        if self.dirty_since is None or (now is not None and now < self.next_sync()):
+            return
+        if self.offset > self.compact_min and self.offset > 2*self.live_bytes:
+            self.compact()
+        else:
+            # Only the pages written since the last sync
+            start = self.synced - self.synced % mmap.PAGESIZE
+            self.map.flush(start, self.offset - start)
+        self.synced = self.offset
+        self.dirty_since = None
+        self.syncs += 1
+
+    def grow(self, needed: int):
+        size = self.size
+        while size < needed:
+            size *= 2
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(size)
+        self.size = size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    def compact(self):
+        """ Replace the file with one holding only the live records """
+        compacted = self.path + ".compact"
+        live = {}
+        offset = 0
+        with open(compacted, 'wb') as file:
+            for rid, (start, length) in self.live.items():
+                file.write(self.map[start:start + length])
+                live[rid] = (offset, length)
+                offset += length
+            size = self.size
+            while size > 2*max(offset, self.compact_min):
+                size //= 2
+            file.truncate(size)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(compacted, self.path)
+
+        self.map.close()
+        self.file.close()
+        self.file = open(self.path, 'a+b')
+        self.size = size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.live = live
+        self.offset = offset
+        self.compactions += 1
+
+    def close(self):
+        self.sync()
+        self.map.close()
+        self.file.close()
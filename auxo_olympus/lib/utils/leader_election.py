@@ -0,0 +1,122 @@
+"""
+Leader election strategies for group (multiple_bool) requests.
+
+The leader of a peer group does the aggregation work (SumNums, FederatedLearning), so picking a slow or busy agent
+dominates the group's latency. The broker hands a strategy the group of workers it is about to dispatch to and the
+strategy returns the index of the leader. Workers carry the statistics the strategies read:
+    worker.latency  LatencyStats of the worker's request-to-reply times, kept by the broker
+    worker.load     last load the worker reported in its heartbeat, None if it never did
+"""
+import random
+from abc import ABCMeta, abstractmethod
+
+
+class LeaderStrategy(object, metaclass=ABCMeta):
+    name = None
+
+    @abstractmethod
+    def elect(self, service, group: list) -> int:
+        """ Index into group of the worker that should lead """
+        pass
+
+    def snapshot(self) -> list:
+        """ Frames of the state the strategy keeps across elections, for the broker's snapshot """
+        return []
+
+    def restore(self, frames: list):
+        """ Take back the state from a snapshot's frames """
+        pass
+
+
+class RandomLeader(LeaderStrategy):
+    """ Any worker, at random """
+    name = 'random'
+
+    def elect(self, service, group: list) -> int:
+        return random.randint(0, len(group)-1)
+
+
+class LowestLatencyLeader(LeaderStrategy):
+    """ The worker with the lowest recent request-to-reply latency -- workers without a measurement get tried first """
+    name = 'latency'
+
+    def elect(self, service, group: list) -> int:
+        return min(range(len(group)), key=lambda i: group[i].latency.ewma or 0.0)
+
+
+class LowestLoadLeader(LeaderStrategy):
+    """ The worker reporting the lowest load in its heartbeats, falling back on the fewest requests in flight """
+    name = 'load'
+
+    def elect(self, service, group: list) -> int:
+        def load(i):
+            worker = group[i]
+            return (worker.load if worker.load is not None else 0.0, worker.slots - worker.credit)
+        return min(range(len(group)), key=load)
+
+
+class RoundRobinLeader(LeaderStrategy):
+    """ Takes turns across the service's workers """
+    name = 'round_robin'
+
+    def __init__(self):
+        self.turns = {}     # service name -> elections so far
+
+    def elect(self, service, group: list) -> int:
+        turn = self.turns.get(service.name, 0)
+        self.turns[service.name] = turn + 1
+
+        # Order by name so the rotation doesn't depend on the order workers went idle in
+        order = sorted(range(len(group)), key=lambda i: group[i].worker_name)
+        return order[turn % len(group)]
+
+    def snapshot(self) -> list:
+        frames = []
+        for name, turn in self.turns.items():
+            frames += [name, str(turn).encode("utf8")]
+        return frames
+
+    def restore(self, frames: list):
+        self.turns = {name: int(turn) for name, turn in zip(frames[::2], frames[1::2])}
+
+
+class StickyLeader(LeaderStrategy):
+    """ Keeps the service's previous leader whenever it is part of the group, otherwise elects one with `fallback` """
+    name = 'sticky'
+
+    def __init__(self, fallback: LeaderStrategy = None):
+        self.fallback: LeaderStrategy = fallback or LowestLatencyLeader()
+        self.leaders = {}   # service name -> identity of the last leader
+
+    def elect(self, service, group: list) -> int:
+        previous = self.leaders.get(service.name)
+        for i, worker in enumerate(group):
+            if worker.identity == previous:
+                return i
+
+        index = self.fallback.elect(service, group)
+        self.leaders[service.name] = group[index].identity
+        return index
+
+    def snapshot(self) -> list:
+        frames = []
+        for name, identity in self.leaders.items():
+            frames += [name, identity]
+        return frames
+
+    def restore(self, frames: list):
+        self.leaders = dict(zip(frames[::2], frames[1::2]))
+
+
+STRATEGIES = {strategy.name: strategy for strategy in
+              (RandomLeader, LowestLatencyLeader, LowestLoadLeader, RoundRobinLeader, StickyLeader)}
+
+
+def get_strategy(strategy) -> LeaderStrategy:
+    """ Strategy instance from a name in STRATEGIES, instances are passed through """
+    if isinstance(strategy, LeaderStrategy):
+        return strategy
+    try:
+        return STRATEGIES[strategy]()
+    except KeyError:
+        raise ValueError(f"Unknown leader strategy {strategy}, choose from {list(STRATEGIES)}")
@@ -0,0 +1,117 @@
+"""
+Versioned membership of a service's peer group: which of its workers are up, and where their peer ports are.
+
+Workers used to learn about their peers only from the full endpoints map sent with every request. Instead the broker
+keeps a Membership per service, whose epoch goes up by one with every change (a worker's peer port endpoint seen for
+the first time or changed, a worker leaving), and sends each subscribed worker only what changed since the epoch it
+holds:
+    {"epoch": 7, "since": 5, "joined": {"A01.sumnums": "tcp://..."}, "left": ["A02.sumnums"]}
+or the whole group, with "reset": true, when the worker holds nothing yet, holds an epoch we never had (from before a
+restart) or the changes it is missing are older than the log. Updates go to idle workers with their heartbeats, so a
+worker's peers are known (and its peer port ready) before a request arrives, and in place of the epoch in a request's
+membership frame when the worker is behind. A worker subscribes by reporting the epoch it holds in its heartbeats; the
+broker resends from there if that's older than what it has sent, so a lost update costs a heartbeat interval.
+
+Workers keep a MembershipReplica, which applies the updates.
+"""
+import json
+import itertools
+from collections import deque
+
+
+class Membership(object):
+    """ A service's peer group and the log of its recent changes, kept by the broker """
+
+    def __init__(self, log_size: int = 1024):
+        """
+        :param log_size: most changes kept to send as diffs, a worker further behind gets the whole group
+        """
+        self.epoch: int = 0
+        self.members = {}                   # worker name -> peer port endpoint
+        self.log = deque(maxlen=log_size)   # (epoch, worker name, endpoint or None for a leave), oldest first
+        self.frames = {}                    # epoch a worker holds -> encoded update, for the current epoch
+
+    def __len__(self):
+        return len(self.members)
+
+    def change(self, name: bytes, endpoint):
+        self.epoch += 1
+        self.log.append((self.epoch, name, endpoint))
+        self.frames.clear()
+
+    def join(self, name: bytes, endpoint: bytes) -> bool:
+        """ The worker's peer port is at endpoint, returns whether that's news """
+        if self.members.get(name) == endpoint:
+            return False
+        self.members[name] = endpoint
+        self.change(name, endpoint)
+        return True
+
+    def leave(self, name: bytes) -> bool:
+        if self.members.pop(name, None) is None:
+            return False
+        self.change(name, None)
+        return True
+
+    def update(self, since: int) -> dict:
+        """ What a worker holding epoch `since` is missing, see the module docstring """
+        if 0 < since <= self.epoch and self.log and since >= self.log[0][0] - 1:
+            final = {}
+            for _, name, endpoint in itertools.islice(self.log, since - self.log[0][0] + 1, None):
+                final[name] = endpoint
+            return {
+                'epoch': self.epoch,
+                'since': since,
+                'joined': {name.decode("utf8"): endpoint.decode("utf8")
+                           for name, endpoint in final.items() if endpoint is not None},
+                'left': [name.decode("utf8") for name, endpoint in final.items() if endpoint is None],
+            }
+
+        return {
+            'epoch': self.epoch,
+            'since': 0,
+            'reset': True,
+            'joined': {name.decode("utf8"): endpoint.decode("utf8") for name, endpoint in self.members.items()},
+            'left': [],
+        }
+
+    def update_frame(self, since: int) -> bytes:
+        """ The update encoded, once per epoch and starting point however many workers it is sent to """
+        frame = self.frames.get(since)
+        if frame is None:
+            frame = self.frames[since] = json.dumps(self.update(since)).encode("utf8")
+        return frame
+
+    def as_dict(self) -> dict:
+        return {'epoch': self.epoch, 'members': len(self.members)}
+
+
+class MembershipReplica(object):
+    """ A worker's copy of its service's membership, kept up to date from the broker's updates """
+
+    def __init__(self):
+        self.epoch: int = 0
+        self.members = {}       # worker name -> peer port endpoint, str
+
+    def reset(self):
+        self.epoch = 0
+        self.members = {}
+
+    def apply(self, update: dict) -> bool:
+        """ Apply an update from the broker. False if changes are missing before it, the replica is reset then """
+        if update.get('reset'):
+            self.members = dict(update['joined'])
+            self.epoch = update['epoch']
+            return True
+        if update['epoch'] <= self.epoch:
+            return True     # already have it
+        if update['since'] > self.epoch:
+            self.reset()
+            return False
+
+        # Each name's state as of the update's epoch, the changes between `since` and ours are already in
+        for name in update['left']:
+            self.members.pop(name, None)
+        self.members.update(update['joined'])
+        self.epoch = update['epoch']
+        return True
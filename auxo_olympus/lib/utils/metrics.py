@@ -0,0 +1,118 @@
+"""
+Lightweight counters and histograms kept by the broker and workers -- cheap enough to update on every message
+"""
+
+
+class BatchMetrics(object):
+    """ Sizes of the receive batches drained after each poll wakeup """
+
+    def __init__(self):
+        self.batches: int = 0
+        self.messages: int = 0
+        self.last: int = 0
+        self.max: int = 0
+
+    def record(self, size: int):
+        if not size:
+            return
+        self.batches += 1
+        self.messages += size
+        self.last = size
+        if size > self.max:
+            self.max = size
+
+    @property
+    def mean(self) -> float:
+        return self.messages / self.batches if self.batches else 0.0
+
+    def as_dict(self) -> dict:
+        return {'batches': self.batches, 'messages': self.messages, 'last': self.last, 'max': self.max,
+                'mean': round(self.mean, 2)}
+
+
+class LatencyStats(object):
+    """ Running request-to-reply latency of a worker, in seconds """
+    __slots__ = ('count', 'ewma', 'last', 'min', 'max')
+    ALPHA = 0.2     # weight of the newest sample in the moving average
+
+    def __init__(self):
+        self.count: int = 0
+        self.ewma = None
+        self.last = None
+        self.min = None
+        self.max = None
+
+    def record(self, latency: float):
+        self.count += 1
+        self.last = latency
+        self.ewma = latency if self.ewma is None else self.ALPHA*latency + (1 - self.ALPHA)*self.ewma
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+    def as_dict(self) -> dict:
+        return {'count': self.count, 'ewma': self.ewma, 'last': self.last, 'min': self.min, 'max': self.max}
+
+
+class LatencyHistogram(object):
+    """
+    Latencies in log-linear buckets, in the style of HdrHistogram: exact below 2*SUB_BUCKETS microseconds, then
+    SUB_BUCKETS buckets per power of two, so every bucket is within 1/SUB_BUCKETS of its values. Recording is a couple
+    of integer operations, percentiles are only worked out when asked for
+    """
+    SUB_BITS = 3
+    SUB_BUCKETS = 1 << SUB_BITS
+    MAX_BITS = 40           # ~12 days in microseconds, anything longer goes in the last bucket
+
+    def __init__(self):
+        self.buckets = [0] * ((self.MAX_BITS - self.SUB_BITS + 1) * self.SUB_BUCKETS)
+        self.count: int = 0
+        self.total: int = 0     # microseconds
+        self.min = None
+        self.max = None
+
+    def index(self, value: int) -> int:
+        shift = value.bit_length() - self.SUB_BITS - 1
+        if shift <= 0:
+            return value
+        return min(shift*self.SUB_BUCKETS + (value >> shift), len(self.buckets) - 1)
+
+    def bounds(self, index: int) -> tuple:
+        """ Lowest and highest microsecond value recorded in the bucket """
+        if index < 2*self.SUB_BUCKETS:
+            return index, index
+        shift, top = divmod(index, self.SUB_BUCKETS)
+        shift -= 1
+        top += self.SUB_BUCKETS
+        return top << shift, ((top + 1) << shift) - 1
+
+    def record(self, latency: float):
+        """ Add a latency, in seconds """
+        value = max(0, int(latency*1e6))
+        self.buckets[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction: float):
+        """ Upper bound in microseconds of the bucket holding the given fraction of the samples, None if empty """
+        if not self.count:
+            return None
+        target = max(1, int(fraction*self.count + 0.5))
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return min(self.bounds(index)[1], self.max)
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {'count': self.count, 'min_us': self.min, 'max_us': self.max,
+                'mean_us': round(self.total / self.count, 1) if self.count else None,
+                'p50_us': self.percentile(0.5), 'p90_us': self.percentile(0.9), 'p99_us': self.percentile(0.99),
+                'p999_us': self.percentile(0.999),
+                'buckets': [[*self.bounds(i), count] for i, count in enumerate(self.buckets) if count]}
@@ -0,0 +1,291 @@
+"""
+Per-service queue of client requests held by the broker while no worker is free.
+
+The queue can be bounded. Once `limit` requests are queued the overflow policy decides what happens to the next one:
+    reject       the new request is refused, the broker answers the client with a status reply
+    drop_oldest  the oldest queued request is dropped (and answered) to make room, the new one is refused if there's
+                 none to drop (a limit of 0)
+    spill        requests beyond the limit are appended to a file on disk and read back in order as the queue drains
+
+Requests may carry a `deadline` attribute (absolute time.time(), None for no deadline). Those are also kept in an
+earliest-deadline heap, so requests whose client has given up are dropped by expire() without scanning the queue and,
+with edf=True, requests with a deadline are served earliest-deadline-first ahead of the FIFO ones.
+
+With fair=True the queue is also split per client (`client_name` attribute) within priority levels (`priority`
+attribute, higher first). Levels are served strictly by priority and the clients within a level by deficit round
+robin, each client getting `weights.get(client, 1)` requests per round -- a chatty client can no longer starve the
+others on the same service.
+"""
+import os
+import heapq
+import pickle
+import struct
+import tempfile
+import itertools
+from collections import deque, OrderedDict
+
+REJECT = 'reject'
+DROP_OLDEST = 'drop_oldest'
+SPILL = 'spill'
+OVERFLOW_POLICIES = (REJECT, DROP_OLDEST, SPILL)
+
+
+def check_weights(weights):
+    """ Fair queuing weights must be positive, a client with none would never have its deficit topped up to a turn """
+    for client, weight in (weights or {}).items():
+        if not weight > 0:
+            raise ValueError(f"fair queuing weight of {client!r} is {weight}, weights must be positive")
+
+
+class SpillFile(object):
+    """ FIFO of pickled requests in an append-only file, truncated whenever it has been read to the end """
+    LENGTH = struct.Struct(">I")
+
+    def __init__(self, directory=None, prefix='auxo-spill-'):
+        fd, self.path = tempfile.mkstemp(prefix=prefix, dir=directory)
+        self.file = os.fdopen(fd, 'w+b')
+        self.read_offset: int = 0
+        self.count: int = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, request):
+        data = pickle.dumps(request)
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(self.LENGTH.pack(len(data)) + data)
+        self.count += 1
+
+    def popleft(self):
+        if not self.count:
+            raise IndexError("pop from an empty spill file")
+        self.file.seek(self.read_offset)
+        length, = self.LENGTH.unpack(self.file.read(self.LENGTH.size))
+        request = pickle.loads(self.file.read(length))
+        self.read_offset += self.LENGTH.size + length
+        self.count -= 1
+
+        if not self.count:
+            self.file.truncate(0)
+            self.read_offset = 0
+        return request
+
+    def peek(self) -> list:
+        """ The spilled requests, oldest first, read back without taking them off the file """
+        requests = []
+        offset = self.read_offset
+        for _ in range(self.count):
+            self.file.seek(offset)
+            length, = self.LENGTH.unpack(self.file.read(self.LENGTH.size))
+            requests.append(pickle.loads(self.file.read(length)))
+            offset += self.LENGTH.size + length
+        return requests
+
+    def close(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class FairLevel(object):
+    """ Per-client sub-queues of one priority level, served by deficit round robin """
+
+    def __init__(self):
+        self.clients = OrderedDict()        # client -> deque of entries, in round robin order
+        self.deficits = {}
+
+    def __bool__(self):
+        return bool(self.clients)
+
+    def push(self, client, entry):
+        queue = self.clients.get(client)
+        if queue is None:
+            queue = self.clients[client] = deque()
+            self.deficits[client] = 0.0
+        queue.append(entry)
+
+    def pop(self, weights):
+        """ Next live entry in round robin order, None if the level has none left """
+        while self.clients:
+            client, queue = next(iter(self.clients.items()))
+            while queue and not queue[0][3]:
+                queue.popleft()
+            if not queue:
+                self.drop_client(client)
+                continue
+
+            if self.deficits[client] < 1:
+                # Start of the client's turn, top up its deficit with its quantum
+                self.deficits[client] += weights.get(client, 1)
+                if self.deficits[client] < 1:
+                    self.clients.move_to_end(client)
+                    continue
+
+            self.deficits[client] -= 1
+            entry = queue.popleft()
+            if not queue:
+                self.drop_client(client)
+            elif self.deficits[client] < 1:
+                self.clients.move_to_end(client)
+            return entry
+        return None
+
+    def drop_client(self, client):
+        del self.clients[client]
+        del self.deficits[client]
+
+    def compact(self):
+        for client in list(self.clients):
+            queue = self.clients[client] = deque(e for e in self.clients[client] if e[3])
+            if not queue:
+                self.drop_client(client)
+
+
+class RequestQueue(object):
+    """ FIFO of requests with an optional bound, deadlines and fair queuing, see the module docstring """
+
+    def __init__(self, limit=None, policy=REJECT, spill_dir=None, edf=False, fair=False, weights=None):
+        assert policy in OVERFLOW_POLICIES, f"unknown overflow policy {policy}"
+        check_weights(weights)
+        self.limit = limit
+        self.policy: str = policy
+        self.spill_dir = spill_dir
+        self.edf: bool = edf
+        self.fair: bool = fair
+        self.weights: dict = weights or {}
+
+        # Entries are [deadline, tiebreak, request, queued] and live in the FIFO, the fair levels if fair is set and, if
+        # they have a deadline, in the deadline heap. Taking an entry out through one clears `queued`, the others skip
+        # it when they get to it
+        self.requests = deque()
+        self.levels = {}            # priority -> FairLevel
+        self.deadlines = []
+        self.counter = itertools.count()
+        self.queued: int = 0        # live entries in memory
+
+        self.spilled = None         # SpillFile, created on the first overflow
+        self.dropped: int = 0       # requests refused or dropped on overflow
+        self.expired: int = 0       # requests dropped because their deadline passed
+
+    def __len__(self):
+        return self.queued + (len(self.spilled) if self.spilled else 0)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        """ The requests held in memory, oldest first -- spilled requests are not read back """
+        return (entry[2] for entry in self.requests if entry[3])
+
+    def all_requests(self) -> list:
+        """ Every queued request, oldest first, the spilled ones read back as copies and left on the file """
+        return list(self) + (self.spilled.peek() if self.spilled else [])
+
+    def full(self) -> bool:
+        return self.limit is not None and self.queued >= self.limit
+
+    def push(self, request):
+        """ Add to the in-memory queue, no bound checks """
+        deadline = getattr(request, 'deadline', None)
+        entry = [deadline, next(self.counter), request, True]
+        self.requests.append(entry)
+        if deadline is not None:
+            heapq.heappush(self.deadlines, entry)
+        if self.fair:
+            priority = getattr(request, 'priority', 0)
+            level = self.levels.get(priority)
+            if level is None:
+                level = self.levels[priority] = FairLevel()
+            level.push(getattr(request, 'client_name', None), entry)
+        self.queued += 1
+
+    def take(self, entry):
+        entry[3] = False
+        self.queued -= 1
+        if self.spilled:
+            self.push(self.spilled.popleft())
+
+        # Entries taken through the other structure are skipped lazily, don't let them pile up
+        if len(self.requests) + len(self.deadlines) > 4*self.queued + 64:
+            self.requests = deque(e for e in self.requests if e[3])
+            self.deadlines = [e for e in self.deadlines if e[3]]
+            heapq.heapify(self.deadlines)
+            for level in self.levels.values():
+                level.compact()
+        return entry[2]
+
+    def append(self, request):
+        """ Queue the request, returns the request that could not be kept (refused or dropped), if any """
+        if not self.full():
+            if self.spilled:
+                # keep FIFO order, the in-memory part only refills from the spill file
+                self.spilled.append(request)
+            else:
+                self.push(request)
+            return None
+
+        if self.policy == SPILL:
+            if self.spilled is None:
+                self.spilled = SpillFile(self.spill_dir)
+            self.spilled.append(request)
+            return None
+
+        self.dropped += 1
+        if self.policy == DROP_OLDEST and self.queued:
+            oldest = self.pop_oldest()
+            self.push(request)
+            return oldest
+        return request
+
+    def popleft(self):
+        """
+        Next request to serve: earliest deadline first if edf is set, then by priority and client round robin if fair
+        is set, otherwise the oldest
+        """
+        if self.edf:
+            while self.deadlines:
+                entry = heapq.heappop(self.deadlines)
+                if entry[3]:
+                    return self.take(entry)
+
+        if self.fair:
+            for priority in sorted(self.levels, reverse=True):
+                entry = self.levels[priority].pop(self.weights)
+                if entry is not None:
+                    return self.take(entry)
+                del self.levels[priority]
+        return self.pop_oldest()
+
+    def pop_oldest(self):
+        while self.requests:
+            entry = self.requests.popleft()
+            if entry[3]:
+                return self.take(entry)
+
+        if self.spilled:
+            return self.spilled.popleft()
+        raise IndexError("pop from an empty request queue")
+
+    def next_deadline(self):
+        """ Earliest deadline among the queued requests, None if none have one """
+        while self.deadlines and not self.deadlines[0][3]:
+            heapq.heappop(self.deadlines)
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def expire(self, now):
+        """ Drop the queued requests whose deadline is before now, returns them """
+        expired = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline >= now:
+                break
+            expired.append(self.take(heapq.heappop(self.deadlines)))
+        self.expired += len(expired)
+        return expired
+
+    def close(self):
+        if self.spilled is not None:
+            self.spilled.close()
+            self.spilled = None
@@ -0,0 +1,139 @@
+"""
+Table of the client request ids the broker has seen, so a retried request is coalesced onto the original instead of
+being computed twice.
+
+A client that times out waiting for a reply and resends the request can't tell whether the first one was lost, is
+still queued or is being worked on. When the request carries a client-supplied id (RoutingHeader.request_id) the broker
+keeps an entry for it here, keyed by (service, request id):
+    in flight   the original is queued or with its workers: a resend from another address waits on it, a resend from
+                the original address is ignored since the reply is already on its way there
+    completed   every reply has come back: a resend is answered with the kept replies
+Entries are kept in least recently used order and evicted once there are more than `capacity` of them, or once they
+have seen no activity for `ttl` seconds. An in-flight entry evicted early costs nothing but the coalescing: the retry
+is dispatched again.
+"""
+import time
+from collections import OrderedDict
+
+
+class TrackedRequest(object):
+    """ Entry for one request id """
+    sender = None       # address of the client that sent the original
+    waiters = None      # other client addresses the replies are owed to, the resends of an in-flight request
+    replies = None      # reply bodies received so far
+    expected = None     # replies that complete the request, known once it is dispatched
+    touched = 0.0       # last activity, for the ttl
+
+    def __init__(self, sender, now):
+        self.sender = sender
+        self.waiters = []
+        self.replies = []
+        self.expected = None
+        self.touched: float = now
+
+    @property
+    def completed(self) -> bool:
+        return self.expected is not None and len(self.replies) >= self.expected
+
+
+class RequestTable(object):
+    """ Bounded LRU/TTL table of in-flight and recently completed request ids, see the module docstring """
+
+    def __init__(self, capacity: int = 10000, ttl: float = 60.0):
+        """
+        :param capacity: most request ids kept, least recently used are evicted first
+        :param ttl: seconds an entry is kept after its last activity
+        """
+        self.capacity: int = capacity
+        self.ttl: float = ttl
+        self.entries = OrderedDict()    # (service, request id) -> TrackedRequest, least recently used first
+        self.coalesced: int = 0         # resends that waited on an in-flight original
+        self.replayed: int = 0          # resends answered from the kept replies
+        self.evicted: int = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def touch(self, key, entry, now):
+        entry.touched = now
+        self.entries.move_to_end(key)
+
+    def begin(self, key, sender, now=None) -> TrackedRequest:
+        """ Track a request seen for the first time """
+        entry = TrackedRequest(sender, now if now is not None else time.time())
+        self.entries[key] = entry
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+        return entry
+
+    def resend(self, key, sender, now=None):
+        """
+        A request whose id is already tracked has been sent again. Returns the reply bodies to answer the sender with
+        right away (those received so far), or None if the id isn't tracked and the request should go ahead
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.touch(key, entry, now if now is not None else time.time())
+
+        if entry.completed:
+            self.replayed += 1
+            return list(entry.replies)
+
+        self.coalesced += 1
+        if sender == entry.sender or sender in entry.waiters:
+            # Its replies are already on their way to that address
+            return []
+        entry.waiters.append(sender)
+        return list(entry.replies)
+
+    def dispatched(self, key, replies: int):
+        """ The request has gone out to workers that will send `replies` replies between them """
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.expected = replies
+
+    def reply(self, key, body: list, now=None) -> list:
+        """ A worker replied to the request, returns the waiting addresses the reply is also owed to """
+        entry = self.entries.get(key)
+        if entry is None:
+            return []
+        self.touch(key, entry, now if now is not None else time.time())
+        entry.replies.append(body)
+        waiters = entry.waiters
+        if entry.completed:
+            entry.waiters = []
+        return waiters
+
+    def forget(self, key) -> list:
+        """ The request failed (dropped, expired, its worker died): stop tracking it, returns its waiting addresses """
+        entry = self.entries.pop(key, None)
+        return entry.waiters if entry is not None else []
+
+    def expire(self, now=None) -> int:
+        """ Evict the entries idle for longer than the ttl, returns how many """
+        cutoff = (now if now is not None else time.time()) - self.ttl
+        expired = 0
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry.touched >= cutoff:
+                break
+            del self.entries[key]
+            expired += 1
+        self.evicted += expired
+        return expired
+
+    def as_dict(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'coalesced': self.coalesced,
+            'replayed': self.replayed,
+            'evicted': self.evicted,
+        }
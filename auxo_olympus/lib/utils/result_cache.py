@@ -0,0 +1,83 @@
+"""
+Per-service cache of worker replies, for services whose replies depend only on the request.
+
+The broker answers a request whose body it has seen recently straight from the cache, without waking a worker. Entries
+are keyed by a hash of the service name and the request body, kept in least recently used order, evicted past
+`capacity` entries and ignored once older than `ttl` seconds. A change in the service's workers can change its
+answers, so registering or deleting one of them clears the cache; replies to requests dispatched before the change
+are not stored, see `generation`.
+
+Only requests dispatched to a single worker are cached, a group request's replies depend on the group.
+"""
+import time
+import hashlib
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    """ LRU/TTL cache of one service's replies, see the module docstring """
+
+    def __init__(self, capacity: int = 1000, ttl: float = 60.0):
+        """
+        :param capacity: most replies kept, least recently used are evicted first
+        :param ttl: secs a reply is served from the cache
+        """
+        self.capacity: int = capacity
+        self.ttl: float = ttl
+        self.entries = OrderedDict()    # digest -> (reply body, time stored)
+        self.generation: int = 0        # bumped by every invalidation
+        self.hits: int = 0
+        self.misses: int = 0
+        self.invalidations: int = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def digest(service: bytes, body: list) -> bytes:
+        """ Hash of the service name and the request body frames """
+        h = hashlib.blake2b(digest_size=16)
+        for frame in [service] + body:
+            h.update(len(frame).to_bytes(4, 'big'))
+            h.update(frame)
+        return h.digest()
+
+    def get(self, digest: bytes, now: float = None):
+        """ The cached reply body, None on a miss """
+        entry = self.entries.get(digest)
+        if entry is not None:
+            reply, stored = entry
+            if (now if now is not None else time.time()) - stored <= self.ttl:
+                self.entries.move_to_end(digest)
+                self.hits += 1
+                return reply
+            del self.entries[digest]
+        self.misses += 1
+        return None
+
+    def key(self, digest: bytes):
+        """ What a request dispatched now remembers to store its reply with `put` """
+        return self.generation, digest
+
+    def put(self, key, reply: list, now: float = None):
+        """ Store a reply, unless the cache was invalidated since the request was dispatched """
+        generation, digest = key
+        if generation != self.generation:
+            return
+        self.entries[digest] = (reply, now if now is not None else time.time())
+        self.entries.move_to_end(digest)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def invalidate(self):
+        self.entries.clear()
+        self.generation += 1
+        self.invalidations += 1
+
+    def as_dict(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,63 @@
+"""
+Snapshots of the broker's registry, so a restarted broker picks up where it left off instead of starting empty.
+
+A planned restart (an upgrade) used to drop every worker: their next heartbeat reached a broker that didn't know them,
+which disconnected them, and the whole fleet reconnected at once. The broker now writes its registry every
+`snapshot_interval` ms and on shutdown, and reads it back on startup. The file is
+    magic (4 bytes), version (1), crc32 of the body (4), body
+where the body is a list of records packed like the journal's frames (see utils/journal.py), each record a list of
+frames starting with its kind:
+    W   worker      address, service, slots, peer port endpoint, load, subscribed to membership, latency stats
+    L   leader      strategy name, the strategy's own state (see LeaderStrategy.snapshot)
+    Q   request     rid, then the frames the journal keeps for a queued request
+It is written to a temporary file and renamed over the previous snapshot, so a crash while writing leaves the previous
+one in place. A snapshot that is missing, torn or of another version is ignored: the broker starts empty.
+"""
+import os
+import zlib
+import struct
+import logging
+
+from auxo_olympus.lib.utils.journal import pack_frames, unpack_frames
+
+MAGIC = b"AXSN"
+VERSION = 1
+HEADER = struct.Struct(">4sBI")
+
+WORKER = b"W"
+LEADER = b"L"
+QUEUED = b"Q"
+
+
+def save(path: str, records: list):
+    """ Write the records (lists of frames) as the snapshot at path, replacing the previous one """
+    body = pack_frames([pack_frames(record) for record in records])
+    partial = path + ".partial"
+    with open(partial, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, zlib.crc32(body)))
+        file.write(body)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(partial, path)
+
+
+def load(path: str) -> list:
+    """ The records of the snapshot at path, [] if there is none or it can't be read """
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        return []
+
+    if len(data) < HEADER.size:
+        logging.warning(f"W: snapshot {path} is truncated, ignoring it")
+        return []
+    magic, version, crc = HEADER.unpack_from(data)
+    body = data[HEADER.size:]
+    if magic != MAGIC or version != VERSION:
+        logging.warning(f"W: {path} is not a version {VERSION} snapshot, ignoring it")
+        return []
+    if zlib.crc32(body) != crc:
+        logging.warning(f"W: snapshot {path} is corrupt, ignoring it")
+        return []
+    return [unpack_frames(record) for record in unpack_frames(body)]
@@ -82,6 +82,19 @@ def ensure_is_bytes(msg):
     return out
 
 
+SNDMORE = int(zmq.SNDMORE)
+
+
+def send_frames(socket, frames: list):
+    """
+    send_multipart for frames that are already bytes: one send per frame with plain int flags, skipping its type
+    checks and enum flag arithmetic, which cost more than the sends themselves for small messages
+    """
+    last = len(frames) - 1
+    for i, frame in enumerate(frames):
+        socket.send(frame, SNDMORE if i < last else 0)
+
+
 def strip_of_bytes(input_dict: dict):
     for key in input_dict.keys():
 
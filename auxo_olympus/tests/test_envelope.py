@@ -0,0 +1,43 @@
+import unittest
+
+from auxo_olympus.lib.utils.envelope import RoutingHeader
+
+
+class TestRoutingHeader(unittest.TestCase):
+
+    def test_round_trip(self):
+        frame = RoutingHeader(multiple=True, priority=3, group_size=12, deadline=2500, min_workers=4,
+                              assembly_timeout=500).pack()
+        self.assertEqual(len(frame), RoutingHeader.LAYOUT.size)
+
+        header = RoutingHeader.unpack(frame)
+        self.assertTrue(header.multiple)
+        self.assertEqual(header.priority, 3)
+        self.assertEqual(header.group_size, 12)
+        self.assertEqual(header.deadline, 2500)
+        self.assertEqual((header.min_workers, header.assembly_timeout), (4, 500))
+
+    def test_request_id(self):
+        header = RoutingHeader.unpack(RoutingHeader(request_id=b"job-1").pack())
+        self.assertEqual(header.request_id, RoutingHeader(request_id=b"job-1").request_id)
+        self.assertEqual(RoutingHeader.unpack(RoutingHeader().pack()).request_id, b"")
+        with self.assertRaises(ValueError):
+            RoutingHeader(request_id=bytes(17))
+
+    def test_body_is_not_a_header(self):
+        self.assertIsNone(RoutingHeader.unpack(b'{"multiple_bool": 1}'))
+
+    def test_is_single(self):
+        self.assertTrue(RoutingHeader.is_single(RoutingHeader(priority=2, request_id=b"job-1").pack()))
+        self.assertFalse(RoutingHeader.is_single(RoutingHeader(multiple=True).pack()))
+        self.assertFalse(RoutingHeader.is_single(RoutingHeader().pack()[:-1]))
+        self.assertFalse(RoutingHeader.is_single(b'{"target": 10}'))
+
+    def test_from_body(self):
+        self.assertTrue(RoutingHeader.from_body(b'{"multiple_bool": 1}').multiple)
+        self.assertFalse(RoutingHeader.from_body(b'{"target": 10}').multiple)
+        self.assertFalse(RoutingHeader.from_body(b'not json').multiple)
+
+
+if __name__ == '__main__':
+    unittest.main()
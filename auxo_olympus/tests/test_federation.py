@@ -0,0 +1,163 @@
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import zmq
+
+from auxo_olympus.lib.utils import MDP
+from auxo_olympus.lib.utils.envelope import RoutingHeader
+from auxo_olympus.lib.utils.federation import Federation, Peer
+from auxo_olympus.lib.entities.mdbroker import MajorDomoBroker
+
+
+class TestFederation(unittest.TestCase):
+
+    def test_pick_least_loaded_peer(self):
+        ctx = zmq.Context()
+        fed = Federation(ctx, "inproc://test-federation", [])
+        busy, idle, other = (Peer(f"inproc://{name}", None) for name in ("busy", "idle", "other"))
+        fed.peers = [busy, idle, other]
+        fed.update_registry(busy, b'{"echo": 5}', time.time())
+        fed.update_registry(idle, b'{"echo": 1}', time.time())
+        fed.update_registry(other, b'{"sumnums": 0}', time.time())
+
+        self.assertIs(fed.pick_peer(b"echo"), idle)
+        self.assertIs(fed.pick_peer(b"sumnums"), other)
+        self.assertIsNone(fed.pick_peer(b"nope"))
+        # Requests forwarded since the last registry count against the peer
+        idle.forwarded = 5
+        self.assertIs(fed.pick_peer(b"echo"), busy)
+        fed.router.close()
+        ctx.term()
+
+    def test_forward_sends_remaining_deadline(self):
+        ctx = zmq.Context()
+        fed = Federation(ctx, "inproc://test-federation", [])
+        receiver = ctx.socket(zmq.ROUTER)
+        receiver.bind("inproc://test-peer")
+        socket = ctx.socket(zmq.DEALER)
+        socket.connect("inproc://test-peer")
+        peer = Peer("inproc://test-peer", socket)
+
+        # 300 ms of a 1000 ms deadline were spent here, the peer gets the rest
+        sent = fed.forward(peer, b"client", b"echo", b"C01", RoutingHeader(deadline=1000), [b"{}"], time.time() - 0.3)
+        self.assertTrue(sent)
+        self.assertTrue(receiver.poll(1000))
+        header = RoutingHeader.unpack(receiver.recv_multipart()[5])
+        self.assertTrue(600 < header.deadline <= 700)
+
+        # Nothing left, nothing forwarded
+        sent = fed.forward(peer, b"client", b"echo", b"C01", RoutingHeader(deadline=100), [b"{}"], time.time() - 0.3)
+        self.assertFalse(sent)
+        self.assertEqual(fed.forwarded, 1)
+        self.assertFalse(receiver.poll(50))
+
+        for closing in (socket, receiver, fed.router):
+            closing.close()
+        ctx.term()
+
+    def test_routes_kept_until_answered_or_deadline(self):
+        ctx = zmq.Context()
+        fed = Federation(ctx, "inproc://test-federation", [])
+        now = time.time()
+        slow = fed.accept(b"peer", b"t1", RoutingHeader(deadline=100000).pack(), now)
+        late = fed.accept(b"peer", b"t2", RoutingHeader(deadline=1000).pack(), now)
+        group = fed.accept(b"peer", b"t3", RoutingHeader(multiple=True).pack(), now)
+
+        # Long past the idle TTL, only the request whose deadline has passed loses its route
+        fed.expire(now + 1.5*Federation.ROUTE_TTL)
+        self.assertTrue(fed.is_forwarded(slow))
+        self.assertFalse(fed.is_forwarded(late))
+        self.assertTrue(fed.is_forwarded(group))
+
+        # A single request's route goes with its reply, a group's once its replies have stopped for ROUTE_TTL
+        fed.reply(slow, [b"echo", b"done"], now)
+        self.assertFalse(fed.is_forwarded(slow))
+        fed.reply(group, [b"echo", b"done"], now)
+        fed.expire(now + 0.5*Federation.ROUTE_TTL)
+        self.assertTrue(fed.is_forwarded(group))
+        fed.expire(now + 2*Federation.ROUTE_TTL)
+        self.assertFalse(fed.is_forwarded(group))
+        fed.router.close()
+        ctx.term()
+
+
+class TestFederatedBrokers(unittest.TestCase):
+    """ Three federated brokers on their own threads, talking over ipc """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        names = ("A", "B", "C")
+        self.endpoints = {name: f"ipc://{self.directory}/{name}.ipc" for name in names}
+        federation = {name: f"ipc://{self.directory}/{name}-federation.ipc" for name in names}
+        self.brokers = {}
+        for name in names:
+            broker = MajorDomoBroker(federation_local=federation[name],
+                                     federation_peers=[federation[peer] for peer in names if peer != name])
+            broker.bind(self.endpoints[name])
+            self.brokers[name] = broker
+        self.threads = [threading.Thread(target=broker.run, daemon=True) for broker in self.brokers.values()]
+        for thread in self.threads:
+            thread.start()
+        self.ctx = zmq.Context()
+
+    def tearDown(self):
+        self.ctx.destroy(0)
+        for broker in self.brokers.values():
+            broker.stop()
+        for thread in self.threads:
+            thread.join()
+        for broker in self.brokers.values():
+            broker.cleanup()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def connect(self, broker, identity):
+        socket = self.ctx.socket(zmq.DEALER)
+        socket.linger = 0
+        socket.identity = identity
+        socket.connect(self.endpoints[broker])
+        return socket
+
+    def wait_for_registry(self, broker, service, timeout=5.0):
+        deadline = time.time() + timeout
+        while self.brokers[broker].federation.pick_peer(service) is None:
+            self.assertLess(time.time(), deadline, "registry never arrived")
+            time.sleep(0.05)
+
+    def test_request_forwarded_to_hosting_peer(self):
+        worker = self.connect("C", b"A01.echo")
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"echo"])
+        self.wait_for_registry("A", b"echo")
+
+        client = self.connect("A", b"C01")
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"echo", b'{"n": 1}'])
+        self.assertTrue(worker.poll(2000))
+        msg = worker.recv_multipart()
+        self.assertEqual(msg[-1], b'{"n": 1}')
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, msg[-3], b"", b'"done"'])
+
+        self.assertTrue(client.poll(2000))
+        self.assertEqual(client.recv_multipart(), [b"", MDP.C_CLIENT, b"echo", b'"done"'])
+        self.assertEqual(self.brokers["A"].federation.forwarded, 1)
+        self.assertEqual(self.brokers["C"].federation.received, 1)
+        self.assertEqual(len(self.brokers["B"].services), 0)
+
+    def test_local_workers_preferred(self):
+        remote = self.connect("B", b"A01.echo")
+        remote.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"echo"])
+        self.wait_for_registry("A", b"echo")
+        local = self.connect("A", b"A02.echo")
+        local.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"echo"])
+        time.sleep(0.1)
+
+        client = self.connect("A", b"C01")
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"echo", json.dumps({"n": 2}).encode()])
+        self.assertTrue(local.poll(2000))
+        self.assertFalse(remote.poll(100))
+
+
+if __name__ == '__main__':
+    unittest.main()
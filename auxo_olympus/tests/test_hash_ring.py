@@ -0,0 +1,31 @@
+import unittest
+
+from auxo_olympus.lib.utils.hash_ring import HashRing
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_preference_covers_every_node(self):
+        ring = HashRing(["tcp://a", "tcp://b", "tcp://c"])
+        order = ring.preference(b"echo")
+        self.assertEqual(sorted(order), ["tcp://a", "tcp://b", "tcp://c"])
+        self.assertEqual(ring.get(b"echo"), order[0])
+        self.assertIsNone(HashRing().get(b"echo"))
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        ring = HashRing(["tcp://a", "tcp://b", "tcp://c"])
+        keys = [f"service-{i}".encode() for i in range(300)]
+        before = {key: ring.get(key) for key in keys}
+        self.assertEqual(set(before.values()), {"tcp://a", "tcp://b", "tcp://c"})
+
+        ring.remove("tcp://b")
+        for key in keys:
+            if before[key] != "tcp://b":
+                self.assertEqual(ring.get(key), before[key])
+            else:
+                # Falls to the next node in its preference order
+                self.assertEqual(ring.get(key), HashRing(["tcp://a", "tcp://b", "tcp://c"]).preference(key)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from auxo_olympus.lib.utils.journal import Journal, pack_frames, unpack_frames
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "broker.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_frames_round_trip(self):
+        frames = [b"echo", b"", b'{"n": 1}']
+        self.assertEqual(unpack_frames(pack_frames(frames)), frames)
+
+    def test_replay_keeps_requests_not_done(self):
+        journal = Journal(self.path, initial_size=4096)
+        for rid in range(1, 4):
+            journal.accepted(rid, [b"echo", str(rid).encode("utf8")])
+        journal.done(2)
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertEqual(journal.recovered, [(1, [b"echo", b"1"]), (3, [b"echo", b"3"])])
+        journal.accepted(4, [b"echo", b"4"])
+        journal.close()
+        self.assertEqual([rid for rid, _ in Journal(self.path).recovered], [1, 3, 4])
+
+    def test_torn_record_ignored(self):
+        journal = Journal(self.path, initial_size=4096)
+        journal.accepted(1, [b"echo", b"1"])
+        torn = journal.offset
+        journal.accepted(2, [b"echo", b"2"])
+        journal.map[torn + Journal.RECORD.size] ^= 0xff       # corrupt the second record's payload
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertEqual([rid for rid, _ in journal.recovered], [1])
+        self.assertEqual(journal.offset, torn)
+
+    def test_grows_and_compacts(self):
+        journal = Journal(self.path, initial_size=1024, compact_min=4096)
+        for rid in range(1, 500):
+            journal.accepted(rid, [b"echo", b"x"*32])
+            if rid != 7:
+                journal.done(rid)
+        self.assertGreater(journal.size, 1024)
+        journal.sync()
+        self.assertEqual(journal.compactions, 1)
+        self.assertEqual(journal.offset, journal.live_bytes)
+        journal.close()
+
+        self.assertEqual([rid for rid, _ in Journal(self.path).recovered], [7])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from auxo_olympus.lib.utils.metrics import LatencyStats
+from auxo_olympus.lib.utils.leader_election import (
+    get_strategy, LowestLatencyLeader, LowestLoadLeader, RoundRobinLeader, StickyLeader
+)
+
+
+class FakeService(object):
+    def __init__(self, name=b"sumnums"):
+        self.name = name
+
+
+class FakeWorker(object):
+    def __init__(self, name, latency=None, load=None):
+        self.identity = name
+        self.worker_name = name
+        self.latency = LatencyStats()
+        if latency is not None:
+            self.latency.record(latency)
+        self.load = load
+        self.slots = 1
+        self.credit = 1
+
+
+class TestLeaderElection(unittest.TestCase):
+
+    def setUp(self):
+        self.service = FakeService()
+
+    def test_lowest_latency(self):
+        group = [FakeWorker(b"A01", latency=0.5), FakeWorker(b"A02", latency=0.1), FakeWorker(b"A03", latency=0.3)]
+        self.assertEqual(LowestLatencyLeader().elect(self.service, group), 1)
+
+    def test_lowest_load(self):
+        group = [FakeWorker(b"A01", load=0.9), FakeWorker(b"A02", load=0.2)]
+        self.assertEqual(LowestLoadLeader().elect(self.service, group), 1)
+
+    def test_round_robin(self):
+        group = [FakeWorker(b"A02"), FakeWorker(b"A01")]
+        strategy = RoundRobinLeader()
+        leaders = [group[strategy.elect(self.service, group)].worker_name for _ in range(3)]
+        self.assertEqual(leaders, [b"A01", b"A02", b"A01"])
+
+    def test_sticky(self):
+        a01, a02, a03 = FakeWorker(b"A01", latency=0.1), FakeWorker(b"A02", latency=0.2), FakeWorker(b"A03")
+        strategy = StickyLeader()
+        self.assertEqual(strategy.elect(self.service, [a02, a01]), 1)
+        self.assertEqual(strategy.elect(self.service, [a01, a02]), 0)
+        # leader missing from the group, elect a new one with the fallback
+        self.assertEqual(strategy.elect(self.service, [a02, a03]), 1)
+
+    def test_snapshot_restore(self):
+        group = [FakeWorker(b"A02", latency=0.1), FakeWorker(b"A01", latency=0.2)]
+        for strategy_class in (RoundRobinLeader, StickyLeader):
+            strategy = strategy_class()
+            strategy.elect(self.service, group)
+            restored = strategy_class()
+            restored.restore(strategy.snapshot())
+            self.assertEqual(restored.elect(self.service, group), strategy.elect(self.service, group))
+        self.assertEqual(LowestLoadLeader().snapshot(), [])
+
+    def test_get_strategy(self):
+        self.assertIsInstance(get_strategy('load'), LowestLoadLeader)
+        with self.assertRaises(ValueError):
+            get_strategy('nope')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,949 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+
+import zmq
+
+from auxo_olympus.lib.utils import MDP, bstar
+from auxo_olympus.lib.utils.envelope import RoutingHeader
+from auxo_olympus.lib.utils.request_queue import DROP_OLDEST, SPILL
+from auxo_olympus.lib.utils.leader_election import get_strategy
+from auxo_olympus.lib.entities.mdbroker import MajorDomoBroker, WorkerQueue, Worker
+from auxo_olympus.lib.entities.mdwrkapi import MajorDomoWorker
+
+ENDPOINT = "inproc://test-broker"
+
+
+class BrokerTestCase(unittest.TestCase):
+    """ Drives a broker over inproc sockets one message at a time, without running its main loop """
+
+    def setUp(self):
+        self.broker = MajorDomoBroker()
+        self.broker.bind(ENDPOINT)
+        self.sockets = []
+
+    def tearDown(self):
+        for socket in self.sockets:
+            socket.close(0)
+        self.broker.cleanup()
+
+    def connect(self, identity=None):
+        socket = self.broker.ctx.socket(zmq.DEALER)
+        socket.linger = 0
+        if identity:
+            socket.identity = identity
+        socket.connect(ENDPOINT)
+        self.sockets.append(socket)
+        return socket
+
+    def pump(self, timeout=50):
+        """ Let the broker process everything waiting on its socket """
+        while self.broker.socket.poll(timeout):
+            self.broker.recv_batch()
+
+    def add_worker(self, identity, service=b"echo", slots=None):
+        worker = self.connect(identity)
+        ready = [b"", MDP.W_WORKER, MDP.W_READY, service]
+        if slots is not None:
+            ready.append(str(slots).encode("utf8"))
+        worker.send_multipart(ready)
+        self.pump()
+        return worker
+
+    def add_client(self, name=b"C01"):
+        return self.connect(name)
+
+    def request(self, client, service, body, name=b"C01", header=None):
+        frames = [b"", MDP.C_CLIENT, name, service]
+        if header is not None:
+            frames.append(header.pack())
+        client.send_multipart(frames + [json.dumps(body).encode("utf8")])
+        self.pump()
+
+    @staticmethod
+    def recv(socket, timeout=500):
+        assert socket.poll(timeout), "nothing received"
+        return socket.recv_multipart()
+
+
+class TestMajorDomoBroker(BrokerTestCase):
+
+    def test_worker_registration(self):
+        self.add_worker(b"A01.echo")
+        self.assertIn(b"echo", self.broker.services)
+        # Keyed on the routing id, names parsed once
+        worker = self.broker.workers[b"A01.echo"]
+        self.assertEqual((worker.agent_name, worker.service_name), (b"A01", b"echo"))
+        self.assertFalse(hasattr(worker, '__dict__'))
+        self.assertEqual(len(self.broker.waiting), 1)
+        self.assertEqual(len(self.broker.services[b"echo"].waiting), 1)
+
+    def test_request_reply(self):
+        worker = self.add_worker(b"A01.echo")
+        client = self.add_client()
+        self.request(client, b"echo", {"hello": "world"})
+
+        msg = self.recv(worker)
+        self.assertEqual(msg[:3], [b"", MDP.W_WORKER, MDP.W_REQUEST])
+        client_addr = msg[-3]
+        self.assertEqual(json.loads(msg[-1]), {"hello": "world"})
+        self.assertEqual(len(self.broker.waiting), 0)
+
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, client_addr, b"", b'"done"'])
+        self.pump()
+
+        reply = self.recv(client)
+        self.assertEqual(reply, [b"", MDP.C_CLIENT, b"echo", b'"done"'])
+        self.assertEqual(len(self.broker.waiting), 1)
+
+    def test_request_queued_until_worker_ready(self):
+        client = self.add_client()
+        self.request(client, b"echo", {"n": 1})
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 1)
+
+        worker = self.add_worker(b"A01.echo")
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 0)
+        self.assertEqual(self.recv(worker)[2], MDP.W_REQUEST)
+
+    def test_purge_expired_worker(self):
+        self.add_worker(b"A01.echo")
+        worker = self.broker.workers[next(iter(self.broker.workers))]
+        worker.expiry = time.time() - 1
+        self.broker.expiries.push(worker)
+        self.broker.purge_workers()
+        self.assertEqual(len(self.broker.waiting), 0)
+        self.assertEqual(len(self.broker.workers), 0)
+
+    def test_heartbeat_postpones_purge(self):
+        self.add_worker(b"A01.echo")
+        self.add_worker(b"A02.echo")
+        first, second = self.broker.workers.values()
+        first.expiry = second.expiry = time.time() - 1
+        self.broker.expiries.push(first)
+        self.broker.expiries.push(second)
+
+        # A heartbeat from the first worker supersedes its stale expiry
+        self.sockets[0].send_multipart([b"", MDP.W_WORKER, MDP.W_HEARTBEAT, b"tcp://127.0.0.1:5560"])
+        self.pump()
+        self.broker.purge_workers()
+        self.assertEqual(list(self.broker.workers.values()), [first])
+
+    def test_busy_worker_not_purged(self):
+        worker = self.add_worker(b"A01.echo")
+        client = self.add_client()
+        self.request(client, b"echo", {"n": 1})
+        self.recv(worker)
+
+        busy = next(iter(self.broker.workers.values()))
+        busy.expiry = time.time() - 1
+        self.broker.purge_workers()
+        self.assertIn(busy.identity, self.broker.workers)
+
+    def test_idle_worker_disconnect(self):
+        self.add_worker(b"A01.echo")
+        worker = self.add_worker(b"A02.echo")
+        self.add_worker(b"A03.echo")
+
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_DISCONNECT])
+        self.pump()
+        names = [w.worker_name for w in self.broker.services[b"echo"].waiting]
+        self.assertEqual(names, [b"A01.echo", b"A03.echo"])
+        self.assertEqual(len(self.broker.waiting), 2)
+
+    def test_routing_header_group(self):
+        workers = [self.add_worker(f"A0{i}.sumnums".encode("utf8"), b"sumnums") for i in range(3)]
+        client = self.add_client()
+        self.request(client, b"sumnums", {"target": 10}, header=RoutingHeader(multiple=True, group_size=2))
+
+        received = [w for w in workers if w.poll(100)]
+        self.assertEqual(len(received), 2)
+        leaders = [w.recv_multipart()[3] for w in received]
+        self.assertEqual(sorted(leaders), [MDP.W_FOLLOWER, MDP.W_LEADER])
+        # the header is not forwarded to the workers
+        self.assertEqual(len(self.broker.waiting), 1)
+
+    def test_routing_flags_sniffed_from_body(self):
+        workers = [self.add_worker(f"A0{i}.sumnums".encode("utf8"), b"sumnums") for i in range(2)]
+        client = self.add_client()
+        self.request(client, b"sumnums", {"target": 10, "multiple_bool": 1})
+        for worker in workers:
+            msg = self.recv(worker)
+            self.assertEqual(json.loads(msg[-1]), {"target": 10, "multiple_bool": 1})
+
+    def test_membership_versioned(self):
+        workers = [self.add_worker(f"A0{i}.sumnums".encode("utf8"), b"sumnums") for i in range(2)]
+        for i, worker in enumerate(workers):
+            worker.send_multipart([b"", MDP.W_WORKER, MDP.W_HEARTBEAT, f"tcp://127.0.0.1:556{i}".encode("utf8")])
+        self.pump()
+
+        membership = self.broker.services[b"sumnums"].membership
+        self.assertEqual(membership.epoch, 2)
+        self.assertEqual(membership.members, {b"A00.sumnums": b"tcp://127.0.0.1:5560",
+                                              b"A01.sumnums": b"tcp://127.0.0.1:5561"})
+
+        # An unchanged endpoint is no change, a disconnect is
+        workers[0].send_multipart([b"", MDP.W_WORKER, MDP.W_HEARTBEAT, b"tcp://127.0.0.1:5560"])
+        self.pump()
+        self.assertEqual(membership.epoch, 2)
+        workers[1].send_multipart([b"", MDP.W_WORKER, MDP.W_DISCONNECT])
+        self.pump()
+        self.assertEqual(membership.epoch, 3)
+        self.assertEqual(membership.update(2), {'epoch': 3, 'since': 2, 'joined': {}, 'left': ["A01.sumnums"]})
+
+    def test_membership_sent_to_subscribed_workers(self):
+        # Heartbeats carrying an epoch subscribe the worker to its service's membership
+        workers = [self.add_worker(f"A0{i}.sumnums".encode("utf8"), b"sumnums") for i in range(2)]
+        for i, worker in enumerate(workers):
+            worker.send_multipart([b"", MDP.W_WORKER, MDP.W_HEARTBEAT, f"tcp://127.0.0.1:556{i}".encode("utf8"),
+                                   b"0.0", b"0"])
+        self.pump()
+
+        # Idle workers get the update they're behind by with their heartbeat
+        self.broker.heartbeat_at = 0
+        self.broker.send_heartbeats()
+        msg = self.recv(workers[0])
+        self.assertEqual(msg[2], MDP.W_MEMBERSHIP)
+        update = json.loads(msg[3])
+        self.assertEqual((update['epoch'], update.get('reset')), (2, True))
+        self.assertEqual(update['joined'], {"A00.sumnums": "tcp://127.0.0.1:5560", "A01.sumnums": "tcp://127.0.0.1:5561"})
+        self.assertEqual(self.recv(workers[0])[2], MDP.W_HEARTBEAT)
+
+        self.assertEqual([self.recv(workers[1])[2] for _ in range(2)], [MDP.W_MEMBERSHIP, MDP.W_HEARTBEAT])
+
+        # A request to a worker behind carries the diff, to an unsubscribed one only the epoch
+        unsubscribed = self.add_worker(b"A02.sumnums", b"sumnums")
+        unsubscribed.send_multipart([b"", MDP.W_WORKER, MDP.W_HEARTBEAT, b"tcp://127.0.0.1:5562"])
+        self.pump()
+        client = self.add_client()
+        for i in range(3):
+            self.request(client, b"sumnums", {"n": i})
+        diff = {'epoch': 3, 'since': 2, 'joined': {"A02.sumnums": "tcp://127.0.0.1:5562"}, 'left': []}
+        self.assertEqual([json.loads(self.recv(worker)[4]) for worker in workers], [diff, diff])
+        self.assertEqual(self.recv(unsubscribed)[4], b"3")
+        self.assertEqual([w.epoch for w in self.broker.workers.values()], [3, 3, None])
+
+    def test_recv_batch_budget(self):
+        self.add_worker(b"A01.echo")
+        client = self.add_client()
+        for i in range(5):
+            client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"echo", RoutingHeader().pack(), b'{}'])
+        time.sleep(0.1)
+
+        self.broker.batch_budget = 3
+        self.assertEqual(self.broker.recv_batch(), 3)
+        self.assertEqual(self.broker.recv_batch(), 2)
+        self.assertEqual(self.broker.recv_batch(), 0)
+        self.assertEqual(self.broker.batch_metrics.as_dict()['max'], 3)
+        self.assertEqual(self.broker.batch_metrics.messages, 6)      # the READY was pumped one at a time
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 4)
+
+    def test_single_request_goes_to_one_worker(self):
+        workers = [self.add_worker(f"A0{i}.echo".encode("utf8")) for i in range(3)]
+        client = self.add_client()
+        self.request(client, b"echo", {"n": 1})
+        self.assertEqual(sum(1 for w in workers if w.poll(100)), 1)
+        self.assertEqual(len(self.broker.waiting), 2)
+
+    def test_worker_credits(self):
+        worker = self.add_worker(b"A01.echo", slots=2)
+        client = self.add_client()
+        for i in range(3):
+            self.request(client, b"echo", {"n": i})
+
+        # Two requests in flight, the third waits for a credit
+        first, second = self.recv(worker), self.recv(worker)
+        self.assertFalse(worker.poll(100))
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 1)
+        self.assertEqual(len(self.broker.waiting), 0)
+
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, second[-3], b"", b'"second"'])
+        self.pump()
+        third = self.recv(worker)
+        self.assertEqual(json.loads(third[-1]), {"n": 2})
+        self.assertEqual(self.recv(client)[-1], b'"second"')
+
+        for msg in (first, third):
+            worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, msg[-3], b"", b'"done"'])
+        self.pump()
+        busy = next(iter(self.broker.workers.values()))
+        self.assertEqual(busy.credit, 2)
+        self.assertEqual(len(self.broker.waiting), 1)
+
+    def test_busy_pipelined_worker_heartbeated(self):
+        worker = self.add_worker(b"A01.echo", slots=2)
+        client = self.add_client()
+        for i in range(2):
+            self.request(client, b"echo", {"n": i})
+        self.recv(worker), self.recv(worker)
+
+        # Busy with both requests for longer than its liveness, it keeps hearing from the broker
+        for _ in range(MajorDomoWorker.HEARTBEAT_LIVENESS + 1):
+            self.broker.heartbeat_at = 0
+            self.broker.send_heartbeats()
+            self.assertEqual(self.recv(worker)[2], MDP.W_HEARTBEAT)
+        busy = self.broker.workers[b"A01.echo"]
+        self.assertEqual((busy.credit, len(busy.inflight)), (0, 2))
+
+    def test_out_of_order_replies_matched_to_their_requests(self):
+        self.broker.cleanup()
+        self.broker = MajorDomoBroker(result_caches={b"sq": (10, 60.0)})
+        self.broker.bind(ENDPOINT)
+        worker = self.add_worker(b"A01.sq", service=b"sq", slots=2)
+        client = self.add_client()
+        self.request(client, b"sq", 2)
+        self.request(client, b"sq", 3)
+        two, three = self.recv(worker), self.recv(worker)
+        self.assertNotEqual(two[-3], three[-3])
+
+        # The second request is answered first
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, three[-3], b"", b"9"])
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, two[-3], b"", b"4"])
+        self.pump()
+        self.assertEqual([self.recv(client)[-1] for _ in range(2)], [b"9", b"4"])
+
+        # Each reply is cached under its own request
+        other = self.add_client(b"C02")
+        self.request(other, b"sq", 2, name=b"C02")
+        self.assertEqual(self.recv(other)[-1], b"4")
+        self.assertFalse(worker.poll(50))
+
+    def test_queue_limit_rejects(self):
+        self.broker.queue_limit = 2
+        client = self.add_client()
+        for i in range(3):
+            self.request(client, b"hybridsolar", {"n": i})
+
+        self.assertEqual(self.recv(client), [b"", MDP.C_CLIENT, b"hybridsolar", MajorDomoBroker.STATUS_QUEUE_FULL])
+        self.assertEqual(len(self.broker.services[b"hybridsolar"].requests), 2)
+
+    def test_queue_limit_drops_oldest(self):
+        self.broker.queue_limits = {b"echo": (1, DROP_OLDEST)}
+        client = self.add_client()
+        self.request(client, b"echo", {"n": 0})
+        self.request(client, b"echo", {"n": 1})
+        self.assertEqual(self.recv(client)[-1], MajorDomoBroker.STATUS_QUEUE_FULL)
+
+        worker = self.add_worker(b"A01.echo")
+        self.assertEqual(json.loads(self.recv(worker)[-1]), {"n": 1})
+
+    def test_mmi_queue(self):
+        self.add_worker(b"A01.echo")
+        client = self.add_client()
+        self.request(client, b"sumnums", {"n": 0})
+
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"mmi.queue", b"sumnums"])
+        self.pump()
+        reply = self.recv(client)
+        self.assertEqual(reply[:3], [b"", MDP.C_CLIENT, b"mmi.queue"])
+        self.assertEqual(json.loads(reply[-1])['depth'], 1)
+
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"mmi.queue", b"nope"])
+        self.pump()
+        self.assertEqual(self.recv(client)[-1], b"404")
+
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"mmi.service", b"echo"])
+        self.pump()
+        self.assertEqual(self.recv(client), [b"", MDP.C_CLIENT, b"mmi.service", b"200"])
+
+    def test_expired_request_not_dispatched(self):
+        client = self.add_client()
+        self.request(client, b"echo", {"n": 0}, header=RoutingHeader(deadline=20))
+        self.request(client, b"echo", {"n": 1}, header=RoutingHeader(deadline=60000))
+        time.sleep(0.05)
+
+        worker = self.add_worker(b"A01.echo")
+        self.assertEqual(json.loads(self.recv(worker)[-1]), {"n": 1})
+        self.assertEqual(self.broker.services[b"echo"].requests.expired, 1)
+
+    def test_purge_requests_without_workers(self):
+        client = self.add_client()
+        self.request(client, b"echo", {"n": 0}, header=RoutingHeader(deadline=20))
+        time.sleep(0.05)
+        self.broker.purge_requests()
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 0)
+
+    def test_fair_queuing_across_clients(self):
+        self.broker.fair_queuing = True
+        chatty, quiet = self.add_client(b"C01"), self.add_client(b"C02")
+        for i in range(3):
+            self.request(chatty, b"echo", {"from": "C01", "n": i}, name=b"C01")
+        self.request(quiet, b"echo", {"from": "C02", "n": 0}, name=b"C02")
+
+        worker = self.add_worker(b"A01.echo")
+        served = []
+        for _ in range(4):
+            msg = self.recv(worker)
+            served.append(json.loads(msg[-1])["from"])
+            worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, msg[-3], b"", b'"done"'])
+            self.pump()
+        self.assertEqual(served, ["C01", "C02", "C01", "C01"])
+
+    def test_non_positive_client_weight_rejected(self):
+        with self.assertRaises(ValueError):
+            MajorDomoBroker(fair_queuing=True, client_weights={b"C01": 0})
+
+    def test_latency_and_load_drive_leader(self):
+        self.broker.leader_strategy = get_strategy('load')
+        workers = [self.add_worker(f"A0{i}.sumnums".encode("utf8"), b"sumnums") for i in range(2)]
+        for i, worker in enumerate(workers):
+            load = b"0.1" if i == 1 else b"0.9"
+            worker.send_multipart([b"", MDP.W_WORKER, MDP.W_HEARTBEAT, b"tcp://127.0.0.1:5560", load])
+        self.pump()
+
+        client = self.add_client()
+        self.request(client, b"sumnums", {"target": 10}, header=RoutingHeader(multiple=True))
+        msgs = [self.recv(worker) for worker in workers]
+        self.assertEqual([msg[3] for msg in msgs], [MDP.W_FOLLOWER, MDP.W_LEADER])
+
+        workers[0].send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, msgs[0][-3], b"", b'"done"'])
+        self.pump()
+        stats = self.broker.workers[b"A00.sumnums"].latency
+        self.assertEqual(stats.count, 1)
+        self.assertGreater(stats.ewma, 0)
+
+    def test_gang_waits_for_quorum(self):
+        workers = [self.add_worker(f"A0{i}.sumnums".encode("utf8"), b"sumnums") for i in range(2)]
+        client = self.add_client()
+        header = RoutingHeader(multiple=True, min_workers=3, group_size=3)
+        self.request(client, b"sumnums", {"target": 10}, header=header)
+        self.request(client, b"sumnums", {"target": 20}, header=RoutingHeader())
+        self.assertFalse(any(w.poll(50) for w in workers))
+
+        workers += [self.add_worker(b"A02.sumnums", b"sumnums"), self.add_worker(b"A03.sumnums", b"sumnums")]
+        msgs = [self.recv(w) for w in workers[:3]]
+        self.assertTrue(all(json.loads(msg[-1]) == {"target": 10} for msg in msgs))
+        # the request that was queued behind the group goes to the fourth worker
+        self.assertEqual(json.loads(self.recv(workers[3])[-1]), {"target": 20})
+
+    def test_gang_assembly_timeout(self):
+        worker = self.add_worker(b"A01.sumnums", b"sumnums")
+        client = self.add_client()
+        header = RoutingHeader(multiple=True, min_workers=2, assembly_timeout=300)
+        self.request(client, b"sumnums", {"target": 10}, header=header)
+        self.request(client, b"sumnums", {"target": 20}, header=RoutingHeader())
+        self.assertFalse(worker.poll(50))
+
+        time.sleep(0.3)
+        self.broker.purge_requests()
+        self.assertEqual(self.recv(client)[-1], MajorDomoBroker.STATUS_ASSEMBLY_TIMEOUT)
+        self.assertEqual(json.loads(self.recv(worker)[-1]), {"target": 20})
+
+    def test_mmi_stats_and_workers(self):
+        workers = [self.add_worker(f"A0{i}.echo".encode("utf8")) for i in range(2)]
+        client = self.add_client()
+        self.request(client, b"echo", {"n": 0})
+        msg = self.recv(workers[0])
+        workers[0].send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, msg[-3], b"", b'"done"'])
+        self.pump()
+        self.recv(client)
+        self.request(client, b"echo", {"n": 1})
+
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"mmi.stats", b"echo"])
+        self.pump()
+        stats = json.loads(self.recv(client)[-1])
+        self.assertEqual((stats['workers'], stats['idle'], stats['busy']), (2, 1, 1))
+        self.assertEqual((stats['dispatched'], stats['replies']), (2, 1))
+        self.assertEqual(stats['latency']['count'], 1)
+        self.assertEqual(sum(bucket[2] for bucket in stats['latency']['buckets']), 1)
+
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"mmi.stats", b""])
+        self.pump()
+        stats = json.loads(self.recv(client)[-1])
+        self.assertEqual(stats['broker']['workers'], 2)
+        self.assertIn("echo", stats['services'])
+
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"mmi.workers", b"echo"])
+        self.pump()
+        report = json.loads(self.recv(client)[-1])
+        self.assertEqual(sorted(report), ["A00.echo", "A01.echo"])
+        self.assertEqual([report[name]['idle'] for name in sorted(report)], [True, False])
+        self.assertLess(report["A00.echo"]['heartbeat_age'], 1.0)
+
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"mmi.workers", b"nope"])
+        self.pump()
+        self.assertEqual(self.recv(client)[-1], b"404")
+
+
+    def test_journal_requeues_after_restart(self):
+        path = os.path.join(tempfile.mkdtemp(), "broker.journal")
+        self.broker.cleanup()
+        self.broker = MajorDomoBroker(journal_path=path, journal_sync=0)
+        self.broker.bind(ENDPOINT)
+
+        client = self.add_client()
+        for i in range(3):
+            self.request(client, b"echo", {"n": i})
+        worker = self.add_worker(b"A01.echo")
+        self.assertEqual(json.loads(self.recv(worker)[-1]), {"n": 0})
+
+        # Crash and restart: the two requests never dispatched come back
+        self.broker.cleanup()
+        self.broker = MajorDomoBroker(journal_path=path)
+        self.broker.bind(ENDPOINT)
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 2)
+
+        worker = self.add_worker(b"A02.echo")
+        self.assertEqual(json.loads(self.recv(worker)[-1]), {"n": 1})
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def test_journal_with_spilled_requests(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "broker.journal")
+        self.broker.cleanup()
+        self.broker = MajorDomoBroker(journal_path=path, journal_sync=0, queue_limit=1, overflow_policy=SPILL,
+                                      spill_dir=directory)
+        self.broker.bind(ENDPOINT)
+
+        client = self.add_client()
+        for i in range(3):
+            self.request(client, b"echo", {"n": i})
+        worker = self.add_worker(b"A01.echo")
+        msg = self.recv(worker)
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, msg[-3], b"", b'"done"'])
+        self.pump()
+        # Read back from the spill file, it is a copy of the request that was journaled
+        self.assertEqual(json.loads(self.recv(worker)[-1]), {"n": 1})
+
+        self.broker.cleanup()
+        self.broker = MajorDomoBroker(journal_path=path)
+        self.broker.bind(ENDPOINT)
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 1)
+
+        worker = self.add_worker(b"A02.echo")
+        self.assertEqual(json.loads(self.recv(worker)[-1]), {"n": 2})
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def test_retries_coalesce_onto_original(self):
+        worker = self.add_worker(b"A01.echo")
+        client = self.add_client()
+        retry = self.add_client(b"C01-retry")
+        header = RoutingHeader(request_id=b"job-1")
+
+        self.request(client, b"echo", {"n": 1}, header=header)
+        client_addr = self.recv(worker)[-3]
+        # Resent while in flight, from the same address and from a new one: neither reaches a worker
+        self.request(client, b"echo", {"n": 1}, header=header)
+        self.request(retry, b"echo", {"n": 1}, header=header)
+        self.assertFalse(worker.poll(50))
+
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, client_addr, b"", b'"done"'])
+        self.pump()
+        self.assertEqual(self.recv(client)[-1], b'"done"')
+        self.assertEqual(self.recv(retry)[-1], b'"done"')
+        self.assertFalse(client.poll(50))
+
+        # Resent after completing: answered from the table
+        self.request(retry, b"echo", {"n": 1}, header=header)
+        self.assertEqual(self.recv(retry)[-1], b'"done"')
+        self.assertFalse(worker.poll(50))
+        self.assertEqual(self.broker.request_table.as_dict()['coalesced'], 2)
+        self.assertEqual(self.broker.request_table.as_dict()['replayed'], 1)
+
+        # Without an id every request is dispatched
+        self.request(client, b"echo", {"n": 2})
+        self.assertEqual(json.loads(self.recv(worker)[-1]), {"n": 2})
+
+    def test_failed_request_id_is_forgotten(self):
+        client = self.add_client()
+        header = RoutingHeader(request_id=b"job-2", deadline=1)
+        self.request(client, b"echo", {"n": 1}, header=header)
+        time.sleep(0.01)
+        self.broker.purge_requests()
+        self.assertNotIn((b"echo", header.request_id), self.broker.request_table)
+
+        # Its retry goes ahead as a new request
+        self.request(client, b"echo", {"n": 1}, header=RoutingHeader(request_id=b"job-2"))
+        worker = self.add_worker(b"A01.echo")
+        self.assertEqual(json.loads(self.recv(worker)[-1]), {"n": 1})
+
+        # The worker dies with it in flight: the retry is dispatched again
+        self.broker.delete_worker(self.broker.workers[next(iter(self.broker.workers))], False)
+        worker = self.add_worker(b"A02.echo")
+        self.request(client, b"echo", {"n": 1}, header=RoutingHeader(request_id=b"job-2"))
+        self.assertEqual(json.loads(self.recv(worker)[-1]), {"n": 1})
+
+
+    def test_result_cache(self):
+        self.broker.cleanup()
+        self.broker = MajorDomoBroker(result_caches={b"echo": (10, 60.0)})
+        self.broker.bind(ENDPOINT)
+        worker = self.add_worker(b"A01.echo")
+        client = self.add_client()
+
+        def ask(body):
+            self.request(client, b"echo", body)
+            if worker.poll(50):
+                client_addr = worker.recv_multipart()[-3]
+                worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, client_addr, b"", json.dumps(body).encode()])
+                self.pump()
+                return True
+            return False
+
+        self.assertTrue(ask({"n": 1}))
+        self.assertEqual(self.recv(client)[-1], b'{"n": 1}')
+        # Same body: served by the broker, the worker never sees it
+        self.assertFalse(ask({"n": 1}))
+        self.assertEqual(self.recv(client)[-1], b'{"n": 1}')
+        self.assertTrue(ask({"n": 2}))
+        self.recv(client)
+
+        # A new worker invalidates the cache
+        self.add_worker(b"A02.echo")
+        self.assertEqual(len(self.broker.services[b"echo"].cache), 0)
+        stats = json.loads(self.broker.stats_report(b"echo"))['cache']
+        self.assertEqual((stats['hits'], stats['invalidations']), (1, 2))
+
+    def test_fast_path(self):
+        self.broker.cleanup()
+        self.broker = MajorDomoBroker(fast_services=[b"echo"])
+        self.broker.bind(ENDPOINT)
+        worker = self.add_worker(b"A01.echo", slots=2)
+        client = self.add_client()
+
+        # Same frames out to the worker and back to the client as the full path
+        self.request(client, b"echo", {"n": 1}, header=RoutingHeader())
+        msg = self.recv(worker)
+        self.assertEqual(msg[:4], [b"", MDP.W_WORKER, MDP.W_REQUEST, MDP.W_LEADER])
+        self.assertEqual(json.loads(msg[-1]), {"n": 1})
+        self.assertEqual(self.broker.fast_requests, 1)
+        self.assertEqual(len(self.broker.services[b"echo"].waiting), 1)
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, msg[-3], b"", b'"done"'])
+        self.pump()
+        self.assertEqual(self.recv(client), [b"", MDP.C_CLIENT, b"echo", b'"done"'])
+        self.assertEqual(next(iter(self.broker.workers.values())).credit, 2)
+
+        # Group requests and requests without a header take the full path
+        self.request(client, b"echo", {"n": 2}, header=RoutingHeader(multiple=True, group_size=1))
+        self.request(client, b"echo", {"n": 3})
+        self.assertEqual(self.broker.fast_requests, 1)
+        # Out of credit: queued, and dispatched when a reply frees a slot
+        self.request(client, b"echo", {"n": 4}, header=RoutingHeader())
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 1)
+        first = self.recv(worker)
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, first[-3], b"", b'"done"'])
+        self.pump()
+        self.recv(worker)
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 0)
+        self.assertEqual(self.broker.fast_requests, 1)
+
+        with self.assertRaises(ValueError):
+            MajorDomoBroker(fast_services=[b"echo"], result_caches={b"echo": (10, 60.0)})
+
+
+class TestWorkerQueue(unittest.TestCase):
+
+    def test_fifo_and_remove(self):
+        workers = [Worker(f"A0{i}.echo".encode("utf8"), 0, None) for i in range(3)]
+        queue = WorkerQueue()
+        for worker in workers:
+            queue.append(worker)
+
+        queue.remove(workers[1])
+        queue.remove(workers[1])        # removing twice is harmless
+        self.assertNotIn(workers[1], queue)
+        self.assertEqual(queue.popleft(), workers[0])
+        queue.append(workers[0])
+        self.assertEqual(list(queue), [workers[2], workers[0]])
+
+
+class TestAsyncMajorDomoBroker(unittest.TestCase):
+
+    def test_request_reply(self):
+        broker = MajorDomoBroker(use_asyncio=True)
+        endpoint = "inproc://test-async-broker"
+        broker.bind(endpoint)
+
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(broker.run_async())
+
+        def run_loop():
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+
+        thread = threading.Thread(target=run_loop, daemon=True)
+        thread.start()
+
+        # A sync context sharing the broker's underlying context, so inproc endpoints resolve
+        ctx = zmq.Context.shadow(broker.ctx.underlying)
+        worker = ctx.socket(zmq.DEALER)
+        worker.identity = b"A01.echo"
+        worker.connect(endpoint)
+        client = ctx.socket(zmq.DEALER)
+        client.connect(endpoint)
+        try:
+            worker.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"echo"])
+            time.sleep(0.1)
+            client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"echo", b'{"n": 1}'])
+
+            self.assertTrue(worker.poll(1000))
+            msg = worker.recv_multipart()
+            self.assertEqual(msg[2], MDP.W_REQUEST)
+            worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, msg[-3], b"", b'"done"'])
+
+            self.assertTrue(client.poll(1000))
+            self.assertEqual(client.recv_multipart()[-1], b'"done"')
+        finally:
+            worker.close(0)
+            client.close(0)
+            loop.call_soon_threadsafe(task.cancel)
+            thread.join(1)
+            broker.cleanup()
+
+
+class TestBinaryStar(unittest.TestCase):
+    """ A primary and a backup broker in one process, exchanging state over ipc """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.endpoints = {name: f"ipc://{self.directory}/{name}.ipc"
+                          for name in ("primary", "backup", "primary-state", "backup-state")}
+        self.primary = MajorDomoBroker(bstar_role='primary', bstar_local=self.endpoints["primary-state"],
+                                       bstar_remote=self.endpoints["backup-state"])
+        self.primary.bind(self.endpoints["primary"])
+        self.backup = MajorDomoBroker(bstar_role='backup', bstar_local=self.endpoints["backup-state"],
+                                      bstar_remote=self.endpoints["primary-state"])
+        self.backup.bind(self.endpoints["backup"])
+        self.brokers = [self.primary, self.backup]
+        self.ctx = zmq.Context()
+
+    def tearDown(self):
+        self.ctx.destroy(0)
+        for broker in self.brokers:
+            broker.cleanup()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def connect(self, broker, identity):
+        socket = self.ctx.socket(zmq.DEALER)
+        socket.linger = 0
+        socket.identity = identity
+        socket.connect(self.endpoints[broker])
+        return socket
+
+    def exchange_state(self, until, timeout=2.0):
+        deadline = time.time() + timeout
+        while not until():
+            self.assertLess(time.time(), deadline, "brokers did not reach the expected state")
+            for broker in self.brokers:
+                broker.bstar.send_at = 0
+                broker.bstar.send_state(time.time())
+            time.sleep(0.02)
+            for broker in self.brokers:
+                broker.recv_state()
+
+    @staticmethod
+    def pump(broker):
+        while broker.socket.poll(50):
+            broker.recv_batch()
+
+    def test_failover_to_backup(self):
+        self.exchange_state(lambda: self.primary.bstar.active and self.backup.bstar.state == bstar.PASSIVE)
+
+        worker = self.connect("primary", b"A01.echo")
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"echo"])
+        client = self.connect("primary", b"C01-test")
+        for i in range(2):
+            client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"echo", json.dumps({"n": i}).encode("utf8")])
+        self.pump(self.primary)
+        self.assertTrue(worker.poll(500))
+        first = worker.recv_multipart()
+
+        # The backup shadows the request still queued and the worker
+        self.exchange_state(lambda: len(self.backup.bstar.requests) == 1 and len(self.backup.bstar.workers) == 1)
+        self.assertEqual(len(self.backup.workers), 0)
+
+        # The primary dies, the worker and client turn to the backup
+        self.brokers.remove(self.primary)
+        self.primary.cleanup()
+        worker.close(0)
+        client.close(0)
+        self.backup.bstar.peer_expiry = 0
+
+        client = self.connect("backup", b"C01-test")
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"mmi.service", b"echo"])
+        self.pump(self.backup)
+        self.assertTrue(self.backup.bstar.active)
+        self.assertTrue(client.poll(500))
+        client.recv_multipart()
+
+        # The worker was registered with the primary, it doesn't need to register again
+        worker = self.connect("backup", b"A01.echo")
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, first[-3], b"", b'"done"'])
+        self.pump(self.backup)
+
+        self.assertTrue(worker.poll(500))
+        self.assertEqual(json.loads(worker.recv_multipart()[-1]), {"n": 1})
+        self.assertTrue(client.poll(500))
+        self.assertEqual(client.recv_multipart()[-1], b'"done"')
+
+    def test_spilled_requests_replicated(self):
+        self.primary.queue_limit = 1
+        self.primary.overflow_policy = SPILL
+        self.exchange_state(lambda: self.primary.bstar.active and self.backup.bstar.state == bstar.PASSIVE)
+
+        client = self.connect("primary", b"C01-test")
+        for i in range(3):
+            client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"echo", json.dumps({"n": i}).encode("utf8")])
+        self.pump(self.primary)
+        self.exchange_state(lambda: len(self.backup.bstar.requests) == 3)
+
+        worker = self.connect("primary", b"A01.echo")
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"echo"])
+        self.pump(self.primary)
+        self.assertTrue(worker.poll(500))
+        first = worker.recv_multipart()
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, first[-3], b"", b'"done"'])
+        self.pump(self.primary)
+        self.assertTrue(worker.poll(500))
+        self.assertEqual(json.loads(worker.recv_multipart()[-1]), {"n": 1})
+
+        # The spilled request's removal reaches the backup too
+        self.exchange_state(lambda: list(self.backup.bstar.requests) == [b"3"])
+        worker.close(0)
+        client.close(0)
+
+    def test_passive_ignores_clients(self):
+        self.exchange_state(lambda: self.primary.bstar.active and self.backup.bstar.state == bstar.PASSIVE)
+
+        client = self.connect("backup", b"C01-test")
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"mmi.service", b"echo"])
+        self.pump(self.backup)
+        self.assertFalse(client.poll(100))
+        self.assertEqual(self.backup.bstar.state, bstar.PASSIVE)
+        client.close(0)
+
+
+
+class TestWarmRestart(unittest.TestCase):
+    """ A broker restarted from its snapshot over ipc, its workers' sockets reconnecting by themselves """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.endpoint = f"ipc://{self.directory}/broker.ipc"
+        self.path = os.path.join(self.directory, "registry.snapshot")
+        self.ctx = zmq.Context()
+        self.broker = self.start()
+
+    def tearDown(self):
+        self.ctx.destroy(0)
+        self.broker.cleanup()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def start(self, **options):
+        broker = MajorDomoBroker(leader_strategy='round_robin', snapshot_path=self.path, **options)
+        broker.bind(self.endpoint)
+        return broker
+
+    def connect(self, identity):
+        socket = self.ctx.socket(zmq.DEALER)
+        socket.linger = 0
+        socket.identity = identity
+        socket.connect(self.endpoint)
+        return socket
+
+    def pump(self):
+        while self.broker.socket.poll(100):
+            self.broker.recv_batch()
+
+    def test_workers_and_queues_survive_restart(self):
+        workers = [self.connect(f"A0{i}.sumnums".encode("utf8")) for i in range(2)]
+        for i, worker in enumerate(workers):
+            worker.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"sumnums"])
+            worker.send_multipart([b"", MDP.W_WORKER, MDP.W_HEARTBEAT, f"tcp://127.0.0.1:556{i}".encode("utf8"),
+                                   b"0.5", b"0"])
+        client = self.connect(b"C01-test")
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"echo", b'{"n": 1}'])
+        self.pump()
+        self.broker.leader_strategy.turns[b"sumnums"] = 3
+
+        # A planned restart: the snapshot is written on the way out
+        self.broker.cleanup()
+        self.broker = self.start()
+        self.assertEqual(set(self.broker.workers), {b"A00.sumnums", b"A01.sumnums"})
+        self.assertEqual(self.broker.provisional, {b"A00.sumnums", b"A01.sumnums"})
+        service = self.broker.services[b"sumnums"]
+        self.assertEqual((service.workers, len(service.waiting)), (2, 0))
+        self.assertEqual(service.membership.members[b"A01.sumnums"], b"tcp://127.0.0.1:5561")
+        self.assertEqual(self.broker.workers[b"A00.sumnums"].load, 0.5)
+        self.assertEqual(self.broker.leader_strategy.turns, {b"sumnums": 3})
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 1)
+
+        # A heartbeat confirms a worker without it registering again, once its socket has reconnected
+        time.sleep(0.3)
+        workers[0].send_multipart([b"", MDP.W_WORKER, MDP.W_HEARTBEAT, b"tcp://127.0.0.1:5560", b"0.5", b"3"])
+        self.pump()
+        self.assertEqual(self.broker.provisional, {b"A01.sumnums"})
+        self.assertEqual(len(service.waiting), 1)
+        self.assertFalse(workers[0].poll(100))
+
+        # The silent one is dropped once it misses its heartbeat
+        silent = self.broker.workers[b"A01.sumnums"]
+        silent.expiry = time.time() - 1
+        self.broker.expiries.push(silent)
+        self.broker.purge_workers()
+        self.assertEqual(set(self.broker.workers), {b"A00.sumnums"})
+        self.assertEqual(self.broker.provisional, set())
+
+        # Queued requests are dispatched once a worker for them turns up
+        echo = self.connect(b"A02.echo")
+        echo.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"echo"])
+        self.pump()
+        self.assertTrue(echo.poll(500))
+        self.assertEqual(echo.recv_multipart()[-1], b'{"n": 1}')
+
+    def test_spilled_requests_survive_restart(self):
+        self.broker.cleanup()
+        self.broker = self.start(queue_limit=1, overflow_policy=SPILL, spill_dir=self.directory)
+        client = self.connect(b"C01-test")
+        for i in range(3):
+            client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"echo", json.dumps({"n": i}).encode("utf8")])
+        self.pump()
+        self.assertEqual(len(self.broker.services[b"echo"].requests.requests), 1)
+
+        self.broker.cleanup()
+        self.broker = self.start()
+        echo = self.connect(b"A01.echo")
+        echo.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"echo", b"3"])
+        self.pump()
+        received = []
+        while echo.poll(500) and len(received) < 3:
+            received.append(json.loads(echo.recv_multipart()[-1])["n"])
+        self.assertEqual(received, [0, 1, 2])
+        client.close(0)
+        echo.close(0)
+
+    def test_restored_worker_disconnecting_gets_no_request(self):
+        worker = self.connect(b"A01.echo")
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"echo"])
+        self.pump()
+        self.broker.cleanup()
+        self.broker = self.start()
+        client = self.connect(b"C01-test")
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"echo", b'{"n": 1}'])
+        self.pump()
+
+        time.sleep(0.3)
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_DISCONNECT])
+        self.pump()
+        self.assertFalse(worker.poll(100))
+        self.assertEqual(len(self.broker.workers), 0)
+        self.assertEqual(len(self.broker.services[b"echo"].requests), 1)
+
+    def test_corrupt_snapshot_ignored(self):
+        self.broker.cleanup()
+        with open(self.path, 'r+b') as file:
+            file.seek(10)
+            file.write(b"garbage")
+        self.broker = self.start()
+        self.assertEqual(len(self.broker.workers), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import zmq
+
+from auxo_olympus.lib.utils import MDP
+from auxo_olympus.lib.entities.mdbroker import MajorDomoBroker
+from auxo_olympus.lib.entities.mdcliapi import MultiBrokerClient
+
+
+class TestMultiBrokerClient(unittest.TestCase):
+    """ A pool of two brokers on their own threads, each with an echo worker, over ipc """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.endpoints = [f"ipc://{self.directory}/broker-{i}.ipc" for i in range(2)]
+        self.brokers = {}
+        self.threads = []
+        for endpoint in self.endpoints:
+            broker = MajorDomoBroker()
+            # Short poll timeouts so the brokers stop quickly
+            broker.HEARTBEAT_INTERVAL = 100
+            broker.heartbeat_at = time.time()
+            broker.bind(endpoint)
+            self.brokers[endpoint] = broker
+            self.threads.append(threading.Thread(target=broker.run, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+        self.ctx = zmq.Context()
+        self.stopping = threading.Event()
+        self.delays = {endpoint: 0.0 for endpoint in self.endpoints}
+        self.workers = [threading.Thread(target=self.echo, args=(endpoint,), daemon=True) for endpoint in self.endpoints]
+        for worker in self.workers:
+            worker.start()
+        self.client = MultiBrokerClient(self.endpoints, client_name="C01", retries=1)
+        self.client.timeout = 500
+
+    def tearDown(self):
+        self.client.close()
+        self.stopping.set()
+        for worker in self.workers:
+            worker.join()
+        self.ctx.term()
+        for broker in self.brokers.values():
+            broker.stop()
+        for thread in self.threads:
+            thread.join()
+        for broker in self.brokers.values():
+            broker.cleanup()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def echo(self, endpoint):
+        socket = self.ctx.socket(zmq.DEALER)
+        socket.linger = 0
+        socket.identity = b"A01.echo"
+        socket.connect(endpoint)
+        socket.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"echo"])
+        while not self.stopping.is_set():
+            if not socket.poll(50):
+                continue
+            msg = socket.recv_multipart()
+            if msg[2] != MDP.W_REQUEST:
+                continue
+            time.sleep(self.delays[endpoint])
+            socket.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, msg[-3], b"", endpoint.encode("utf8")])
+        socket.close()
+
+    def wait_for_workers(self):
+        for broker in self.brokers.values():
+            deadline = time.time() + 2.0
+            while not broker.services.get(b"echo") or not broker.services[b"echo"].workers:
+                self.assertLess(time.time(), deadline, "worker never registered")
+                time.sleep(0.02)
+
+    def test_service_sticks_to_its_broker(self):
+        self.wait_for_workers()
+        primary = self.client.brokers_for(b"echo")[0]
+        for _ in range(3):
+            self.client.send(b"echo", "hello")
+            self.assertEqual(self.client.recv(), [primary.encode("utf8")])
+
+    def test_failover_to_next_broker(self):
+        self.wait_for_workers()
+        primary, secondary = self.client.brokers_for(b"echo")
+        self.brokers[primary].stop()
+        self.threads[self.endpoints.index(primary)].join()
+
+        self.client.send(b"echo", "hello")
+        self.assertEqual(self.client.recv(), [secondary.encode("utf8")])
+        self.assertFalse(self.client.health[primary].healthy(time.time()))
+        # Until it recovers the failed broker is tried last
+        self.assertEqual(self.client.brokers_for(b"echo"), [secondary, primary])
+
+    def test_hedged_request(self):
+        self.wait_for_workers()
+        self.client.close()
+        self.client = MultiBrokerClient(self.endpoints, client_name="C02", retries=0, hedge_percentile=0.9)
+        self.client.timeout = 5000
+        for _ in range(MultiBrokerClient.HEDGE_MIN_SAMPLES):
+            self.client.latency.record(0.02)
+        primary, secondary = self.client.brokers_for(b"echo")
+        self.delays[primary] = 1.0
+
+        start = time.time()
+        self.client.send(b"echo", "hello")
+        self.assertEqual(self.client.recv(), [secondary.encode("utf8")])
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(self.client.health[secondary].hedges_won, 1)
+
+    def test_stalled_broker_expires_while_hedge_in_flight(self):
+        self.wait_for_workers()
+        self.client.close()
+        self.client = MultiBrokerClient(self.endpoints, client_name="C02", retries=0, hedge_percentile=0.9)
+        self.client.timeout = 400
+        for _ in range(MultiBrokerClient.HEDGE_MIN_SAMPLES):
+            self.client.latency.record(0.2)
+        primary, secondary = self.client.brokers_for(b"echo")
+        self.delays[primary] = 2.0
+        self.delays[secondary] = 0.3
+
+        # Count the client's polls, not the brokers'
+        polls = []
+        poll = zmq.Poller.poll
+
+        def counting_poll(poller, timeout=None):
+            if poller.sockets and poller.sockets[0][0].context is self.client.ctx:
+                polls.append(timeout)
+            return poll(poller, timeout)
+
+        self.client.send(b"echo", "hello")
+        with mock.patch.object(zmq.Poller, 'poll', counting_poll):
+            self.assertEqual(self.client.recv(), [secondary.encode("utf8")])
+        # The stalled broker is failed once its own timeout passes, without spinning until the hedge answers
+        self.assertFalse(self.client.health[primary].healthy(time.time()))
+        self.assertLess(len(polls), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+
+import zmq
+
+from auxo_olympus.lib.utils import MDP
+from auxo_olympus.lib.entities.mdshard import ShardedBroker
+
+
+class ShardedBrokerTestCase(unittest.TestCase):
+    """ Runs a sharded broker's front on a thread and talks to it as clients and workers would """
+    threads = True
+
+    def setUp(self):
+        self.broker = ShardedBroker(2, threads=self.threads)
+        if self.threads:
+            self.endpoint = "inproc://test-sharded-broker"
+        else:
+            self.endpoint = f"ipc://{tempfile.gettempdir()}/test-sharded-broker-{os.getpid()}.ipc"
+        self.broker.bind(self.endpoint)
+        self.broker.start()
+        self.front = threading.Thread(target=self.broker.run, daemon=True)
+        self.front.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for socket in self.sockets:
+            socket.close(0)
+        self.broker.stop()
+        self.front.join()
+        self.broker.cleanup()
+
+    def connect(self, identity):
+        socket = self.broker.ctx.socket(zmq.DEALER)
+        socket.linger = 0
+        socket.identity = identity
+        socket.connect(self.endpoint)
+        self.sockets.append(socket)
+        return socket
+
+    @staticmethod
+    def recv(socket, timeout=5000):
+        assert socket.poll(timeout), "nothing received"
+        return socket.recv_multipart()
+
+    def round_trip(self, services):
+        """ A worker and a request per service, each answered through its own shard """
+        workers = {}
+        for i, service in enumerate(services):
+            workers[service] = self.connect(f"A{i:02d}.".encode() + service)
+            workers[service].send_multipart([b"", MDP.W_WORKER, MDP.W_READY, service])
+
+        client = self.connect(b"C01")
+        for service in services:
+            client.send_multipart([b"", MDP.C_CLIENT, b"C01", service, json.dumps({"to": service.decode()}).encode()])
+        for service, worker in workers.items():
+            msg = self.recv(worker)
+            self.assertEqual(json.loads(msg[-1]), {"to": service.decode()})
+            worker.send_multipart([b"", MDP.W_WORKER, MDP.W_REPLY, msg[-3], b"", b'"' + service + b'"'])
+
+        replies = sorted(self.recv(client)[2:] for _ in services)
+        self.assertEqual(replies, sorted([service, b'"' + service + b'"'] for service in services))
+
+
+class TestShardedBroker(ShardedBrokerTestCase):
+
+    def test_services_spread_over_shards(self):
+        services = [b"echo", b"sumnums", b"vertexcoloring", b"hybridsolar"]
+        self.assertEqual(len({self.broker.shard_of(service) for service in services}), 2)
+        self.round_trip(services)
+
+        # Each shard only knows its own services
+        for index, broker in enumerate(self.broker.brokers):
+            self.assertEqual(sorted(broker.services),
+                             sorted(service for service in services if self.broker.shard_of(service) == index))
+
+    def test_mmi_goes_to_the_owning_shard(self):
+        worker = self.connect(b"A01.sumnums")
+        worker.send_multipart([b"", MDP.W_WORKER, MDP.W_READY, b"sumnums"])
+        client = self.connect(b"C01")
+        client.send_multipart([b"", MDP.C_CLIENT, b"C01", b"mmi.service", b"sumnums"])
+        self.assertEqual(self.recv(client)[-1], b"200")
+
+
+class TestWorkerShards(unittest.TestCase):
+
+    def test_silent_workers_forgotten(self):
+        broker = ShardedBroker(2, threads=True)
+        shard = broker.route([b"W01", b"", MDP.W_WORKER, MDP.W_READY, b"sumnums"])
+        broker.route([b"W02", b"", MDP.W_WORKER, MDP.W_READY, b"echo"])
+        broker.worker_shards[b"W01"][1] -= 2*ShardedBroker.WORKER_TTL
+
+        # A message refreshes the worker, the one that went silent is dropped
+        self.assertEqual(broker.route([b"W01", b"", MDP.W_WORKER, MDP.W_HEARTBEAT]), shard)
+        broker.worker_shards[b"W02"][1] -= 2*ShardedBroker.WORKER_TTL
+        broker.expire_workers(time.time())
+        self.assertEqual(list(broker.worker_shards), [b"W01"])
+
+        broker.route([b"W01", b"", MDP.W_WORKER, MDP.W_DISCONNECT])
+        self.assertEqual(len(broker.worker_shards), 0)
+        broker.cleanup()
+
+
+class TestShardProcesses(ShardedBrokerTestCase):
+    threads = False
+
+    def test_services_spread_over_shards(self):
+        self.round_trip([b"echo", b"sumnums", b"vertexcoloring"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import json
+import unittest
+
+from auxo_olympus.lib.utils.membership import Membership, MembershipReplica
+
+
+class TestMembership(unittest.TestCase):
+
+    def test_diffs_keep_replica_in_sync(self):
+        membership = Membership()
+        replica = MembershipReplica()
+        membership.join(b"A01.sumnums", b"tcp://a:1")
+        membership.join(b"A02.sumnums", b"tcp://b:1")
+        self.assertFalse(membership.join(b"A02.sumnums", b"tcp://b:1"))
+        self.assertTrue(replica.apply(json.loads(membership.update_frame(replica.epoch))))
+        self.assertEqual(replica.epoch, 2)
+
+        # Changes since the replica's epoch collapse to each worker's latest state
+        membership.join(b"A03.sumnums", b"tcp://c:1")
+        membership.leave(b"A03.sumnums")
+        membership.join(b"A01.sumnums", b"tcp://a:2")
+        membership.leave(b"A02.sumnums")
+        update = membership.update(2)
+        self.assertEqual(update, {'epoch': 6, 'since': 2, 'joined': {"A01.sumnums": "tcp://a:2"},
+                                  'left': ["A03.sumnums", "A02.sumnums"]})
+        self.assertTrue(replica.apply(update))
+        self.assertEqual(replica.members, {"A01.sumnums": "tcp://a:2"})
+
+        # Applying an update twice, or one overlapping what the replica has, changes nothing
+        self.assertTrue(replica.apply(update))
+        self.assertTrue(replica.apply(membership.update(4)))
+        self.assertEqual((replica.epoch, replica.members), (6, {"A01.sumnums": "tcp://a:2"}))
+
+    def test_snapshot_when_behind_the_log(self):
+        membership = Membership(log_size=2)
+        for i in range(4):
+            membership.join(f"A0{i}.echo".encode("utf8"), b"tcp://x:1")
+        self.assertTrue(membership.update(1)['reset'])
+        self.assertNotIn('reset', membership.update(2))
+        # An epoch from before a restart can't be diffed against
+        self.assertTrue(membership.update(9)['reset'])
+        self.assertIs(membership.update_frame(2), membership.update_frame(2))
+
+    def test_replica_detects_gap(self):
+        membership = Membership()
+        replica = MembershipReplica()
+        membership.join(b"A01.echo", b"tcp://a:1")
+        replica.apply(membership.update(0))
+        membership.join(b"A02.echo", b"tcp://b:1")
+        membership.join(b"A03.echo", b"tcp://c:1")
+        self.assertFalse(replica.apply(membership.update(2)))
+        self.assertEqual((replica.epoch, replica.members), (0, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+from auxo_olympus.lib.utils.metrics import LatencyHistogram
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_buckets_cover_values(self):
+        histogram = LatencyHistogram()
+        for value in list(range(200)) + [1000, 12345, 10**6, 10**9]:
+            low, high = histogram.bounds(histogram.index(value))
+            self.assertLessEqual(low, value)
+            self.assertLessEqual(value, high)
+            self.assertLessEqual(high - low, max(0, value // histogram.SUB_BUCKETS))
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for _ in range(99):
+            histogram.record(100e-6)
+        histogram.record(50e-3)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.percentile(0.5), 103)
+        self.assertEqual(histogram.percentile(0.999), 50000)
+        self.assertEqual((histogram.min, histogram.max), (100, 50000))
+        self.assertIsNone(LatencyHistogram().percentile(0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+
+from auxo_olympus.lib.utils.request_queue import RequestQueue, REJECT, DROP_OLDEST, SPILL
+
+
+class Request(object):
+    def __init__(self, name, deadline=None, client_name=None, priority=0):
+        self.name = name
+        self.deadline = deadline
+        self.client_name = client_name
+        self.priority = priority
+
+
+class TestRequestQueue(unittest.TestCase):
+
+    def test_unbounded(self):
+        queue = RequestQueue()
+        for i in range(100):
+            self.assertIsNone(queue.append(i))
+        self.assertEqual(len(queue), 100)
+        self.assertEqual(queue.popleft(), 0)
+
+    def test_reject(self):
+        queue = RequestQueue(limit=2, policy=REJECT)
+        queue.append(1)
+        queue.append(2)
+        self.assertEqual(queue.append(3), 3)
+        self.assertEqual([queue.popleft(), queue.popleft()], [1, 2])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_drop_oldest(self):
+        queue = RequestQueue(limit=2, policy=DROP_OLDEST)
+        for i in range(3):
+            queue.append(i)
+        self.assertEqual([queue.popleft(), queue.popleft()], [1, 2])
+
+    def test_drop_oldest_with_nothing_to_drop(self):
+        queue = RequestQueue(limit=0, policy=DROP_OLDEST)
+        self.assertEqual(queue.append(1), 1)
+        self.assertFalse(queue)
+        self.assertEqual(queue.dropped, 1)
+
+    def test_spill_keeps_order(self):
+        queue = RequestQueue(limit=2, policy=SPILL)
+        try:
+            for i in range(6):
+                self.assertIsNone(queue.append({'n': i}))
+            self.assertEqual(len(queue.requests), 2)
+            self.assertEqual(len(queue), 6)
+
+            out = [queue.popleft()['n'] for _ in range(3)]
+            queue.append({'n': 6})
+            out += [queue.popleft()['n'] for _ in range(4)]
+            self.assertEqual(out, list(range(7)))
+            self.assertFalse(queue)
+        finally:
+            queue.close()
+
+    def test_all_requests_reads_spilled(self):
+        queue = RequestQueue(limit=2, policy=SPILL)
+        try:
+            for i in range(5):
+                queue.append({'n': i})
+            queue.popleft()
+            self.assertEqual([request['n'] for request in queue.all_requests()], [1, 2, 3, 4])
+            # Left on the file
+            self.assertEqual([queue.popleft()['n'] for _ in range(4)], [1, 2, 3, 4])
+        finally:
+            queue.close()
+
+    def test_expire(self):
+        queue = RequestQueue()
+        for name, deadline in [('a', 5.0), ('b', None), ('c', 1.0), ('d', 9.0)]:
+            queue.append(Request(name, deadline))
+
+        self.assertEqual([r.name for r in queue.expire(now=6.0)], ['c', 'a'])
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.next_deadline(), 9.0)
+        self.assertEqual([queue.popleft().name, queue.popleft().name], ['b', 'd'])
+        self.assertFalse(queue)
+        self.assertEqual(queue.expired, 2)
+
+    def test_earliest_deadline_first(self):
+        queue = RequestQueue(edf=True)
+        for name, deadline in [('a', None), ('b', 5.0), ('c', 1.0)]:
+            queue.append(Request(name, deadline))
+        self.assertEqual([queue.popleft().name for _ in range(3)], ['c', 'b', 'a'])
+        self.assertIsNone(queue.next_deadline())
+
+    def fill(self, queue, requests):
+        for client, count in requests:
+            for i in range(count):
+                queue.append(Request(f"{client}{i}", client_name=client))
+
+    def test_fair_round_robin(self):
+        queue = RequestQueue(fair=True)
+        self.fill(queue, [('a', 5), ('b', 2)])
+        self.assertEqual([queue.popleft().name for _ in range(7)], ['a0', 'b0', 'a1', 'b1', 'a2', 'a3', 'a4'])
+
+    def test_fair_weights(self):
+        queue = RequestQueue(fair=True, weights={'a': 2})
+        self.fill(queue, [('a', 5), ('b', 3)])
+        self.assertEqual([queue.popleft().name for _ in range(8)], ['a0', 'a1', 'b0', 'a2', 'a3', 'b1', 'a4', 'b2'])
+
+    def test_non_positive_weights_rejected(self):
+        for weight in (0, -1):
+            with self.assertRaises(ValueError):
+                RequestQueue(fair=True, weights={'a': weight})
+
+    def test_priority_levels(self):
+        queue = RequestQueue(fair=True)
+        self.fill(queue, [('bulk', 3)])
+        queue.append(Request('probe', client_name='health', priority=5))
+        self.assertEqual(queue.popleft().name, 'probe')
+        self.assertEqual(queue.popleft().name, 'bulk0')
+
+    def test_fair_skips_expired(self):
+        queue = RequestQueue(fair=True)
+        queue.append(Request('a0', deadline=1.0, client_name='a'))
+        queue.append(Request('a1', client_name='a'))
+        queue.append(Request('b0', client_name='b'))
+        queue.expire(now=2.0)
+        self.assertEqual([queue.popleft().name, queue.popleft().name], ['a1', 'b0'])
+        self.assertFalse(queue)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from auxo_olympus.lib.utils.request_table import RequestTable
+
+KEY = (b"echo", b"job-1")
+
+
+class TestRequestTable(unittest.TestCase):
+
+    def test_group_request_completes_after_every_reply(self):
+        table = RequestTable()
+        self.assertIsNone(table.resend(KEY, b"C1"))
+        table.begin(KEY, b"C1")
+        table.dispatched(KEY, 2)
+
+        self.assertEqual(table.resend(KEY, b"C1"), [])
+        self.assertEqual(table.reply(KEY, [b"a"]), [])
+        # A retry from elsewhere gets the replies so far, then waits for the rest
+        self.assertEqual(table.resend(KEY, b"C2"), [[b"a"]])
+        self.assertEqual(table.reply(KEY, [b"b"]), [b"C2"])
+        self.assertTrue(table.get(KEY).completed)
+        self.assertEqual(table.resend(KEY, b"C3"), [[b"a"], [b"b"]])
+
+    def test_capacity_and_ttl(self):
+        table = RequestTable(capacity=2, ttl=10.0)
+        table.begin((b"echo", b"1"), b"C1", now=0.0)
+        table.begin((b"echo", b"2"), b"C1", now=5.0)
+        table.resend((b"echo", b"1"), b"C1", now=6.0)
+        table.begin((b"echo", b"3"), b"C1", now=7.0)
+        # The least recently used entry went to make room
+        self.assertNotIn((b"echo", b"2"), table)
+        self.assertEqual(len(table), 2)
+
+        self.assertEqual(table.expire(now=16.5), 1)
+        self.assertEqual(list(table.entries), [(b"echo", b"3")])
+        self.assertEqual(table.as_dict()['evicted'], 2)
+
+    def test_forget_returns_waiters(self):
+        table = RequestTable()
+        table.begin(KEY, b"C1")
+        table.resend(KEY, b"C2")
+        self.assertEqual(table.forget(KEY), [b"C2"])
+        self.assertNotIn(KEY, table)
+
+
+if __name__ == '__main__':
+    unittest.main()
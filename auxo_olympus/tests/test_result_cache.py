@@ -0,0 +1,34 @@
+import unittest
+
+from auxo_olympus.lib.utils.result_cache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_lru_and_ttl(self):
+        cache = ResultCache(capacity=2, ttl=10.0)
+        a, b, c = (ResultCache.digest(b"echo", [body]) for body in (b"a", b"b", b"c"))
+        self.assertNotEqual(ResultCache.digest(b"echo", [b"ab"]), ResultCache.digest(b"echo", [b"a", b"b"]))
+
+        cache.put(cache.key(a), [b"A"], now=0.0)
+        cache.put(cache.key(b), [b"B"], now=0.0)
+        self.assertEqual(cache.get(a, now=1.0), [b"A"])
+        cache.put(cache.key(c), [b"C"], now=2.0)
+        self.assertIsNone(cache.get(b, now=2.0))
+        self.assertIsNone(cache.get(a, now=10.5))
+        self.assertEqual(cache.get(c, now=10.5), [b"C"])
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_invalidation_drops_replies_in_flight(self):
+        cache = ResultCache()
+        digest = ResultCache.digest(b"echo", [b"a"])
+        key = cache.key(digest)
+        cache.invalidate()
+        cache.put(key, [b"stale"])
+        self.assertIsNone(cache.get(digest))
+        cache.put(cache.key(digest), [b"fresh"])
+        self.assertEqual(cache.get(digest), [b"fresh"])
+
+
+if __name__ == '__main__':
+    unittest.main()
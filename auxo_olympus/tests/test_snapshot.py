@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from auxo_olympus.lib.utils import snapshot
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "registry.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        records = [[snapshot.WORKER, b"A01.echo", b"echo", b"1", b""], [snapshot.LEADER, b"random"]]
+        snapshot.save(self.path, records)
+        self.assertEqual(snapshot.load(self.path), records)
+
+        # Replaced whole, nothing left behind
+        snapshot.save(self.path, records[1:])
+        self.assertEqual(snapshot.load(self.path), records[1:])
+        self.assertEqual(os.listdir(self.directory), ["registry.snapshot"])
+
+    def test_missing_or_damaged(self):
+        self.assertEqual(snapshot.load(self.path), [])
+        snapshot.save(self.path, [[snapshot.LEADER, b"random"]])
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path) - 1)
+        self.assertEqual(snapshot.load(self.path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
 from setuptools import setup, find_packages
 
-packages = find_packages(exclude=("auxo_olympus.tests", "auxo_olympus.zmq_examples"))
+packages = find_packages(exclude=("auxo_olympus.tests", "auxo_olympus.zmq_examples", "auxo_olympus.benchmarks"))
 
 setup(
       name='auxo_olympus',